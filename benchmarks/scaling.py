@@ -0,0 +1,253 @@
+"""
+Scaling benchmarks on synthetic instances.
+
+For every combination of orders per day and precision, times:
+* the Scenario construction stages
+* Policy.train, per epoch
+* Policy.train per scenario with each simulator (source.events), at fine bucket sizes
+* the lockstep batch simulation of all days, per scenario-epoch
+* the utility kernels
+
+The results are written as JSON so that runs on different commits can be compared:
+
+    python -m benchmarks.scaling --orders 500 2000 8000 --precisions 2 --output bench.json
+    python -m benchmarks.scaling --orders 500 2000 8000 --precisions 2 --compare bench.json
+"""
+import io
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+from contextlib import redirect_stdout
+import numpy as np
+from source.batch import ScenarioBatch, simulate
+from source.bounds import perfect_information_solution
+from source.events import SIMULATORS
+from source.locations import LocationIndex
+from source.policies.do_nothing import DoNothing
+from source.policies.last_nearest_order import LastNearestOrder
+from source.policies.vfa import VFA
+from source.policies.hierarchical_vfa import HierarchicalVFA
+from source.scenario import Scenario, df_to_epoch_tables, get_locations
+from source.spatial import INDEXES, build_order_index
+from source.synthetic import generate_data
+from source.utils import compute_movement_location, get_nearest_order_per_courier, haversine_distance
+
+POLICIES = {
+    'do_nothing': DoNothing,
+    'last_nearest_order': LastNearestOrder,
+    'vfa': VFA,
+    'hvfa': HierarchicalVFA,
+}
+MINUTES_BUCKET_SIZE = 10
+
+
+def measure(fn, repeat: int):
+    """
+    Returns the best wall-clock time of `repeat` calls and the last result.
+    """
+    best, result = float('inf'), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def bench_scenario_stages(data, precision: int, repeat: int):
+    seconds, location_index = measure(
+        lambda: LocationIndex.from_locations(get_locations(data, precision=precision), precision=precision), repeat
+    )
+    results = {'scenario.locations': seconds}
+    results['scenario.distances'], _ = measure(location_index.get_distances, repeat)
+    results['scenario.epoch_tables'], (orders, couriers) = measure(
+        lambda: df_to_epoch_tables(data, MINUTES_BUCKET_SIZE, precision, location_index), repeat
+    )
+    results['scenario.perfect_solution'], _ = measure(
+        lambda: perfect_information_solution(orders, couriers, location_index), repeat
+    )
+    return results, len(location_index)
+
+
+def prepare_scenario(scenario: Scenario):
+    """
+    Builds the lazy distance matrix and perfect-information solution of a scenario, so that the
+    first policy timed on it does not pay for them.
+    """
+    scenario.location_index.get_distances()
+    with redirect_stdout(io.StringIO()):
+        scenario.perfect_solution
+
+
+def bench_policies(scenario: Scenario, policies: list, repeat: int):
+    results = {}
+    active_epochs = sum(scenario.get_couriers(epoch) is not None for epoch in range(scenario.epochs))
+    prepare_scenario(scenario)
+    for name in policies:
+        def train():
+            with redirect_stdout(io.StringIO()):
+                return POLICIES[name](minutes_bucket_size=MINUTES_BUCKET_SIZE, precision=scenario.precision,
+                                      action_details=False).train(scenario)
+        seconds, _ = measure(train, repeat)
+        results[f'train.{name}.per_epoch'] = seconds / max(active_epochs, 1)
+    return results
+
+
+def bench_simulators(data, precision: int, policies: list, buckets: list, repeat: int):
+    results = {}
+    for minutes_bucket_size in buckets:
+        scenario = Scenario(0, 'bench', data, minutes_bucket_size, precision=precision)
+        prepare_scenario(scenario)
+        for name in policies:
+            for simulator in SIMULATORS:
+                def train():
+                    with redirect_stdout(io.StringIO()):
+                        return POLICIES[name](minutes_bucket_size=minutes_bucket_size, precision=precision,
+                                              action_details=False, simulator=simulator).train(scenario)
+                seconds, _ = measure(train, repeat)
+                results[f'simulator.{simulator}.{name}.{minutes_bucket_size:g}min'] = seconds
+    return results
+
+
+def bench_batch(scenarios: list, policies: list, repeat: int):
+    results = {}
+    batch = ScenarioBatch(scenarios)
+    batch.location_index.get_distances()
+    for name in policies:
+        def batch_simulate():
+            policy = POLICIES[name](minutes_bucket_size=MINUTES_BUCKET_SIZE, precision=batch.location_index.precision)
+            return simulate(policy, batch)
+        try:
+            seconds, _ = measure(batch_simulate, repeat)
+        except NotImplementedError:
+            continue
+        results[f'batch.{name}.per_scenario_epoch'] = seconds / batch.num_groups
+    return results
+
+
+def bench_kernels(scenario: Scenario, repeat: int):
+    # Busiest epoch, where the hot loops hurt the most
+    epoch = int(np.argmax(np.diff(scenario.order_table.offsets)))
+    orders = scenario.get_orders(epoch)
+    couriers = scenario.get_couriers(epoch)
+    location_index = scenario.location_index
+    all_cells = np.arange(len(location_index))
+    results = {}
+    for kind in INDEXES:
+        results[f'kernel.order_index.{kind}.all_locations'], _ = measure(
+            lambda: build_order_index(location_index, orders['cell'], kind=kind).nearest(all_cells), repeat
+        )
+    results['kernel.nearest_field.all_locations'], _ = measure(
+        lambda: build_order_index(location_index, orders['cell']).field(all_cells), repeat
+    )
+    if couriers is not None:
+        order_index = build_order_index(location_index, orders['cell'])
+        results['kernel.nearest_order_per_courier'], _ = measure(
+            lambda: get_nearest_order_per_courier(orders, couriers, location_index, order_index=order_index), repeat
+        )
+        results['kernel.compute_movement_location'], _ = measure(
+            lambda: compute_movement_location(
+                couriers['cell'], np.resize(orders['cell'], len(couriers)), location_index
+            ), repeat
+        )
+    lat, lng = location_index.coords[:, 0], location_index.coords[:, 1]
+    results['kernel.haversine_distance.per_pair'] = measure(
+        lambda: haversine_distance(lat, lng, lat[::-1], lng[::-1]), repeat
+    )[0] / len(lat)
+    return results, len(orders), 0 if couriers is None else len(couriers)
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    records = []
+    for precision in args.precisions:
+        for orders_per_day in args.orders:
+            data = generate_data(
+                days=args.days, orders_per_day=orders_per_day, spread_km=args.spread_km, seed=args.seed
+            )
+            day = data[data.start_date == data.start_date.min()]
+            params = {'orders_per_day': orders_per_day, 'precision': precision, 'spread_km': args.spread_km}
+            num_cells = len(LocationIndex.from_locations(get_locations(day, precision=precision), precision))
+            if num_cells > args.max_cells:
+                print(f"Skipping {params}: {num_cells} cells > --max-cells {args.max_cells}", file=sys.stderr)
+                continue
+            stages, num_cells = bench_scenario_stages(day, precision, args.repeat)
+            scenario = Scenario(0, 'bench', day, MINUTES_BUCKET_SIZE, precision=precision)
+            kernels, peak_orders, peak_couriers = bench_kernels(scenario, args.repeat)
+            policies = bench_policies(scenario, args.policies, args.repeat)
+            simulators = bench_simulators(day, precision, args.policies, args.fine_buckets, args.repeat)
+            batch = bench_batch(
+                Scenario.generate_scenarios('bench', data, MINUTES_BUCKET_SIZE, precision=precision),
+                args.policies, args.repeat
+            )
+            for benchmark, seconds in {**stages, **kernels, **policies, **simulators, **batch}.items():
+                records.append({
+                    'benchmark': benchmark,
+                    **params,
+                    'cells': num_cells,
+                    'peak_orders': peak_orders,
+                    'peak_couriers': peak_couriers,
+                    'seconds': seconds,
+                })
+    return {
+        'commit': git_commit(),
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'repeat': args.repeat,
+        'records': records,
+    }
+
+
+def record_key(record):
+    return record['benchmark'], record['orders_per_day'], record['precision'], record['spread_km']
+
+
+def print_results(results, baseline=None):
+    reference = {record_key(r): r['seconds'] for r in baseline['records']} if baseline else {}
+    for record in results['records']:
+        line = (
+            f"{record['benchmark']:<45} orders/day: {record['orders_per_day']:>6} "
+            f"precision: {record['precision']} cells: {record['cells']:>6} - {record['seconds'] * 1e3:10.3f} ms"
+        )
+        if record_key(record) in reference:
+            line += f" - x{reference[record_key(record)] / record['seconds']:.2f} vs {baseline['commit']}"
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', type=int, default=1)
+    parser.add_argument('--orders', type=int, nargs='+', default=[500, 2000, 8000], help='Orders per day')
+    parser.add_argument('--precisions', type=int, nargs='+', default=[2])
+    parser.add_argument('--spread-km', type=float, default=5.0)
+    parser.add_argument('--policies', nargs='+', default=list(POLICIES), choices=list(POLICIES))
+    parser.add_argument('--fine-buckets', type=float, nargs='+', default=[1, 0.5],
+                        help='Bucket sizes (minutes) of the simulator benchmarks')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-cells', type=int, default=20000,
+                        help='Skip configurations whose distance matrix would exceed this many cells')
+    parser.add_argument('--output', help='Write the results as JSON')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare against')
+    args = parser.parse_args()
+
+    results = run(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
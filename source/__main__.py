@@ -1,92 +1,118 @@
 import os
 import csv
-from source.scenario import Scenario
-from source.utils import load_data, split_data
-from source.policies.last_nearest_order import LastNearestOrder
-from source.policies.do_nothing import DoNothing
-from source.policies.vfa import VFA
+import argparse
+from source.batch import evaluate_batch
+from source.config import PARAMS, get_policy, load_scenarios
+from source.events import SIMULATORS
+from source.export import EXPORT_FORMATS
+from source.parallel import SPLITS, evaluate_splits, run_parallel
+from source.profiling import Profiler
+from source.policies.vfa import NEAREST_FIELDS
 
-INSTANCE_NAME = 'robotex5'
 OUTPUT_FOLDER = 'results'
-PARAMS = {
-    'instance_name': INSTANCE_NAME,
-    'input_data_path': f"./data/{INSTANCE_NAME}.csv",
-    'policies': ['do_nothing', 'vfa', 'last_nearest_order'],
-    'minutes_bucket_size': 10,
-    'precision': 2,
-    'train': True,
-    'export_policy_details': True,
-    'verbose': False,
-}
 
 
-def get_policy(name):
-    if name == 'last_nearest_order':
-        return LastNearestOrder
-    elif name == 'do_nothing':
-        return DoNothing
-    elif name == 'vfa':
-        return VFA
-    else:
-        raise ValueError('Unknown policy: {}'.format(name))
+def get_checkpoints(policies: dict, folder: str):
+    """
+    Returns the checkpoint folder of each policy that can be saved: {policy name: folder/policy name}.
+    """
+    if folder is None:
+        return {}
+    return {
+        policy_name: os.path.join(folder, policy_name)
+        for policy_name, policy in policies.items() if hasattr(policy, 'save')
+    }
 
 
-if __name__ == '__main__':
-    data = load_data(PARAMS['input_data_path'])
-    train, test = split_data(data)
-    train_scenarios = Scenario.generate_scenarios(
-        label="train", data=train, minutes_bucket_size=PARAMS['minutes_bucket_size']
-    ) if PARAMS['train'] else []
-    test_scenarios = Scenario.generate_scenarios(
-        label="test", data=test, minutes_bucket_size=PARAMS['minutes_bucket_size']
-    )
-
-    policies_performance = [
-        ("policy", "scenario", "reward", "perfect_reward", "gap", "execution_secs")
-    ]
-    for policy_name in PARAMS.get('policies', []):
-        policy = get_policy(policy_name)(**PARAMS)
-        sum_cost, sum_gap = 0, 0
-        num_scenarios = len(train_scenarios)
-        for scenario in train_scenarios:
-            solution = policy.train(scenario)
-            sum_cost += solution['cost']
-            sum_gap += solution['gap']
-            policies_performance.append(
-                (policy_name, scenario.label, solution['cost'], scenario.perfect_cost,
-                 solution['gap'], solution['execution_secs'])
-            )
-        if PARAMS['train']:
-            print(
-                f"Train -> Policy: {policy_name} "
-                f"| Avg. reward: {sum_cost / num_scenarios} "
-                f"| gap: {(sum_gap / num_scenarios * 100):.1f}%"
-            )
-
-        sum_cost, sum_gap = 0, 0
-        num_scenarios = len(test_scenarios)
-        for scenario in test_scenarios:
-            solution = policy.train(scenario)
-            sum_cost += solution['cost']
-            sum_gap += solution['gap']
-            policies_performance.append(
-                (policy_name, scenario.label, solution['cost'], scenario.perfect_cost,
-                 solution['gap'], solution['execution_secs'])
-            )
-
+def print_summary(policy_name, rows):
+    for split in SPLITS:
+        split_rows = [row for row in rows if row[0] == policy_name and row[1] == split]
+        if not split_rows:
+            continue
+        num_scenarios = len(split_rows)
+        sum_cost = sum(row[2] for row in split_rows)
+        sum_gap = sum(row[4] for row in split_rows)
         print(
-            f"Test -> Policy: {policy_name} "
+            f"{split.capitalize()} -> Policy: {policy_name} "
             f"| Avg. reward: {sum_cost / num_scenarios} "
             f"| gap: {(sum_gap / num_scenarios * 100):.1f}%"
         )
 
-    # Export performance metrics
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=PARAMS['jobs'], help='Number of worker processes')
+    parser.add_argument('--parallel-stateful', action='store_true', default=PARAMS['parallel_stateful'],
+                        help='Evaluate test scenarios of stateful policies in parallel after training')
+    parser.add_argument('--profile', default=PARAMS['profile'], metavar='FOLDER',
+                        help='Record per-epoch timings and memory peaks and write the trace to FOLDER')
+    parser.add_argument('--save-checkpoints', default=PARAMS['save_checkpoints'], metavar='FOLDER',
+                        help='Save trained stateful policies (e.g. VFA) to FOLDER after the train scenarios')
+    parser.add_argument('--from-checkpoints', default=PARAMS['from_checkpoints'], metavar='FOLDER',
+                        help='Load stateful policies from FOLDER and evaluate the test scenarios only')
+    parser.add_argument('--export-actions', default=PARAMS['export_actions'], choices=EXPORT_FORMATS,
+                        help='Stream per-epoch decisions and costs as gzipped JSON lines or CSV')
+    parser.add_argument('--export-traces', action='store_true', default=PARAMS['export_traces'],
+                        help='Save compact per-scenario action traces that source.rescore can re-score')
+    parser.add_argument('--summary-only', action='store_true', default=PARAMS['summary_only'],
+                        help='Keep only the per-scenario summary in memory')
+    parser.add_argument('--batch', action='store_true', default=PARAMS['batch'],
+                        help='Simulate the scenarios of each split in lockstep (policies with take_action_batch)')
+    parser.add_argument('--simulator', default=PARAMS['simulator'], choices=SIMULATORS,
+                        help='Simulate every epoch or only the epochs with events (same costs)')
+    parser.add_argument('--nearest-field', default=PARAMS['nearest_field'], choices=NEAREST_FIELDS,
+                        help='How VFA samples the nearest order of every cell (transform: approximate, faster)')
+    args = parser.parse_args()
+    if args.batch and 'hvfa' in PARAMS['policies']:
+        parser.error("--batch is not supported by the hvfa policy (remove it from PARAMS['policies'])")
+    profiler = Profiler() if args.profile else None
+    policy_params = {
+        **PARAMS, 'profiler': profiler, 'export_actions': args.export_actions, 'summary_only': args.summary_only,
+        'simulator': args.simulator, 'export_traces': args.export_traces, 'nearest_field': args.nearest_field,
+    }
+
+    scenarios = load_scenarios(profiler, jobs=args.jobs)
+    if not PARAMS['train'] or args.from_checkpoints:
+        scenarios['train'] = []
+
+    policies = {
+        policy_name: get_policy(policy_name)(**policy_params) for policy_name in PARAMS.get('policies', [])
+    }
+    for policy_name, checkpoint in get_checkpoints(policies, args.from_checkpoints).items():
+        policies[policy_name] = get_policy(policy_name).load(checkpoint, **policy_params)
+    checkpoints = get_checkpoints(policies, args.save_checkpoints) if scenarios['train'] else {}
+
+    # Performance metrics are written as each policy finishes
+    output_file = None
     if PARAMS['export_policy_details']:
         os.makedirs(OUTPUT_FOLDER, exist_ok=True)
         file_name = PARAMS['input_data_path'].split('/')[-1].split('.')[0]
         output_file = f"{OUTPUT_FOLDER}/performance_{file_name}.csv"
-        with open(output_file, "w") as out:
-            csv_out = csv.writer(out, lineterminator='\n')
-            for row in policies_performance:
-                csv_out.writerow(row)
+    with open(output_file or os.devnull, "w") as out:
+        csv_out = csv.writer(out, lineterminator='\n')
+        csv_out.writerow((
+            "policy", "scenario", "reward", "perfect_reward", "gap", "execution_secs", "matched_reference_reward"
+        ))
+        if args.jobs > 1 and not args.batch:
+            rows = run_parallel(
+                policies, scenarios, jobs=args.jobs, parallel_stateful=args.parallel_stateful, checkpoints=checkpoints
+            )
+            csv_out.writerows(rows)
+            for policy_name in policies:
+                print_summary(policy_name, rows)
+        else:
+            evaluate = evaluate_batch if args.batch else evaluate_splits
+            for policy_name, policy in policies.items():
+                rows, policy = evaluate(policy, policy_name, scenarios, checkpoints.get(policy_name))
+                csv_out.writerows(rows)
+                out.flush()
+                print_summary(policy_name, rows)
+    if output_file is not None:
         print(f"Performance metrics exported to {output_file}")
+
+    if profiler is not None:
+        profiler.print_summary()
+        os.makedirs(args.profile, exist_ok=True)
+        profiler.to_csv(f"{args.profile}/epochs.csv", f"{args.profile}/stages.csv")
+        profiler.to_json(f"{args.profile}/trace.json")
+        print(f"Profiling trace exported to {args.profile}")
@@ -0,0 +1,241 @@
+"""
+Min-cost assignment on sparse bipartite graphs with a vectorized (Jacobi) auction.
+
+Every round, all unassigned bidders bid at once for their best object at the current prices,
+raising its price by the margin over their second best object plus eps, and every object goes
+to its highest bidder. Rounds are repeated with eps divided by `scaling` until it reaches its
+final value (eps-scaling), keeping the prices and the still eps-optimal assignments of the
+previous phase, which bounds the price wars of contested objects.
+
+There may be more objects than bidders, in which case the objects left unassigned must not be
+priced above the assigned objects of their subproblem (`object_groups`) for the result to be optimal:
+each phase ends with a reverse auction where such objects bid for bidders (the forward/reverse
+method of Bertsekas and Castanon for asymmetric problems). The result is within `eps` per bidder of
+the optimal assignment. `assignment_graph` gives every bidder a private object (being unmatched),
+so that every bidder can be assigned.
+
+`check_optimality` compares the auction with a brute-force search on small random instances:
+
+    python -m source.assignment --instances 700
+"""
+import argparse
+import itertools
+import numpy as np
+
+DEFAULT_EPS = 1e-4
+EPS_SCALING = 8
+
+
+def auction(offsets, objects, costs, num_objects: int, object_groups=None, eps: float = DEFAULT_EPS,
+            scaling: float = EPS_SCALING):
+    """
+    Returns the object assigned to each bidder by a min-cost assignment of all bidders to distinct objects.
+    :param offsets: CSR offsets (bidders + 1) of the edges of each bidder
+    :param objects: object of each edge
+    :param costs: cost of each edge
+    :param num_objects: number of objects (at least the number of bidders)
+    :param object_groups: independent subproblem of each object (e.g. its epoch), None for a single one
+    :param eps: final bid increment (the optimality tolerance per bidder)
+    :param scaling: factor eps is divided by between phases
+    :return: object of each bidder
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    objects = np.asarray(objects, dtype=np.int64)
+    costs = np.asarray(costs, dtype=np.float64)
+    object_groups = np.zeros(num_objects, dtype=np.int64) if object_groups is None else np.asarray(object_groups)
+    num_bidders = len(offsets) - 1
+    degree = np.diff(offsets)
+    if num_bidders and degree.min() == 0:
+        raise ValueError('Every bidder needs at least one edge')
+    prices = np.zeros(num_objects)
+    # Bid margin of bidders with a single edge (nobody else can take their object)
+    span = float(np.ptp(costs)) + eps if len(costs) else eps
+    phase_eps = max(span / scaling, eps)
+    assigned = np.full(num_bidders, -1, dtype=np.int64)
+    assigned_edge = np.full(num_bidders, -1, dtype=np.int64)
+    owner = np.full(num_objects, -1, dtype=np.int64)
+    pending = np.arange(num_bidders)
+    while True:
+        while len(pending):
+            counts = degree[pending]
+            starts = np.cumsum(counts) - counts
+            edges = np.repeat(offsets[pending] - starts, counts) + np.arange(counts.sum())
+            values = -costs[edges] - prices[objects[edges]]
+            best = np.maximum.reduceat(values, starts)
+            # First edge reaching the best value, i.e. the lowest edge on ties
+            ties = np.flatnonzero(values == np.repeat(best, counts))
+            first = ties[np.searchsorted(ties, starts)]
+            values[first] = -np.inf
+            second = np.where(counts > 1, np.maximum.reduceat(values, starts), best - span)
+            targets = objects[edges[first]]
+            bids = prices[targets] + best - second + phase_eps
+            # Highest bid of each object wins (lowest bidder on ties)
+            order = np.lexsort((pending, -bids, targets))
+            winners = order[np.r_[True, targets[order][1:] != targets[order][:-1]]]
+            won = targets[winners]
+            displaced = owner[won]
+            displaced = displaced[displaced >= 0]
+            assigned[displaced] = -1
+            owner[won] = pending[winners]
+            assigned[pending[winners]] = won
+            assigned_edge[pending[winners]] = edges[first][winners]
+            prices[won] = bids[winners]
+            lost = np.ones(len(pending), dtype=bool)
+            lost[winners] = False
+            pending = np.concatenate([pending[lost], displaced])
+        _reverse_auction(offsets, objects, costs, prices, assigned, assigned_edge, owner, object_groups, phase_eps)
+        if phase_eps <= eps:
+            return assigned
+        phase_eps = max(phase_eps / scaling, eps)
+        # Only the assignments that are not eps-optimal at the current prices are bid again
+        values = -costs - prices[objects]
+        best = np.maximum.reduceat(values, offsets[:-1]) if num_bidders else values
+        pending = np.flatnonzero(values[assigned_edge] < best - phase_eps)
+        owner[assigned[pending]] = -1
+        assigned[pending] = -1
+
+
+def _reverse_auction(offsets, objects, costs, prices, assigned, assigned_edge, owner, object_groups, eps: float):
+    """
+    Reverse auction (in place) until no unassigned object is priced above the lowest price of the assigned
+    objects of its group, lambda: such an object bids for its best bidder, offering itself at the price of
+    its second best bidder (at least lambda), or drops its price to lambda if no bidder would gain from it.
+    """
+    num_bidders, num_objects = len(offsets) - 1, len(prices)
+    if not num_bidders:
+        return
+    lam = np.full(object_groups.max(initial=0) + 1, np.inf)
+    np.minimum.at(lam, object_groups[owner >= 0], prices[owner >= 0])
+    lam = lam[object_groups]
+    pending = np.flatnonzero((owner < 0) & (prices > lam))
+    if not len(pending):
+        return
+    edge_bidders = np.repeat(np.arange(num_bidders), np.diff(offsets))
+    by_object = np.argsort(objects, kind='stable')
+    object_degree = np.bincount(objects, minlength=num_objects)
+    object_offsets = np.concatenate([[0], np.cumsum(object_degree)])
+    while len(pending):
+        counts = object_degree[pending]
+        starts = np.cumsum(counts) - counts
+        edges = by_object[np.repeat(object_offsets[pending] - starts, counts) + np.arange(counts.sum())]
+        bidders = edge_bidders[edges]
+        # Gain of each bidder from the object at price 0 over its assignment
+        values = -costs[edges] + costs[assigned_edge[bidders]] + prices[assigned[bidders]]
+        best = np.maximum.reduceat(values, starts)
+        ties = np.flatnonzero(values == np.repeat(best, counts))
+        first = ties[np.searchsorted(ties, starts)]
+        values[first] = -np.inf
+        second = np.where(counts > 1, np.maximum.reduceat(values, starts), -np.inf)
+        settled = lam[pending] >= best - eps
+        prices[pending[settled]] = lam[pending[settled]]
+        offering = np.flatnonzero(~settled)
+        if not len(offering):
+            break
+        targets = bidders[first[offering]]
+        offer_prices = np.maximum(lam[pending[offering]], second[offering] - eps)
+        offers = -costs[edges[first[offering]]] - offer_prices
+        # Best offer to each bidder wins (lowest object on ties)
+        order = np.lexsort((pending[offering], -offers, targets))
+        winners = order[np.r_[True, targets[order][1:] != targets[order][:-1]]]
+        won = targets[winners]
+        released = assigned[won]
+        owner[released] = -1
+        winning_objects = pending[offering[winners]]
+        owner[winning_objects] = won
+        assigned[won] = winning_objects
+        assigned_edge[won] = edges[first[offering[winners]]]
+        prices[winning_objects] = offer_prices[winners]
+        lost = np.ones(len(offering), dtype=bool)
+        lost[winners] = False
+        pending = np.concatenate([pending[offering[lost]], released[prices[released] > lam[released]]])
+
+
+def assignment_graph(num_bidders: int, num_objects: int, bidders, objects, costs, unmatched_costs):
+    """
+    CSR graph for auction where every bidder can also stay unmatched, taking a private object
+    (numbered num_objects + bidder) at `unmatched_costs`.
+    :param num_bidders: number of bidders
+    :param num_objects: number of objects
+    :param bidders: bidder of each edge
+    :param objects: object of each edge
+    :param costs: cost of each edge
+    :param unmatched_costs: cost of leaving each bidder unmatched (scalar or array)
+    :return: tuple (offsets, objects, costs, number of objects) for auction
+    """
+    bidders = np.concatenate([np.asarray(bidders, dtype=np.int64), np.arange(num_bidders)])
+    objects = np.concatenate([np.asarray(objects, dtype=np.int64), num_objects + np.arange(num_bidders)])
+    costs = np.concatenate([
+        np.asarray(costs, dtype=np.float64),
+        np.broadcast_to(np.asarray(unmatched_costs, dtype=np.float64), num_bidders),
+    ])
+    order = np.argsort(bidders, kind='stable')
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(bidders, minlength=num_bidders))])
+    return offsets, objects[order], costs[order], num_objects + num_bidders
+
+
+def brute_force_cost(costs, edges, unmatched_cost: float):
+    """
+    Minimum cost of assigning every bidder (row) to a distinct object (column) it has an edge to,
+    or leaving it unmatched at `unmatched_cost`, by enumerating the assignments.
+    :param costs: bidders x objects costs
+    :param edges: bidders x objects mask of the edges
+    """
+    num_bidders, num_objects = costs.shape
+    best = np.inf
+    for choice in itertools.permutations(list(range(num_objects)) + [-1] * num_bidders, num_bidders):
+        choice = np.array(choice)
+        matched = np.flatnonzero(choice >= 0)
+        if edges[matched, choice[matched]].all():
+            best = min(best, costs[matched, choice[matched]].sum() + unmatched_cost * (num_bidders - len(matched)))
+    return best
+
+
+def check_optimality(instances: int = 700, seed: int = 0, eps: float = 1e-6):
+    """
+    Solves random instances of a few independent groups (up to 4 bidders and 6 objects each) in one
+    auction and compares the cost of each with brute_force_cost.
+    :return: number of instances whose auction cost is more than eps per bidder above the optimum
+    """
+    rng = np.random.default_rng(seed)
+    failures = 0
+    for _ in range(instances):
+        groups = []
+        for _ in range(rng.integers(1, 4)):
+            num_bidders = int(rng.integers(1, 5))
+            num_objects = int(rng.integers(num_bidders, 7))
+            costs = np.round(rng.random((num_bidders, num_objects)) * 3 - 0.2, int(rng.integers(0, 3)))
+            groups.append((costs, rng.random((num_bidders, num_objects)) < 0.6))
+        unmatched_cost = float(rng.choice([0.5, 50.0]))
+        bidder_offsets = np.cumsum([0] + [costs.shape[0] for costs, _ in groups])
+        object_offsets = np.cumsum([0] + [costs.shape[1] for costs, _ in groups])
+        bidders, objects = zip(*(np.nonzero(edges) for _, edges in groups))
+        graph = assignment_graph(
+            bidder_offsets[-1], object_offsets[-1],
+            np.concatenate([group_bidders + offset for group_bidders, offset in zip(bidders, bidder_offsets)]),
+            np.concatenate([group_objects + offset for group_objects, offset in zip(objects, object_offsets)]),
+            np.concatenate([costs[edges] for costs, edges in groups]), unmatched_cost
+        )
+        object_groups = np.concatenate(
+            [np.repeat(np.arange(len(groups)), np.diff(object_offsets)),
+             np.repeat(np.arange(len(groups)), np.diff(bidder_offsets))]
+        )
+        assigned = auction(*graph, object_groups=object_groups, eps=eps, scaling=float(rng.choice([2, 8])))
+        if len(np.unique(assigned)) < len(assigned):
+            failures += 1
+            continue
+        offsets, graph_objects, graph_costs, _ = graph
+        cost = graph_costs[graph_objects == np.repeat(assigned, np.diff(offsets))].sum()
+        optimum = sum(brute_force_cost(costs, edges, unmatched_cost) for costs, edges in groups)
+        failures += cost > optimum + len(assigned) * eps + 1e-9
+    return failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--instances', type=int, default=700)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    failures = check_optimality(args.instances, args.seed)
+    print(f"Auction check: {args.instances} instances - Not optimal: {failures}")
+    if failures:
+        raise SystemExit(1)
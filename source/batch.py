@@ -0,0 +1,202 @@
+"""
+Lockstep simulation of many scenarios at once.
+
+`Policy.train` runs one scenario at a time, one Python iteration per epoch. Here the
+couriers and orders of a whole batch of scenarios are ragged arrays, and a policy decides
+(`take_action_batch`) for many (scenario, epoch) pairs in a single vectorized call:
+* stateless (or frozen) policies decide for every epoch of every scenario at once;
+* learning policies (e.g. VFA) advance all scenarios together, epoch by epoch, so each
+  epoch's update uses the sample paths of all scenarios.
+All decisions are then scored against the orders of their epoch in one call.
+"""
+import time
+import numpy as np
+from source.locations import LocationIndex
+from source.parallel import SPLITS, performance_row
+from source.spatial import grouped_nearest
+
+
+def ragged_rows(offsets, groups):
+    """
+    Returns the rows of the given groups of a CSR layout, in group order, and their count per group.
+    """
+    starts = offsets[groups]
+    counts = offsets[groups + 1] - starts
+    within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(starts, counts) + within, counts
+
+
+class ScenarioBatch:
+    """
+    Scenarios laid out for lockstep simulation.
+
+    Every (scenario, epoch) pair is a group with id `scenario * epochs + epoch`. The cells of
+    the couriers and orders of all groups are stored as arrays sorted by group, with CSR offsets,
+    and refer to a single LocationIndex: the scenarios' own one if they share it, their union otherwise.
+    """
+
+    def __init__(self, scenarios: list):
+        if not scenarios:
+            raise ValueError('A batch needs at least one scenario')
+        epochs = {scenario.epochs for scenario in scenarios}
+        if len(epochs) != 1:
+            raise ValueError('Cannot batch scenarios with {} epochs'.format(sorted(epochs)))
+        self.scenarios = scenarios
+        self.num_scenarios = len(scenarios)
+        self.epochs = epochs.pop()
+        indexes = list({id(scenario.location_index): scenario.location_index for scenario in scenarios}.values())
+        self.location_index = indexes[0] if len(indexes) == 1 else LocationIndex.union(indexes)
+        # Batch cell id of every cell of each scenario's location index
+        cell_maps = [
+            np.arange(len(self.location_index)) if scenario.location_index is self.location_index
+            else self.location_index.lookup_keys(scenario.location_index.keys)
+            for scenario in scenarios
+        ]
+        # Cells of each scenario (see Scenario.cells)
+        self.scenario_cells = [cell_map[scenario.cells] for scenario, cell_map in zip(scenarios, cell_maps)]
+        self.courier_cells, self.courier_offsets = self._gather('courier_table', cell_maps)
+        self.order_cells, self.order_offsets = self._gather('order_table', cell_maps)
+        self.courier_groups = np.repeat(np.arange(self.num_groups), np.diff(self.courier_offsets))
+
+    @property
+    def num_groups(self):
+        return self.num_scenarios * self.epochs
+
+    def _gather(self, table: str, cell_maps: list):
+        cells, counts = [], []
+        for scenario, cell_map in zip(self.scenarios, cell_maps):
+            epoch_table = getattr(scenario, table)
+            cells.append(cell_map[epoch_table.rows['cell']])
+            counts.append(np.diff(epoch_table.offsets))
+        return np.concatenate(cells).astype(np.int64), np.concatenate([[0], np.cumsum(np.concatenate(counts))])
+
+    def epoch_groups(self, epoch: int):
+        """
+        Returns the group of `epoch` in every scenario.
+        """
+        return np.arange(self.num_scenarios) * self.epochs + epoch
+
+    def state(self, groups):
+        return BatchState(self, groups)
+
+    def evaluate(self, move_cells, cost_function=None):
+        """
+        Scores the move cell of every courier against the orders that arise during its epoch.
+        :param move_cells: batch cell id per courier (aligned with `courier_cells`)
+        :param cost_function: maps the nearest-order distances (float64 array) to courier costs
+                              (default: the distances themselves)
+        :return: float64 array (scenarios, epochs) with the cost of every epoch
+        """
+        _, distances = grouped_nearest(
+            self.location_index, move_cells, self.courier_groups, self.order_cells, self.order_offsets
+        )
+        found = np.isfinite(distances)
+        costs = distances[found].astype(np.float64)
+        if cost_function is not None:
+            costs = cost_function(costs)
+        epoch_costs = np.bincount(self.courier_groups[found], weights=costs, minlength=self.num_groups)
+        return epoch_costs.reshape(self.num_scenarios, self.epochs)
+
+
+class BatchState:
+    """
+    Decision-time view of a selection of groups of a ScenarioBatch, the batched counterpart of State:
+    the couriers available at each group's epoch and the orders that arose in the previous epoch of
+    the same scenario (none at epoch 0). `courier_group` and the order offsets index the selection.
+    """
+
+    def __init__(self, batch: ScenarioBatch, groups):
+        self.batch = batch
+        self.location_index = batch.location_index
+        self.groups = np.asarray(groups, dtype=np.int64)
+        self.scenarios = self.groups // batch.epochs
+        self.epochs = self.groups % batch.epochs
+        self.courier_rows, self.courier_counts = ragged_rows(batch.courier_offsets, self.groups)
+        self.courier_cells = batch.courier_cells[self.courier_rows]
+        self.courier_group = np.repeat(np.arange(len(self.groups)), self.courier_counts)
+        first = self.epochs == 0
+        order_rows, order_counts = ragged_rows(batch.order_offsets, np.where(first, 0, self.groups - 1))
+        keep = np.repeat(~first, order_counts)
+        self.order_cells = batch.order_cells[order_rows[keep]]
+        self.order_offsets = np.concatenate([[0], np.cumsum(np.where(first, 0, order_counts))])
+
+    def __len__(self):
+        return len(self.groups)
+
+    @property
+    def order_counts(self):
+        return np.diff(self.order_offsets)
+
+    def nearest_orders(self, query_cells, query_group, max_distance: float = None):
+        """
+        Returns the nearest order (position within its group's orders) and distance of each query cell.
+        :param query_cells: batch cell ids
+        :param query_group: position in the selection of each query's group
+        """
+        return grouped_nearest(
+            self.location_index, query_cells, query_group, self.order_cells, self.order_offsets, max_distance
+        )
+
+    def scenario_cells(self, group_ix):
+        """
+        Returns every cell of the scenario of the given selection positions, with the position of each.
+        :return: tuple (batch cell ids, selection positions)
+        """
+        cells = [self.batch.scenario_cells[scenario] for scenario in self.scenarios[group_ix].tolist()]
+        if not cells:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        return np.concatenate(cells), np.repeat(group_ix, [len(c) for c in cells])
+
+
+def simulate(policy, batch: ScenarioBatch):
+    """
+    Runs a policy over all scenarios of a batch with `take_action_batch`.
+    Stateless and frozen policies decide for all groups at once, other policies epoch by epoch.
+    :return: dict with the cost of each scenario ('costs'), of each epoch ('epoch_costs', scenarios x epochs),
+    'execution_secs' and 'scenario_epochs_per_sec'
+    """
+    now = time.time()
+    if policy.stateless or getattr(policy, 'frozen', False):
+        selections = [np.arange(batch.num_groups)]
+    else:
+        selections = [batch.epoch_groups(epoch) for epoch in range(batch.epochs)]
+    move_cells = np.empty(len(batch.courier_cells), dtype=np.int64)
+    for groups in selections:
+        state = batch.state(groups)
+        move_cells[state.courier_rows] = policy.take_action_batch(state)
+    epoch_costs = batch.evaluate(move_cells)
+    execution_secs = time.time() - now
+    return {
+        'costs': epoch_costs.sum(axis=1),
+        'epoch_costs': epoch_costs,
+        'execution_secs': execution_secs,
+        'scenario_epochs_per_sec': batch.num_groups / max(execution_secs, 1e-9),
+    }
+
+
+def evaluate_batch(policy, policy_name: str, scenarios: dict, checkpoint: str = None):
+    """
+    Batched counterpart of parallel.evaluate_splits: runs each split as one ScenarioBatch.
+    Execution time is reported per scenario as the batch time divided by the number of scenarios.
+    :return: tuple (performance rows, policy after the last split)
+    """
+    rows = []
+    for split in SPLITS:
+        split_scenarios = scenarios.get(split, [])
+        if split_scenarios:
+            result = simulate(policy, ScenarioBatch(split_scenarios))
+            print(
+                f"Policy: {policy.name} - "
+                f"Batch: {split} ({len(split_scenarios)} scenarios) - "
+                f"Execution time: {result['execution_secs']:.1f} - "
+                f"Scenario-epochs/s: {result['scenario_epochs_per_sec']:.0f}"
+            )
+            for scenario, cost in zip(split_scenarios, result['costs'].tolist()):
+                rows.append(performance_row(policy_name, scenario, {
+                    'cost': round(cost, 2),
+                    'execution_secs': result['execution_secs'] / len(split_scenarios),
+                    'gap': round((cost - scenario.perfect_cost) / scenario.perfect_cost, 2),
+                }))
+        if split == 'train' and checkpoint is not None:
+            policy.save(checkpoint)
+    return rows, policy
@@ -0,0 +1,246 @@
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from source.assignment import DEFAULT_EPS, assignment_graph, auction
+from source.locations import LocationIndex
+from source.spatial import build_order_index, grouped_nearest
+from source.utils import compute_movement_location
+
+# Candidate orders of each courier in the matched reference: its k nearest, optionally within a radius (km)
+DEFAULT_CANDIDATES = 8
+DEFAULT_CANDIDATE_RADIUS = None
+
+
+class PerfectSolution:
+    """
+    Perfect-information decisions of a scenario, as arrays aligned with its courier table rows:
+    * order: position (within the epoch) of the courier's nearest order, -1 if the epoch has no orders.
+    * distance: distance from the courier to that order.
+    * move_cell: neighbour cell the courier moves to.
+    * move_distance: distance from the move cell to the order (the courier's cost).
+    * epoch_costs: cost of each epoch.
+
+    These greedy decisions let several couriers head for the same order, as policies are scored,
+    which makes their cost a lower bound on the cost of any policy. The matched reference (see
+    matched_assignment) gives every order to at most one courier. It is not a bound (policies can
+    cost less):
+    * matched_order: position of the courier's matched order, -1 if unmatched (it keeps its greedy decision).
+    * matched_move_cell, matched_move_distance, matched_epoch_costs: as above.
+    """
+
+    def __init__(self, order, distance, move_cell, move_distance, epoch_costs, matched_order=None,
+                 matched_move_cell=None, matched_move_distance=None, matched_epoch_costs=None):
+        self.order = order
+        self.distance = distance
+        self.move_cell = move_cell
+        self.move_distance = move_distance
+        self.epoch_costs = epoch_costs
+        self.matched_order = matched_order
+        self.matched_move_cell = matched_move_cell
+        self.matched_move_distance = matched_move_distance
+        self.matched_epoch_costs = matched_epoch_costs
+
+    @property
+    def cost(self):
+        return float(self.epoch_costs.sum())
+
+    @property
+    def matched_cost(self):
+        return float(self.matched_epoch_costs.sum()) if self.matched_epoch_costs is not None else np.nan
+
+    def to_arrays(self):
+        arrays = {
+            'order': self.order,
+            'distance': self.distance,
+            'move_cell': self.move_cell,
+            'move_distance': self.move_distance,
+            'epoch_costs': self.epoch_costs,
+            'matched_order': self.matched_order,
+            'matched_move_cell': self.matched_move_cell,
+            'matched_move_distance': self.matched_move_distance,
+            'matched_epoch_costs': self.matched_epoch_costs,
+        }
+        return {key: value for key, value in arrays.items() if value is not None}
+
+    @classmethod
+    def from_arrays(cls, arrays: dict):
+        return cls(**arrays)
+
+    def decisions(self, courier_table, location_index: LocationIndex):
+        """
+        Returns the decisions as {epoch: {'actions': {courier: {...}}, 'cost': float}}.
+        """
+        best_decisions = dict()
+        for epoch in range(len(courier_table)):
+            best_decisions[epoch] = dict()
+            start, end = courier_table.offsets[epoch], courier_table.offsets[epoch + 1]
+            if end == start or self.order[start] < 0:
+                continue
+            actions = dict()
+            for j, row in enumerate(range(start, end)):
+                move_lat, move_lng = location_index.location(self.move_cell[row])
+                actions[j] = {
+                    'order_id': int(self.order[row]),
+                    'distance': float(self.distance[row]),
+                    'move_distance': float(self.move_distance[row]),
+                    'lat': move_lat,
+                    'lng': move_lng,
+                    'cell': int(self.move_cell[row]),
+                }
+            best_decisions[epoch]['actions'] = actions
+            best_decisions[epoch]['cost'] = float(self.epoch_costs[epoch])
+        return best_decisions
+
+
+def perfect_information_solution(order_table, courier_table, location_index: LocationIndex, matched: bool = True):
+    """
+    Moves every courier towards the nearest order of its epoch (orders known in advance).
+    All epochs are solved together, each epoch being a group of spatial.grouped_nearest.
+    :param matched: also compute the matched reference (see matched_assignment)
+    :return: PerfectSolution
+    """
+    num_epochs = len(courier_table)
+    num_couriers = len(courier_table.rows)
+    courier_epoch = courier_table.epoch
+    order, distance = grouped_nearest(
+        location_index, courier_table.rows['cell'], courier_epoch, order_table.rows['cell'], order_table.offsets
+    )
+
+    found = order >= 0
+    move_cell = courier_table.rows['cell'].astype(np.int64)
+    move_distance = np.zeros(num_couriers, dtype=np.float32)
+    order_rows = order_table.offsets[courier_epoch[found]] + order[found]
+    move_cell[found], move_distance[found] = compute_movement_location(
+        move_cell[found], order_table.rows['cell'][order_rows], location_index
+    )
+    epoch_costs = np.bincount(
+        courier_epoch[found], weights=move_distance[found].astype(np.float64), minlength=num_epochs
+    )
+    solution = PerfectSolution(order, distance, move_cell, move_distance, epoch_costs)
+    if matched:
+        (solution.matched_order, solution.matched_move_cell, solution.matched_move_distance,
+         solution.matched_epoch_costs) = matched_assignment(order_table, courier_table, location_index, solution)
+    return solution
+
+
+def candidate_pairs(order_table, courier_table, location_index: LocationIndex, k: int = DEFAULT_CANDIDATES,
+                    radius: float = DEFAULT_CANDIDATE_RADIUS):
+    """
+    Returns the sparse candidate graph of the matched reference: the k nearest orders of each courier
+    and the k nearest couriers of each order, among those of their epoch (within `radius` km if given).
+    :return: tuple (courier rows, order rows) of the candidate pairs, sorted by courier then order
+    """
+    couriers, orders = [], []
+    for epoch in np.flatnonzero(np.diff(courier_table.offsets) * np.diff(order_table.offsets)).tolist():
+        courier_start, order_start = courier_table.offsets[epoch], order_table.offsets[epoch]
+        courier_cells = courier_table.rows['cell'][courier_start:courier_table.offsets[epoch + 1]]
+        order_cells = order_table.rows['cell'][order_start:order_table.offsets[epoch + 1]]
+        nearest_orders, _ = build_order_index(location_index, order_cells).k_nearest(
+            courier_cells, k, max_distance=radius
+        )
+        nearest_couriers, _ = build_order_index(location_index, courier_cells).k_nearest(
+            order_cells, k, max_distance=radius
+        )
+        found, found_reverse = nearest_orders >= 0, nearest_couriers >= 0
+        couriers += [
+            courier_start + np.nonzero(found)[0], courier_start + nearest_couriers[found_reverse]
+        ]
+        orders += [
+            order_start + nearest_orders[found], order_start + np.nonzero(found_reverse)[0]
+        ]
+    if not couriers:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    couriers, orders = np.concatenate(couriers), np.concatenate(orders)
+    pairs = np.unique(couriers * len(order_table.rows) + orders)
+    return pairs // len(order_table.rows), pairs % len(order_table.rows)
+
+
+def matched_assignment(order_table, courier_table, location_index: LocationIndex, solution: PerfectSolution,
+                       k: int = DEFAULT_CANDIDATES, radius: float = DEFAULT_CANDIDATE_RADIUS, eps: float = DEFAULT_EPS):
+    """
+    Perfect-information reference where every order goes to at most one courier: in each epoch, as many
+    couriers as possible are matched to distinct candidate orders (candidate_pairs) at minimum total
+    cost, each moving towards its order. Couriers left without an order (more couriers than orders,
+    or no free candidate) keep their greedy decision, so the matched cost is never below the greedy one.
+    Policies are scored without this rule, and the greedy solution is optimal there: the matched cost
+    is not a bound on policy costs, which can be below it.
+    All epochs are solved as a single sparse auction (source.assignment), within `eps` km per courier
+    and order of the optimal matching over the candidate graph.
+    :param solution: greedy solution of the scenario
+    :param k: candidate orders per courier
+    :param radius: optional candidate radius (km)
+    :param eps: auction tolerance (km)
+    :return: tuple (matched order positions (-1 if unmatched), move cells, move distances, epoch costs)
+    """
+    num_couriers, num_orders = len(courier_table.rows), len(order_table.rows)
+    courier_epoch = courier_table.epoch
+    couriers, orders = candidate_pairs(order_table, courier_table, location_index, k=k, radius=radius)
+    move_cells, move_distances = compute_movement_location(
+        courier_table.rows['cell'][couriers], order_table.rows['cell'][orders], location_index
+    )
+    # A match only costs its excess over the courier's greedy cost, which unmatched couriers pay
+    excess = move_distances - solution.move_distance[couriers].astype(np.float64)
+    # The smaller side of each epoch bids for the other (couriers for orders or orders for couriers),
+    # and leaving one of its nodes unmatched costs more than any rearrangement of the epoch's matches can
+    # save, so that as many pairs as possible are matched (unmatched nodes of the other side cost nothing)
+    epoch_couriers, epoch_orders = np.diff(courier_table.offsets), np.diff(order_table.offsets)
+    courier_bids = (epoch_couriers <= epoch_orders)[courier_epoch[couriers]]
+    nodes, bidders = np.unique(np.where(courier_bids, couriers, num_couriers + orders), return_inverse=True)
+    objects = np.where(courier_bids, orders, num_orders + couriers)
+    span = float(np.ptp(excess)) + 1 if len(excess) else 1
+    unmatched_cost = span * (np.minimum(epoch_couriers, epoch_orders).max(initial=0) + 1)
+    order_epoch = order_table.epoch
+    node_epoch = np.where(nodes < num_couriers, courier_epoch[nodes.clip(max=num_couriers - 1)],
+                          order_epoch[(nodes - num_couriers).clip(min=0)])
+    assigned = auction(
+        *assignment_graph(len(nodes), num_orders + num_couriers, bidders, objects, excess, unmatched_cost),
+        object_groups=np.concatenate([order_epoch, courier_epoch, node_epoch]), eps=eps
+    )
+    # Candidate pair of each match (pairs are unique)
+    winners = np.flatnonzero(assigned < num_orders + num_couriers)
+    pair_keys = bidders * (num_orders + num_couriers) + objects
+    pairs = np.argsort(pair_keys)
+    pairs = pairs[np.searchsorted(pair_keys[pairs], winners * (num_orders + num_couriers) + assigned[winners])]
+    matched = couriers[pairs]
+
+    matched_order = np.full(num_couriers, -1, dtype=np.int64)
+    matched_order[matched] = orders[pairs] - order_table.offsets[courier_epoch[matched]]
+    matched_move_cell = solution.move_cell.copy()
+    matched_move_cell[matched] = move_cells[pairs]
+    matched_move_distance = solution.move_distance.copy()
+    matched_move_distance[matched] = move_distances[pairs]
+    found = solution.order >= 0
+    epoch_costs = np.bincount(
+        courier_epoch[found], weights=matched_move_distance[found].astype(np.float64), minlength=len(courier_table)
+    )
+    return matched_order, matched_move_cell, matched_move_distance, epoch_costs
+
+
+def solve_perfect_information(scenarios: list, jobs: int = 1):
+    """
+    Computes (and memoizes) the perfect-information solution of many scenarios at once.
+    :param scenarios: list of Scenario
+    :param jobs: number of worker processes
+    """
+    pending = [scenario for scenario in scenarios if not scenario.has_perfect_solution]
+    if jobs <= 1 or len(pending) <= 1:
+        for scenario in pending:
+            scenario.perfect_solution = perfect_information_solution(
+                scenario.order_table, scenario.courier_table, scenario.location_index
+            )
+        return
+    location_indexes = {id(scenario.location_index): scenario.location_index for scenario in pending}
+    for location_index in location_indexes.values():
+        location_index.share()
+    try:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            solutions = pool.map(
+                perfect_information_solution,
+                [scenario.order_table for scenario in pending],
+                [scenario.courier_table for scenario in pending],
+                [scenario.location_index for scenario in pending],
+            )
+            for scenario, solution in zip(pending, solutions):
+                scenario.perfect_solution = solution
+    finally:
+        for location_index in location_indexes.values():
+            location_index.release()
@@ -0,0 +1,241 @@
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import numpy as np
+from source.bounds import PerfectSolution
+from source.locations import LocationIndex
+from source.scenario import DEFAULT_DELIVERY_DURATION_SECONDS, Scenario, EpochTable
+
+CACHE_VERSION = 5
+DEFAULT_CACHE_DIR = '.cache/scenarios'
+HASH_CHUNK_BYTES = 1 << 20
+
+
+def file_hash(path: str):
+    """
+    Returns the sha256 hex digest of a file's content.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ScenarioCache:
+    """
+    On-disk cache of preprocessed scenarios.
+
+    Each entry is a folder named after a hash of the input file content, `minutes_bucket_size`,
+    `precision`, the delivery duration and whether scenarios share a dataset-wide location
+    index. It holds a `meta.json`, each distinct location index once (an `.npz` with its cells
+    plus a `.npy` distance matrix that is memory-mapped on load, so scenarios sharing a
+    dataset-wide index share it on load too) and, per scenario, an `.npz` with its cells,
+    epoch tables and perfect-information solution.
+    """
+
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR):
+        self.cache_dir = cache_dir
+
+    @staticmethod
+    def key(input_data_path: str, minutes_bucket_size: int, precision: int, global_locations: bool = False,
+            delivery_duration_seconds: int = DEFAULT_DELIVERY_DURATION_SECONDS):
+        content = json.dumps({
+            'version': CACHE_VERSION,
+            'data': file_hash(input_data_path),
+            'minutes_bucket_size': minutes_bucket_size,
+            'precision': precision,
+            'global_locations': global_locations,
+            'delivery_duration_seconds': delivery_duration_seconds,
+        }, sort_keys=True)
+        return hashlib.sha256(content.encode()).hexdigest()[:16]
+
+    def path(self, key: str):
+        return os.path.join(self.cache_dir, key)
+
+    def __contains__(self, key: str):
+        return os.path.exists(os.path.join(self.path(key), 'meta.json'))
+
+    def load(self, key: str, mmap: bool = True):
+        """
+        Loads the scenarios of an entry.
+        :param key: entry key
+        :param mmap: memory-map the distance matrices instead of reading them into memory
+        :return: dict {label: [Scenario]} or None if the entry does not exist
+        """
+        if key not in self:
+            return None
+        folder = self.path(key)
+        with open(os.path.join(folder, 'meta.json')) as f:
+            meta = json.load(f)
+        location_indexes = [
+            load_location_index(os.path.join(folder, file), mmap=mmap) for file in meta['location_indexes']
+        ]
+        scenarios = {}
+        for label, entries in meta['scenarios'].items():
+            scenarios[label] = [
+                load_scenario(os.path.join(folder, entry['file']), location_indexes) for entry in entries
+            ]
+        return scenarios
+
+    def store(self, key: str, scenarios: dict, **metadata):
+        """
+        Stores the scenarios of an entry, replacing it if it exists.
+        :param key: entry key
+        :param scenarios: dict {label: [Scenario]}
+        :param metadata: extra information saved in meta.json (e.g. input path)
+        """
+        folder = self.path(key)
+        tmp_folder = folder + '.tmp'
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+        os.makedirs(tmp_folder)
+        meta = {
+            'key': key, 'version': CACHE_VERSION, 'created': time.time(), **metadata,
+            'location_indexes': [], 'scenarios': {},
+        }
+        # Position in meta['location_indexes'] of each distinct location index
+        location_indexes = {}
+        for label, label_scenarios in scenarios.items():
+            meta['scenarios'][label] = []
+            for scenario in label_scenarios:
+                if id(scenario.location_index) not in location_indexes:
+                    location_indexes[id(scenario.location_index)] = len(meta['location_indexes'])
+                    file = f'location_index_{len(meta["location_indexes"])}'
+                    save_location_index(os.path.join(tmp_folder, file), scenario.location_index)
+                    meta['location_indexes'].append(file)
+                file = f'{label}_{scenario.index}'
+                save_scenario(os.path.join(tmp_folder, file), scenario, location_indexes[id(scenario.location_index)])
+                meta['scenarios'][label].append({'index': scenario.index, 'file': file})
+        with open(os.path.join(tmp_folder, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=2)
+        # Swap the entry in only once it is complete so readers never see a partial one
+        self.invalidate(key)
+        os.rename(tmp_folder, folder)
+
+    def get_or_build(self, key: str, build, **metadata):
+        """
+        Returns the cached scenarios of `key`, building and storing them with `build()` on a miss.
+        """
+        scenarios = self.load(key)
+        if scenarios is None:
+            scenarios = build()
+            self.store(key, scenarios, **metadata)
+        return scenarios
+
+    def invalidate(self, key: str = None):
+        """
+        Removes an entry, or every entry if no key is given.
+        """
+        if key is None:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+        else:
+            shutil.rmtree(self.path(key), ignore_errors=True)
+
+    def entries(self):
+        """
+        Returns the metadata of every entry, with its size on disk.
+        """
+        if not os.path.isdir(self.cache_dir):
+            return []
+        entries = []
+        for key in sorted(os.listdir(self.cache_dir)):
+            if key not in self:
+                continue
+            folder = self.path(key)
+            with open(os.path.join(folder, 'meta.json')) as f:
+                meta = json.load(f)
+            meta['num_scenarios'] = {label: len(v) for label, v in meta.pop('scenarios').items()}
+            meta['size_bytes'] = sum(
+                os.path.getsize(os.path.join(folder, file)) for file in os.listdir(folder)
+            )
+            entries.append(meta)
+        return entries
+
+
+def save_location_index(path: str, location_index: LocationIndex):
+    np.savez(
+        path + '.npz',
+        precision=location_index.precision,
+        lat_ix=location_index.lat_ix,
+        lng_ix=location_index.lng_ix,
+        is_data=location_index.is_data,
+    )
+    np.save(path + '_distances.npy', location_index.distances)
+
+
+def load_location_index(path: str, mmap: bool = True):
+    """
+    :param mmap: memory-map the distance matrix instead of reading it into memory
+    """
+    with np.load(path + '.npz') as arrays:
+        distances = np.load(path + '_distances.npy', mmap_mode='r' if mmap else None)
+        return LocationIndex(
+            arrays['lat_ix'], arrays['lng_ix'], int(arrays['precision']),
+            is_data=arrays['is_data'], distances=distances
+        )
+
+
+def save_scenario(path: str, scenario: Scenario, location_index: int):
+    """
+    :param location_index: position of the scenario's location index in the entry's `location_indexes`
+    """
+    np.savez(
+        path + '.npz',
+        index=scenario.index,
+        label=scenario.label,
+        minutes_bucket_size=scenario.minutes_bucket_size,
+        delivery_duration_seconds=scenario.delivery_duration_seconds,
+        precision=scenario.precision,
+        location_index=location_index,
+        cells=scenario.cells,
+        data_cells=scenario.data_cells,
+        orders=scenario.order_table.rows,
+        order_offsets=scenario.order_table.offsets,
+        couriers=scenario.courier_table.rows,
+        courier_offsets=scenario.courier_table.offsets,
+        **{f'perfect_{key}': value for key, value in scenario.perfect_solution.to_arrays().items()}
+    )
+
+
+def load_scenario(path: str, location_indexes: list):
+    with np.load(path + '.npz') as arrays:
+        return Scenario.from_components(
+            index=int(arrays['index']),
+            label=str(arrays['label']),
+            minutes_bucket_size=arrays['minutes_bucket_size'].item(),
+            precision=int(arrays['precision']),
+            location_index=location_indexes[int(arrays['location_index'])],
+            order_table=EpochTable(arrays['orders'], arrays['order_offsets']),
+            courier_table=EpochTable(arrays['couriers'], arrays['courier_offsets']),
+            perfect_solution=PerfectSolution.from_arrays({
+                key[len('perfect_'):]: arrays[key] for key in arrays.files if key.startswith('perfect_')
+            }),
+            cells=arrays['cells'],
+            data_cells=arrays['data_cells'],
+            delivery_duration_seconds=int(arrays['delivery_duration_seconds']),
+        )
+
+
+if __name__ == '__main__':
+    # Usage: python -m source.cache [list|clear [key]] [--dir cache_dir]
+    args = sys.argv[1:]
+    cache_dir = DEFAULT_CACHE_DIR
+    if '--dir' in args:
+        cache_dir = args[args.index('--dir') + 1]
+        args = args[:args.index('--dir')] + args[args.index('--dir') + 2:]
+    command = args[0] if args else 'list'
+    cache = ScenarioCache(cache_dir)
+    if command == 'list':
+        for entry in cache.entries():
+            print(
+                f"{entry['key']} - {entry.get('input_data_path', '?')} - "
+                f"bucket: {entry.get('minutes_bucket_size', '?')}min - precision: {entry.get('precision', '?')} - "
+                f"scenarios: {entry['num_scenarios']} - {entry['size_bytes'] / 2 ** 20:.1f} MB"
+            )
+    elif command == 'clear':
+        cache.invalidate(args[1] if len(args) > 1 else None)
+    else:
+        raise ValueError('Unknown command: {}'.format(command))
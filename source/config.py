@@ -0,0 +1,122 @@
+"""
+Configuration of the experiment runner (python -m source) and of the tools that build the same
+scenarios and policies (source.sweep, source.training, source.rescore).
+"""
+from source.bounds import solve_perfect_information
+from source.cache import ScenarioCache
+from source.profiling import get_profiler
+from source.scenario import DEFAULT_DELIVERY_DURATION_SECONDS, Scenario, build_location_index
+from source.utils import iter_daily_data, scan_data, split_dates
+from source.policies.last_nearest_order import LastNearestOrder
+from source.policies.do_nothing import DoNothing
+from source.policies.vfa import VFA
+from source.policies.hierarchical_vfa import HierarchicalVFA
+
+INSTANCE_NAME = 'robotex5'
+PARAMS = {
+    'instance_name': INSTANCE_NAME,
+    'input_data_path': f"./data/{INSTANCE_NAME}.csv",
+    'policies': ['do_nothing', 'vfa', 'last_nearest_order'],
+    'minutes_bucket_size': 10,
+    'precision': 2,
+    # Time from an order's start until its courier is available again
+    'delivery_duration_seconds': DEFAULT_DELIVERY_DURATION_SECONDS,
+    # Scenarios share one location index built from all days instead of one per day
+    'global_locations': True,
+    'order_index': 'grid',
+    'bounded_search': False,
+    # Nearest-order samples of VFA: 'index' (exact, order index) or 'transform' (grid distance transform)
+    'nearest_field': 'index',
+    'action_details': True,
+    'train': True,
+    'export_policy_details': True,
+    'verbose': False,
+    # Preprocessed scenarios are cached on disk (None disables the cache)
+    'cache_dir': '.cache/scenarios',
+    # Worker processes for (policy, scenario) evaluation (--jobs)
+    'jobs': 1,
+    # Evaluate stateful policies' test scenarios in parallel once trained (--parallel-stateful)
+    'parallel_stateful': False,
+    # Folder for the per-epoch profiling trace and stage memory peaks (--profile); None disables profiling
+    'profile': None,
+    # Folder where trained stateful policies are saved (--save-checkpoints) or loaded from (--from-checkpoints)
+    'save_checkpoints': None,
+    'from_checkpoints': None,
+    # Stream per-epoch decisions and costs to logs/<instance>/<policy>/actions ('jsonl', 'csv' or None)
+    'export_actions': None,
+    # Save per-scenario action traces to logs/<instance>/<policy>/traces for source.rescore (--export-traces)
+    'export_traces': False,
+    # Do not keep per-epoch decisions in memory (--summary-only)
+    'summary_only': False,
+    # Simulate all scenarios of a split in lockstep with source.batch (--batch)
+    'batch': False,
+    # Simulation loop of Policy.train: 'epochs' (every epoch) or 'events' (only epochs with orders or couriers)
+    'simulator': 'epochs',
+}
+
+
+def get_policy(name):
+    if name == 'last_nearest_order':
+        return LastNearestOrder
+    elif name == 'do_nothing':
+        return DoNothing
+    elif name == 'vfa':
+        return VFA
+    elif name == 'hvfa':
+        return HierarchicalVFA
+    else:
+        raise ValueError('Unknown policy: {}'.format(name))
+
+
+def build_scenarios(profiler=None, jobs: int = 1):
+    """
+    Builds the train and test scenarios of PARAMS['input_data_path'].
+    :param jobs: worker processes for the perfect-information solutions
+    """
+    # Days are streamed from the input file so only about one day of raw data is in memory
+    summary = scan_data(PARAMS['input_data_path'])
+    _, test_dates = split_dates(summary['rows_per_date'].index)
+    test_dates = set(test_dates)
+    profiler = get_profiler(profiler)
+    location_index = None
+    if PARAMS['global_locations']:
+        with profiler.stage('locations'):
+            location_index = build_location_index(
+                iter_daily_data(PARAMS['input_data_path'], summary=summary), PARAMS['precision']
+            )
+        if profiler.enabled:
+            with profiler.stage('distances'):
+                location_index.get_distances()
+    scenarios = {'train': [], 'test': []}
+    for date, day in iter_daily_data(PARAMS['input_data_path'], summary=summary):
+        label = 'test' if date in test_dates else 'train'
+        scenarios[label].append(Scenario(
+            len(scenarios[label]), label, day, PARAMS['minutes_bucket_size'], precision=PARAMS['precision'],
+            profiler=profiler, location_index=location_index,
+            delivery_duration_seconds=PARAMS['delivery_duration_seconds']
+        ))
+    with profiler.stage('perfect_solution'):
+        solve_perfect_information(scenarios['train'] + scenarios['test'], jobs=jobs)
+    return scenarios
+
+
+def load_scenarios(profiler=None, jobs: int = 1):
+    """
+    Returns the scenarios of PARAMS, from the cache when enabled (built with build_scenarios otherwise).
+    :param jobs: worker processes for the perfect-information solutions of scenarios that are built
+    """
+    if PARAMS['cache_dir'] is None:
+        return build_scenarios(profiler, jobs)
+    cache = ScenarioCache(PARAMS['cache_dir'])
+    key = cache.key(
+        PARAMS['input_data_path'], PARAMS['minutes_bucket_size'], PARAMS['precision'], PARAMS['global_locations'],
+        PARAMS['delivery_duration_seconds']
+    )
+    return cache.get_or_build(
+        key, lambda: build_scenarios(profiler, jobs),
+        input_data_path=PARAMS['input_data_path'],
+        minutes_bucket_size=PARAMS['minutes_bucket_size'],
+        precision=PARAMS['precision'],
+        global_locations=PARAMS['global_locations'],
+        delivery_duration_seconds=PARAMS['delivery_duration_seconds'],
+    )
@@ -0,0 +1,117 @@
+"""
+Simulation loops of Policy.train.
+
+* epochs: one iteration per epoch of the day, whether or not anything happens in it.
+* events: a discrete-event loop over a priority queue of order and courier-availability
+  events, one per non-empty epoch, that only does work when something happens. Epochs
+  without couriers cost nothing and need no decision, and the orders of an epoch only
+  matter to the decision of the next courier event, so both are skipped. Costs are the
+  same as the epoch loop's at the same bucket size, which makes fine buckets (1 minute,
+  30 seconds) affordable: the work grows with the number of busy epochs, not of epochs.
+
+Both loops yield (epoch, cost, per-courier evaluation, actions) for every epoch they simulate.
+"""
+import heapq
+import numpy as np
+from source.scenario import get_bucket_seconds
+from source.state import State
+from source.utils import is_empty
+
+SIMULATORS = ['epochs', 'events']
+# Event kinds, in processing order when two events have the same time
+ORDERS_REVEALED = 0
+COURIERS_AVAILABLE = 1
+
+
+class EventQueue:
+    """
+    Priority queue of (time in seconds, kind, epoch) events, popped by time then kind.
+    The orders of epoch t are revealed at its end, (t + 1) * bucket seconds, before the
+    couriers of epoch t + 1 become available at that same time.
+    """
+
+    def __init__(self, events: list = ()):
+        self._heap = list(events)
+        heapq.heapify(self._heap)
+
+    @classmethod
+    def from_scenario(cls, scenario):
+        bucket_seconds = get_bucket_seconds(scenario.minutes_bucket_size)
+        order_epochs = np.flatnonzero(np.diff(scenario.order_table.offsets))
+        courier_epochs = np.flatnonzero(np.diff(scenario.courier_table.offsets))
+        return cls(
+            [((epoch + 1) * bucket_seconds, ORDERS_REVEALED, epoch) for epoch in order_epochs.tolist()]
+            + [(epoch * bucket_seconds, COURIERS_AVAILABLE, epoch) for epoch in courier_epochs.tolist()]
+        )
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, time_seconds: int, kind: int, epoch: int):
+        heapq.heappush(self._heap, (time_seconds, kind, epoch))
+
+    def pop(self):
+        return heapq.heappop(self._heap)
+
+
+def simulate_epochs(policy, state: State, details: bool = True):
+    """
+    Runs the policy over every epoch of the state's scenario, starting at the state's epoch.
+    """
+    profiler = policy.profiler
+    for epoch in range(state.epoch, state.scenario.epochs):
+        profiler.start_epoch(policy.name, state.scenario, epoch, state.orders, state.couriers)
+        with profiler.phase('take_action'):
+            actions = policy.take_action(state) if not is_empty(state.couriers) else None
+        with profiler.phase('update'):
+            cost, action_evaluation, state = state.step(actions, details=details)
+        yield epoch, cost, action_evaluation, actions
+
+
+def simulate_events(policy, state: State, details: bool = True, queue: EventQueue = None):
+    """
+    Runs the policy over the events of the state's scenario (EventQueue.from_scenario by default).
+    A courier event moves the state to its epoch and asks the policy for actions, which are
+    scored once the orders of that epoch are revealed (or the next courier event comes first,
+    when the epoch has no orders).
+    """
+    profiler = policy.profiler
+    queue = EventQueue.from_scenario(state.scenario) if queue is None else queue
+    pending = None
+
+    def score():
+        with profiler.phase('update'):
+            cost, action_evaluation, next_state = state.step(pending, details=details)
+        return cost, action_evaluation, next_state
+
+    while len(queue):
+        _, kind, epoch = queue.pop()
+        if epoch < state.epoch:
+            continue
+        if kind == ORDERS_REVEALED:
+            if pending is not None and epoch == state.epoch:
+                cost, action_evaluation, next_state = score()
+                yield state.epoch, cost, action_evaluation, pending
+                state, pending = next_state, None
+            continue
+        if pending is not None:
+            # The previous decision's epoch had no orders
+            cost, action_evaluation, next_state = score()
+            yield state.epoch, cost, action_evaluation, pending
+            state, pending = next_state, None
+        state = state.jump(epoch)
+        profiler.start_epoch(policy.name, state.scenario, epoch, state.orders, state.couriers)
+        with profiler.phase('take_action'):
+            pending = policy.take_action(state)
+    if pending is not None:
+        cost, action_evaluation, _ = score()
+        yield state.epoch, cost, action_evaluation, pending
+
+
+def get_simulator(name: str):
+    if name == 'epochs':
+        return simulate_epochs
+    elif name == 'events':
+        return simulate_events
+    else:
+        raise ValueError('Unknown simulator: {}'.format(name))
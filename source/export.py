@@ -0,0 +1,94 @@
+import os
+import csv
+import gzip
+import json
+
+EXPORT_FORMATS = ['jsonl', 'csv']
+EXPORT_BATCH_EPOCHS = 64
+DECISION_FIELDS = [
+    'order_id', 'distance', 'courier_lat', 'courier_lng', 'action_lat', 'action_lng', 'order_lat', 'order_lng'
+]
+CSV_FIELDS = ['epoch', 'cost', 'courier'] + DECISION_FIELDS
+
+
+class ActionExporter:
+    """
+    Streams the per-epoch cost and decisions (State.evaluate_cost_function details) of a
+    scenario to a gzip file as they are produced, so that nothing is kept in memory.
+
+    Formats:
+    * jsonl: one line per epoch {"epoch", "cost", "decisions": [{"courier", ...}]}.
+    * csv: one row per (epoch, courier) with the epoch cost; epochs without decisions get a
+      row with empty courier fields so that the cost series is complete.
+    Records are buffered and written `batch_epochs` epochs at a time.
+    """
+
+    def __init__(self, path: str, fmt: str = 'jsonl', batch_epochs: int = EXPORT_BATCH_EPOCHS):
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError('Unknown export format: {}'.format(fmt))
+        self.path = path
+        self.fmt = fmt
+        self.batch_epochs = batch_epochs
+        self._buffer = []
+        self._buffered_epochs = 0
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._file = gzip.open(path, 'wt', newline='')
+        if fmt == 'csv':
+            self._csv = csv.writer(self._file, lineterminator='\n')
+            self._csv.writerow(CSV_FIELDS)
+
+    @staticmethod
+    def file_name(fname: str, fmt: str):
+        return f'{fname}.{fmt}.gz'
+
+    def write(self, epoch: int, cost: float, decisions: dict):
+        """
+        Adds an epoch to the buffer, writing the buffer out once it holds `batch_epochs` epochs.
+        :param epoch: epoch
+        :param cost: epoch cost
+        :param decisions: dict {courier_id: {DECISION_FIELDS}} (may be empty)
+        """
+        if self.fmt == 'jsonl':
+            self._buffer.append(json.dumps({
+                'epoch': epoch,
+                'cost': cost,
+                'decisions': [{'courier': courier, **decision} for courier, decision in decisions.items()],
+            }))
+        elif decisions:
+            self._buffer.extend(
+                [epoch, cost, courier, *(decision[field] for field in DECISION_FIELDS)]
+                for courier, decision in decisions.items()
+            )
+        else:
+            self._buffer.append([epoch, cost] + [None] * (len(CSV_FIELDS) - 2))
+        self._buffered_epochs += 1
+        if self._buffered_epochs >= self.batch_epochs:
+            self.flush()
+
+    def flush(self):
+        if self.fmt == 'jsonl':
+            if self._buffer:
+                self._file.write('\n'.join(self._buffer) + '\n')
+        else:
+            self._csv.writerows(self._buffer)
+        self._buffer = []
+        self._buffered_epochs = 0
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_actions(path: str):
+    """
+    Iterates over the epoch records of a jsonl export.
+    """
+    with gzip.open(path, 'rt') as f:
+        for line in f:
+            yield json.loads(line)
@@ -0,0 +1,291 @@
+from collections.abc import Mapping
+
+import numpy as np
+
+from source.shared import SharedArray
+from source.utils import haversine_distance
+
+# Same ordering as `get_location_neighbours` so ties resolve to the same move
+NEIGHBOUR_MOVES = [(i, j) for i in [0, -1, 1] for j in [0, -1, 1]]
+DISTANCE_DTYPE = np.float32
+DISTANCE_CHUNK_ROWS = 1024
+
+
+class LocationIndex:
+    """
+    Integer index over the grid cells (lat, lng rounded to `precision`) of a scenario.
+
+    Cells are identified by a contiguous integer id. Coordinates, neighbours and
+    pairwise distances are stored as dense NumPy arrays indexed by that id:
+    * coords: float64 array (n, 2) with the (lat, lng) of every cell.
+    * neighbours: int32 array (n, 9) with the ids of the reachable cells (-1 if unknown).
+    * distances: float32 array (n, n) with the haversine distance (km) between cells.
+    """
+
+    def __init__(self, lat_ix: np.ndarray, lng_ix: np.ndarray, precision: int, is_data: np.ndarray = None,
+                 distances: np.ndarray = None):
+        self.precision = precision
+        self.scale = 10 ** precision
+        self.lat_ix = np.asarray(lat_ix, dtype=np.int64)
+        self.lng_ix = np.asarray(lng_ix, dtype=np.int64)
+        self.keys = self.cell_keys(self.lat_ix, self.lng_ix)
+        if np.any(np.diff(self.keys) <= 0):
+            raise ValueError('Cells must be unique and sorted by key')
+        self.coords = np.column_stack([self.lat_ix / self.scale, self.lng_ix / self.scale])
+        self.is_data = np.ones(len(self), dtype=bool) if is_data is None else np.asarray(is_data, dtype=bool)
+        self.neighbours = self.get_neighbours()
+        self._distances = distances
+        self._shared_distances = None
+
+    @classmethod
+    def from_coordinates(cls, lats, lngs, precision: int):
+        """
+        Builds the index of the cells covering the given coordinates plus their neighbours.
+        :param lats: latitudes of the observed locations
+        :param lngs: longitudes of the observed locations
+        :param precision: The precision of the location coordinates.
+        :return: LocationIndex
+        """
+        keys, data_keys = cls.covering_keys(lats, lngs, precision)
+        lat_ix, lng_ix = keys >> 32, (keys & 0xFFFFFFFF) - (1 << 31)
+        return cls(lat_ix=lat_ix, lng_ix=lng_ix, precision=precision, is_data=np.isin(keys, data_keys))
+
+    @classmethod
+    def covering_keys(cls, lats, lngs, precision: int):
+        """
+        Returns the sorted keys of the cells covering the given coordinates plus their neighbours,
+        and the sorted keys of the covering cells alone.
+        """
+        scale = 10 ** precision
+        data_lat_ix = np.rint(np.asarray(lats, dtype=float) * scale).astype(np.int64)
+        data_lng_ix = np.rint(np.asarray(lngs, dtype=float) * scale).astype(np.int64)
+        moves = np.array(NEIGHBOUR_MOVES, dtype=np.int64)
+        keys = cls.cell_keys(data_lat_ix[:, None] + moves[:, 0], data_lng_ix[:, None] + moves[:, 1])
+        return np.unique(keys), np.unique(keys[:, 0])
+
+    @classmethod
+    def from_locations(cls, locations: list, precision: int):
+        """
+        Builds the index from a list of location records [{'lat': ..., 'lng': ...}].
+        """
+        return cls.from_coordinates(
+            [loc['lat'] for loc in locations], [loc['lng'] for loc in locations], precision
+        )
+
+    @classmethod
+    def union(cls, indexes: list):
+        """
+        Builds the index of the cells of several indexes (a cell is a data cell if it is one in any of them).
+        :param indexes: list of LocationIndex with the same precision
+        :return: LocationIndex
+        """
+        precisions = {index.precision for index in indexes}
+        if len(precisions) != 1:
+            raise ValueError('Cannot merge location indexes with precisions {}'.format(sorted(precisions)))
+        keys, first = np.unique(np.concatenate([index.keys for index in indexes]), return_index=True)
+        data_keys = np.concatenate([index.keys[index.is_data] for index in indexes])
+        return cls(
+            lat_ix=np.concatenate([index.lat_ix for index in indexes])[first],
+            lng_ix=np.concatenate([index.lng_ix for index in indexes])[first],
+            precision=precisions.pop(),
+            is_data=np.isin(keys, data_keys),
+        )
+
+    @staticmethod
+    def cell_keys(lat_ix, lng_ix):
+        """
+        Encodes integer grid coordinates as a single sortable int64 key.
+        """
+        return (np.asarray(lat_ix, dtype=np.int64) << 32) + (np.asarray(lng_ix, dtype=np.int64) + (1 << 31))
+
+    @staticmethod
+    def key_coordinates(keys, precision: int):
+        """
+        Decodes cell keys back to (lat, lng) arrays.
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        scale = 10 ** precision
+        return (keys >> 32) / scale, ((keys & 0xFFFFFFFF) - (1 << 31)) / scale
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, lats, lngs):
+        """
+        Returns the cell id of each coordinate (-1 if the cell is not indexed).
+        :param lats: array-like of latitudes
+        :param lngs: array-like of longitudes
+        :return: int64 array of cell ids
+        """
+        return self.lookup_keys(self.cell_keys(
+            np.rint(np.asarray(lats, dtype=float) * self.scale),
+            np.rint(np.asarray(lngs, dtype=float) * self.scale)
+        ))
+
+    def lookup_keys(self, keys):
+        """
+        Returns the cell id of each cell key (-1 if the cell is not indexed).
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        ix = np.searchsorted(self.keys, keys).clip(max=len(self) - 1)
+        return np.where(self.keys[ix] == keys, ix, -1)
+
+    def index_of(self, lat, lng):
+        ix = int(self.lookup([lat], [lng])[0])
+        if ix < 0:
+            raise KeyError((lat, lng))
+        return ix
+
+    def location(self, ix):
+        return tuple(self.coords[ix].tolist())
+
+    def region(self, lats, lngs):
+        """
+        Returns the cells `from_coordinates` would index for the given coordinates, as ids of this
+        index (e.g. the cells of one day in a dataset-wide index).
+        :return: tuple (sorted cell ids, sorted ids of the cells covering the coordinates)
+        """
+        keys, data_keys = self.covering_keys(lats, lngs, self.precision)
+        cells, data_cells = self.lookup_keys(keys), self.lookup_keys(data_keys)
+        if np.any(cells < 0):
+            raise ValueError('{} cells are not in the location index'.format(int(np.sum(cells < 0))))
+        return cells, data_cells
+
+    def records(self, data_only: bool = False, cells=None):
+        if cells is None:
+            cells = np.flatnonzero(self.is_data) if data_only else np.arange(len(self))
+        return [
+            {'lat': lat, 'lng': lng, 'cell': cell}
+            for cell, (lat, lng) in zip(cells.tolist(), self.coords[cells].tolist())
+        ]
+
+    def get_neighbours(self):
+        moves = np.array(NEIGHBOUR_MOVES, dtype=np.int64)
+        keys = self.cell_keys(self.lat_ix[:, None] + moves[:, 0], self.lng_ix[:, None] + moves[:, 1])
+        ix = np.searchsorted(self.keys, keys).clip(max=len(self) - 1)
+        return np.where(self.keys[ix] == keys, ix, -1).astype(np.int32)
+
+    @property
+    def distances(self):
+        if self._distances is None:
+            self._distances = self.get_distances()
+        return self._distances
+
+    def get_distances(self):
+        """
+        Returns the dense matrix of haversine distances between all cells.
+        Rows are computed in chunks to bound the float64 intermediates.
+        :return: float32 array (n, n)
+        """
+        n = len(self)
+        distances = np.empty((n, n), dtype=DISTANCE_DTYPE)
+        lat, lng = self.coords[:, 0], self.coords[:, 1]
+        for start in range(0, n, DISTANCE_CHUNK_ROWS):
+            end = min(start + DISTANCE_CHUNK_ROWS, n)
+            distances[start:end] = haversine_distance(
+                lat[start:end, None], lng[start:end, None], lat[None, :], lng[None, :]
+            )
+        return distances
+
+    def share(self):
+        """
+        Moves the distance matrix to shared memory so that pickling the index for worker
+        processes sends a handle instead of the matrix. Call `release` when workers are done.
+        """
+        if self._shared_distances is None:
+            self._shared_distances = SharedArray(self.distances)
+            self._distances = self._shared_distances.array
+        return self
+
+    def release(self):
+        if self._shared_distances is not None:
+            self._distances = np.array(self._distances)
+            self._shared_distances.unlink()
+            self._shared_distances = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self._shared_distances is not None:
+            state['_distances'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._shared_distances is not None:
+            self._distances = self._shared_distances.array
+
+    @property
+    def distance_map(self):
+        return DistanceMapView(self)
+
+    @property
+    def neighbours_map(self):
+        return NeighboursMapView(self)
+
+
+class _CellMapping(Mapping):
+    """
+    Read-only mapping keyed by (lat, lng) tuples, backed by a LocationIndex.
+    """
+
+    def __init__(self, index: LocationIndex, cells: np.ndarray):
+        self._index = index
+        self._cells = cells
+
+    def _cell(self, location):
+        ix = self._index.lookup([location[0]], [location[1]])[0]
+        if ix < 0 or not self._contains_cell(ix):
+            raise KeyError(location)
+        return ix
+
+    def _contains_cell(self, ix):
+        return True
+
+    def __iter__(self):
+        return (self._index.location(ix) for ix in self._cells)
+
+    def __len__(self):
+        return len(self._cells)
+
+    def __contains__(self, location):
+        try:
+            self._cell(location)
+        except (KeyError, TypeError, IndexError):
+            return False
+        return True
+
+
+class DistanceMapView(_CellMapping):
+    """
+    Backward compatible {source: {destination: distance}} view of the distance matrix.
+    """
+
+    def __init__(self, index: LocationIndex):
+        super().__init__(index, np.arange(len(index)))
+
+    def __getitem__(self, location):
+        return DistanceRowView(self._index, self._cell(location))
+
+
+class DistanceRowView(_CellMapping):
+    def __init__(self, index: LocationIndex, source: int):
+        super().__init__(index, np.arange(len(index)))
+        self._source = source
+
+    def __getitem__(self, location):
+        return float(self._index.distances[self._source, self._cell(location)])
+
+
+class NeighboursMapView(_CellMapping):
+    """
+    Backward compatible {source: [destinations]} view of the neighbours array (data cells only).
+    """
+
+    def __init__(self, index: LocationIndex):
+        super().__init__(index, np.flatnonzero(index.is_data))
+
+    def _contains_cell(self, ix):
+        return bool(self._index.is_data[ix])
+
+    def __getitem__(self, location):
+        return [self._index.location(ix) for ix in self._index.neighbours[self._cell(location)]]
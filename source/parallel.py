@@ -0,0 +1,102 @@
+from concurrent.futures import ProcessPoolExecutor
+from source.policies.policy import Policy
+
+SPLITS = ['train', 'test']
+
+
+def performance_row(policy_name: str, scenario, solution: dict):
+    return (policy_name, scenario.label, solution['cost'], scenario.perfect_cost,
+            solution['gap'], solution['execution_secs'], scenario.matched_reference_cost)
+
+
+def evaluate_scenarios(policy: Policy, policy_name: str, scenarios: list):
+    """
+    Runs a policy over scenarios one after another (the policy keeps learning between them).
+    :return: tuple (performance rows, policy after the last scenario)
+    """
+    rows = [performance_row(policy_name, scenario, policy.train(scenario)) for scenario in scenarios]
+    return rows, policy
+
+
+def evaluate_splits(policy: Policy, policy_name: str, scenarios: dict, checkpoint: str = None):
+    """
+    Runs a policy over the scenarios of every split in SPLITS order.
+    :param scenarios: dict {split: [Scenario]}
+    :param checkpoint: if given, the policy is saved there once the train scenarios are done
+    :return: tuple (performance rows, policy after the last scenario)
+    """
+    rows = []
+    for split in SPLITS:
+        split_rows, policy = evaluate_scenarios(policy, policy_name, scenarios.get(split, []))
+        rows += split_rows
+        if split == 'train' and checkpoint is not None:
+            policy.save(checkpoint)
+    return rows, policy
+
+
+def run_parallel(policies: dict, scenarios: dict, jobs: int, parallel_stateful: bool = False,
+                 checkpoints: dict = None):
+    """
+    Evaluates (policy, scenario) pairs across `jobs` worker processes.
+
+    Stateless policies get one task per scenario. Stateful policies (e.g. VFA) run all their
+    scenarios sequentially in a single task, unless `parallel_stateful`, in which case only
+    training is sequential and test scenarios are evaluated in parallel from the trained policy.
+    Distance matrices are moved to shared memory so that tasks do not copy them.
+    Profiling records made in the workers are added to each policy's profiler.
+    :param policies: dict {policy name: Policy}, in output order
+    :param scenarios: dict {split: [Scenario]} with split in SPLITS
+    :param jobs: number of worker processes
+    :param parallel_stateful: evaluate stateful policies' test scenarios in parallel
+    :param checkpoints: dict {policy name: folder} where stateful policies are saved after training
+    :return: list of performance rows in the same order as the sequential runner
+    """
+    location_indexes = {
+        id(scenario.location_index): scenario.location_index
+        for split in SPLITS for scenario in scenarios[split]
+    }
+    for location_index in location_indexes.values():
+        location_index.share()
+    # Per task: the profiler returned with the policy and how many of its epoch records it was submitted with
+    results, traces, offsets = {}, {}, {}
+    checkpoints = checkpoints or {}
+    try:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures, trainings = {}, {}
+            for policy_ix, (policy_name, policy) in enumerate(policies.items()):
+                if policy.stateless:
+                    for split_ix, split in enumerate(SPLITS):
+                        for scenario_ix, scenario in enumerate(scenarios[split]):
+                            futures[(policy_ix, split_ix, scenario_ix)] = pool.submit(
+                                evaluate_scenarios, policy, policy_name, [scenario]
+                            )
+                elif parallel_stateful:
+                    trainings[policy_ix] = pool.submit(
+                        evaluate_splits, policy, policy_name, {'train': scenarios['train']},
+                        checkpoints.get(policy_name)
+                    )
+                else:
+                    futures[(policy_ix, 0, 0)] = pool.submit(
+                        evaluate_splits, policy, policy_name, scenarios, checkpoints.get(policy_name)
+                    )
+            for policy_ix, training in trainings.items():
+                rows, trained_policy = training.result()
+                results[(policy_ix, 0, 0)] = rows
+                traces[(policy_ix, 0, 0)] = trained_policy.profiler
+                policy_name = list(policies)[policy_ix]
+                for scenario_ix, scenario in enumerate(scenarios['test']):
+                    futures[(policy_ix, 1, scenario_ix)] = pool.submit(
+                        evaluate_scenarios, trained_policy, policy_name, [scenario]
+                    )
+                    offsets[(policy_ix, 1, scenario_ix)] = len(trained_policy.profiler.epochs)
+            for key, future in futures.items():
+                results[key], task_policy = future.result()
+                traces[key] = task_policy.profiler
+    finally:
+        for location_index in location_indexes.values():
+            location_index.release()
+    for key in sorted(traces):
+        profiler = list(policies.values())[key[0]].profiler
+        if profiler.enabled:
+            profiler.epochs.extend(traces[key].epochs[offsets.get(key, 0):])
+    return [row for key in sorted(results) for row in results[key]]
@@ -0,0 +1,113 @@
+"""
+Parallel training of VFA across worker processes.
+
+A pass over the train scenarios is split across `jobs` worker processes, worker w running
+scenarios w, w + jobs, w + 2 * jobs, ... in order, in one of two modes:
+* hogwild: workers update the value table in shared memory (VFA.share) directly and without
+  locks. Estimates are never stale, but concurrent updates of an entry can overwrite each other
+  and the outcome depends on timing, so runs are not reproducible.
+* merge: in rounds of `sync_every` scenarios per worker, workers train private copies of the
+  table from the same snapshot and the parent merges their changes: every changed entry takes the
+  mean of the values of the workers that changed it. Workers do not see each other's updates for
+  up to `sync_every` scenarios, but the outcome only depends on the scenarios, `jobs` and `sync_every`.
+"""
+import io
+from contextlib import contextmanager, redirect_stdout
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+MODES = ['hogwild', 'merge']
+DEFAULT_SYNC_EVERY = 1
+
+
+def partition(scenarios: list, jobs: int):
+    """
+    Returns the scenarios of each worker (round-robin, keeping their order).
+    """
+    return [scenarios[worker::jobs] for worker in range(jobs)]
+
+
+def train_scenarios(policy, scenarios: list):
+    """
+    Trains the policy over the scenarios one after another.
+    :return: total cost
+    """
+    with redirect_stdout(io.StringIO()):
+        return sum(policy.train(scenario)['cost'] for scenario in scenarios)
+
+
+def train_private(policy, scenarios: list):
+    """
+    Trains a private copy of the policy's (shared) value table over the scenarios.
+    :return: tuple (total cost, flat positions of the changed entries, their values, their visited flags)
+    """
+    V, visited = policy.V, policy.visited
+    policy.V, policy.visited = V.copy(), visited.copy()
+    cost = train_scenarios(policy, scenarios)
+    changed = np.flatnonzero((policy.V != V) | (policy.visited != visited))
+    return cost, changed, policy.V.ravel()[changed], policy.visited.ravel()[changed]
+
+
+def merge_changes(policy, results: list):
+    """
+    Sets every entry changed by the workers (results of train_private, in worker order) to the mean
+    of their values for it.
+    """
+    if not results:
+        return
+    changed = np.concatenate([result[1] for result in results])
+    values = np.concatenate([result[2] for result in results])
+    visited = np.concatenate([result[3] for result in results])
+    entries, inverse = np.unique(changed, return_inverse=True)
+    means = np.bincount(inverse, weights=values) / np.bincount(inverse)
+    policy.V.reshape(-1)[entries] = means
+    policy.visited.reshape(-1)[changed[visited]] = True
+
+
+@contextmanager
+def shared_training(policy, scenarios: list, jobs: int):
+    """
+    Moves the scenarios' distance matrices and the policy's value table to shared memory and yields
+    a pool of `jobs` worker processes, releasing the shared memory on exit.
+    """
+    location_indexes = list({id(scenario.location_index): scenario.location_index for scenario in scenarios}.values())
+    for location_index in location_indexes:
+        location_index.share()
+    try:
+        policy.share(location_indexes)
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            yield pool
+    finally:
+        policy.release()
+        for location_index in location_indexes:
+            location_index.release()
+
+
+def run_parallel_pass(policy, scenarios: list, pool: ProcessPoolExecutor, jobs: int, mode: str = 'hogwild',
+                      sync_every: int = DEFAULT_SYNC_EVERY):
+    """
+    Runs one training pass over the scenarios across the workers of `pool` (see shared_training).
+    :param policy: VFA with a shared value table
+    :param scenarios: train scenarios
+    :param pool: worker processes
+    :param jobs: number of workers to split the scenarios across
+    :param mode: 'hogwild' or 'merge' (see MODES)
+    :param sync_every: scenarios per worker between merges ('merge' mode)
+    :return: total cost
+    """
+    if mode not in MODES:
+        raise ValueError('Unknown parallel training mode: {}'.format(mode))
+    parts = [part for part in partition(scenarios, jobs) if part]
+    if mode == 'hogwild':
+        futures = [pool.submit(train_scenarios, policy, part) for part in parts]
+        return sum(future.result() for future in futures)
+    cost = 0
+    for start in range(0, max(len(part) for part in parts), sync_every):
+        futures = [
+            pool.submit(train_private, policy, part[start:start + sync_every])
+            for part in parts if part[start:start + sync_every]
+        ]
+        results = [future.result() for future in futures]
+        merge_changes(policy, results)
+        cost += sum(result[0] for result in results)
+    return cost
@@ -10,6 +10,8 @@ POLICY_NAME = 'DoNothing'
 
 
 class DoNothing(Policy):
+    stateless = True
+
     def __init__(self, **kwargs):
         super(DoNothing, self).__init__(
             name=POLICY_NAME,
@@ -19,6 +21,9 @@ class DoNothing(Policy):
     def take_action(self, state: State):
         couriers = state.couriers
         return {
-            ix: {'lat': courier['lat'], 'lng': courier['lng']}
+            ix: {'lat': courier['lat'], 'lng': courier['lng'], 'cell': courier['cell']}
             for ix, courier in enumerate(couriers)
         }
+
+    def take_action_batch(self, state):
+        return state.courier_cells.copy()
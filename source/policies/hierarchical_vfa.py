@@ -0,0 +1,247 @@
+import numpy as np
+from source.locations import LocationIndex
+from source.state import State
+from source.policies.vfa import VFA, CHECKPOINT_PARAMS
+from source.utils import is_empty
+
+POLICY_NAME = 'HierarchicalVFA'
+DEFAULT_LEVELS = 3
+SAMPLE_CELLS = ['data', 'all']
+# Prior variance (km^2) of a sampled value, so that a level with a single sample does not take all the weight
+PRIOR_VARIANCE = 1.0
+
+
+class ValueLevel:
+    """
+    Value estimates at one grid precision, as dense `epochs x cells` arrays whose columns
+    are identified by their cell key at that precision (see LocationIndex.cell_keys):
+    * V: smoothed value estimate.
+    * variance: smoothed squared deviation of the samples from the estimate.
+    * counts: number of updates.
+    """
+
+    def __init__(self, precision: int, num_epochs: int):
+        self.precision = precision
+        self.column_keys = np.empty(0, dtype=np.int64)
+        self.V = np.zeros((num_epochs, 0))
+        self.variance = np.zeros((num_epochs, 0))
+        self.counts = np.zeros((num_epochs, 0), dtype=np.int32)
+        self._sorted = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_sorted'] = None
+        return state
+
+    def keys(self, location_index: LocationIndex):
+        """
+        Returns the key, at this level's precision, of the cell containing each cell of a location index.
+        Halves round up (not to even), so that every coarse cell covers the same number of fine cells.
+        """
+        factor = 10 ** (location_index.precision - self.precision)
+        return LocationIndex.cell_keys(
+            np.floor(location_index.lat_ix / factor + 0.5), np.floor(location_index.lng_ix / factor + 0.5)
+        )
+
+    def columns(self, keys, add: bool = False):
+        """
+        Returns the column of each key, -1 for unseen keys unless `add`, which appends their columns.
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        if self._sorted is None:
+            order = np.argsort(self.column_keys)
+            self._sorted = (order, self.column_keys[order])
+        order, sorted_keys = self._sorted
+        if len(sorted_keys):
+            position = np.searchsorted(sorted_keys, keys).clip(max=len(sorted_keys) - 1)
+            columns = np.where(sorted_keys[position] == keys, order[position], -1)
+        else:
+            columns = np.full(keys.shape, -1, dtype=np.int64)
+        if add:
+            new_keys, inverse = np.unique(keys[columns < 0], return_inverse=True)
+            if len(new_keys):
+                columns[columns < 0] = len(self.column_keys) + inverse.ravel()
+                padding = np.zeros((self.V.shape[0], len(new_keys)))
+                self.column_keys = np.concatenate([self.column_keys, new_keys])
+                self.V = np.concatenate([self.V, padding], axis=1)
+                self.variance = np.concatenate([self.variance, padding], axis=1)
+                self.counts = np.concatenate([self.counts, padding.astype(np.int32)], axis=1)
+                self._sorted = None
+        return columns
+
+    def update(self, prev_epoch: int, columns, sampled_values, alpha: float, window: int = 1):
+        """
+        Smooths the sampled values of `columns` into the epochs within `window` of `prev_epoch`, like VFA.
+        """
+        for epoch in range(prev_epoch - window, prev_epoch + window + 1):
+            if epoch < 0 or epoch >= self.V.shape[0]:
+                continue
+            visited = self.counts[epoch, columns] > 0
+            prev_value = np.where(visited, self.V[epoch, columns], sampled_values)
+            deviation = (sampled_values - prev_value) ** 2
+            self.variance[epoch, columns] = (1 - alpha) * self.variance[epoch, columns] + alpha * deviation
+            self.V[epoch, columns] = (1 - alpha) * prev_value + alpha * sampled_values
+            self.counts[epoch, columns] += 1
+
+    def estimates(self, epoch: int, columns):
+        """
+        Returns the estimate and its variance for each column (nan where there is none).
+        """
+        known = columns >= 0
+        known[known] = self.counts[epoch, columns[known]] > 0
+        value = np.full(columns.shape, np.nan)
+        variance = np.full(columns.shape, np.nan)
+        value[known] = self.V[epoch, columns[known]]
+        variance[known] = (self.variance[epoch, columns[known]] + PRIOR_VARIANCE) / self.counts[epoch, columns[known]]
+        return value, variance
+
+
+class HierarchicalVFA(VFA):
+    """
+    Value function approximation with hierarchical aggregation.
+
+    Estimates are kept at `levels` grid precisions, from the policy's precision down to
+    coarser ones (e.g. 3, 2, 1). Every epoch, nearest-order distances are sampled at the
+    cells where data exists only; level 0 is updated at those cells and each coarser
+    level once per coarse cell, with the mean of the samples it contains. The value of a
+    cell combines the estimates of the levels containing it with weights
+    1 / (variance + bias^2), where the bias of a level is its difference from the finest
+    available estimate. Rarely visited fine cells thus lean on their coarse cells.
+    With `sample_cells='all'`, samples are taken at every cell of the location index (data
+    cells and their neighbours) like VFA: more updates, but better estimates on coarse grids.
+    """
+    _excluded_keys = VFA._excluded_keys + ['value_levels', '_level_keys_cache']
+    checkpoint_params = CHECKPOINT_PARAMS + ['levels', 'sample_cells']
+
+    def __init__(self, **kwargs):
+        super(HierarchicalVFA, self).__init__(**kwargs)
+        self.name = POLICY_NAME
+        self.logs_folder = 'logs/' + kwargs.get('instance_name', 'xxx') + '/' + self.name
+        self.levels = kwargs.get('levels', DEFAULT_LEVELS)
+        self.sample_cells = kwargs.get('sample_cells', 'data')
+        if self.sample_cells not in SAMPLE_CELLS:
+            raise ValueError('Unknown sample cells: {}'.format(self.sample_cells))
+        self.value_levels = [ValueLevel(self.precision - level, self.V.shape[0]) for level in range(self.levels)]
+        self._level_keys_cache = None
+
+    def __getstate__(self):
+        state = super(HierarchicalVFA, self).__getstate__()
+        state['_level_keys_cache'] = None
+        return state
+
+    def level_keys(self, location_index: LocationIndex):
+        """
+        Returns, per level, the key of every cell of the location index (cached for the last index seen).
+        """
+        if self._level_keys_cache is not None and self._level_keys_cache[0] is location_index:
+            return self._level_keys_cache[1]
+        if location_index.precision != self.precision:
+            raise ValueError(
+                f'Location index precision {location_index.precision} does not match policy precision {self.precision}'
+            )
+        keys = [level.keys(location_index) for level in self.value_levels]
+        self._level_keys_cache = (location_index, keys)
+        return keys
+
+    def take_action(self, state: State):
+        self.epoch = state.epoch
+        actions = self.compute_actions(state.couriers, state.location_index)
+
+        if not self.frozen and state.epoch > 0 and not is_empty(state.orders):
+            cells = state.data_cells if self.sample_cells == 'data' else state.cells
+            order_ids, distances = self.sample_nearest_orders(state, cells)
+            found = order_ids >= 0
+            self.update_level_estimates(
+                prev_epoch=state.epoch - 1,
+                location_index=state.location_index,
+                cells=cells[found],
+                sampled_values=distances[found].astype(np.float64)
+            )
+        return actions
+
+    def take_action_batch(self, state):
+        raise NotImplementedError('{} does not support batched simulation'.format(self.name))
+
+    def share(self, location_indexes: list):
+        raise NotImplementedError('{} does not support parallel training'.format(self.name))
+
+    def update_level_estimates(self, prev_epoch: int, location_index: LocationIndex, cells, sampled_values):
+        for level, keys in zip(self.value_levels, self.level_keys(location_index)):
+            level_keys, inverse = np.unique(keys[cells], return_inverse=True)
+            inverse = inverse.ravel()
+            means = np.bincount(inverse, weights=sampled_values) / np.bincount(inverse)
+            level.update(
+                prev_epoch, level.columns(level_keys, add=True), means, self.current_step_size(), self.epoch_window
+            )
+
+    def cell_values(self, epoch: int, location_index: LocationIndex, cells):
+        """
+        Returns the aggregated value of each cell id (inf where no level has an estimate).
+        """
+        cells = np.asarray(cells, dtype=np.int64)
+        estimates = [
+            level.estimates(epoch, level.columns(keys[cells]))
+            for level, keys in zip(self.value_levels, self.level_keys(location_index))
+        ]
+        values = np.stack([value for value, _ in estimates])
+        variances = np.stack([variance for _, variance in estimates])
+        # Finest available estimate of each cell, the reference for the levels' bias
+        finest = values[np.isfinite(values).argmax(axis=0), np.arange(len(cells))]
+        weights = np.where(np.isfinite(values), 1 / (variances + (values - finest) ** 2), 0)
+        total = weights.sum(axis=0)
+        combined = np.where(np.isfinite(values), weights * values, 0).sum(axis=0)
+        return np.where(total > 0, combined / np.where(total > 0, total, 1), np.inf)
+
+    def compute_movement_locations(self, start_cells, location_index):
+        """
+        Moves each courier to the neighbour with the lowest aggregated value (first one on ties).
+        Couriers whose neighbours have no estimates at any level stay where they are.
+        """
+        movements = location_index.neighbours[start_cells]
+        values = np.where(
+            movements >= 0,
+            self.cell_values(self.epoch, location_index, movements.clip(min=0).ravel()).reshape(movements.shape),
+            np.inf
+        )
+        best = values.argmin(axis=1)
+        rows = np.arange(len(start_cells))
+        return np.where(np.isfinite(values[rows, best]), movements[rows, best], start_cells)
+
+    def value_table(self):
+        level = self.value_levels[0]
+        return level.V, level.counts > 0
+
+    def checkpoint_arrays(self):
+        arrays = {}
+        for ix, level in enumerate(self.value_levels):
+            arrays.update({
+                f'level_{ix}_V': level.V,
+                f'level_{ix}_variance': level.variance,
+                f'level_{ix}_counts': level.counts,
+                f'level_{ix}_column_keys': level.column_keys,
+            })
+        return arrays
+
+    def set_checkpoint_arrays(self, arrays: dict):
+        for ix, level in enumerate(self.value_levels):
+            level.V = arrays[f'level_{ix}_V']
+            level.variance = arrays[f'level_{ix}_variance']
+            level.counts = arrays[f'level_{ix}_counts']
+            level.column_keys = np.asarray(arrays[f'level_{ix}_column_keys'])
+            level._sorted = None
+
+    def value_table_as_dict(self):
+        """
+        Returns the aggregated value of every finest-level cell as {epoch: {(lat, lng): value}}.
+        """
+        level = self.value_levels[0]
+        lats, lngs = LocationIndex.key_coordinates(level.column_keys, level.precision)
+        location_index = LocationIndex.from_coordinates(lats, lngs, level.precision)
+        cells = location_index.lookup(lats, lngs)
+        locations = list(zip(lats.tolist(), lngs.tolist()))
+        table = {}
+        for t in range(level.V.shape[0]):
+            visited = np.flatnonzero(level.counts[t] > 0)
+            values = self.cell_values(t, location_index, cells[visited])
+            table[t] = {locations[column]: float(value) for column, value in zip(visited, values)}
+        return table
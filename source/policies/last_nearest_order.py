@@ -1,10 +1,12 @@
 from source.state import State
 from source.policies.policy import Policy
-from source.utils import get_nearest_order_per_courier
+from source.utils import compute_movement_location, get_nearest_order_per_courier
 
 POLICY_NAME = 'LastNearestOrder'
 
 class LastNearestOrder(Policy):
+    stateless = True
+
     def __init__(self, **kwargs):
         super(LastNearestOrder, self).__init__(
             name=POLICY_NAME,
@@ -15,6 +17,16 @@ class LastNearestOrder(Policy):
         orders = state.orders
         couriers = state.couriers
         return get_nearest_order_per_courier(
-            orders, couriers, state.distance_map, state.neighbours_map
+            orders, couriers, state.location_index, order_index=state.order_index,
+            max_distance=self.max_distance if self.bounded_search else None
         )
 
+    def take_action_batch(self, state):
+        order_ids, _ = state.nearest_orders(
+            state.courier_cells, state.courier_group, max_distance=self.max_distance if self.bounded_search else None
+        )
+        found = order_ids >= 0
+        move_cells = state.courier_cells.copy()
+        order_cells = state.order_cells[state.order_offsets[state.courier_group[found]] + order_ids[found]]
+        move_cells[found], _ = compute_movement_location(move_cells[found], order_cells, state.location_index)
+        return move_cells
@@ -1,13 +1,19 @@
 import os
 import time
 import json
-import numpy as np
+from contextlib import nullcontext
+from source.events import SIMULATORS, get_simulator
+from source.export import ActionExporter
+from source.profiling import get_profiler
 from source.scenario import Scenario
 from source.state import State
+from source.traces import ActionTrace, TraceRecorder
 
 
 class Policy:
-    _excluded_keys = ['verbose']
+    _excluded_keys = ['verbose', 'profiler']
+    # Stateless policies do not learn across scenarios, so scenarios can be evaluated in any order
+    stateless = False
 
     def __init__(self, **kwargs):
         self.name = kwargs.get('name', 'Policy')
@@ -15,44 +21,92 @@ class Policy:
         self.minutes_bucket_size = kwargs.get('minutes_bucket_size', 10)
         self.max_distance = self.courier_km_per_minute * self.minutes_bucket_size
         self.precision = kwargs.get('precision', 2)
+        # Nearest-order index kind (see source.spatial.INDEXES) and whether searches stop at max_distance
+        self.order_index_kind = kwargs.get('order_index', 'grid')
+        self.bounded_search = kwargs.get('bounded_search', False)
+        self.action_details = kwargs.get('action_details', True)
         self.verbose = kwargs.get('verbose', False)
+        # Per-epoch phase timings are recorded only when a source.profiling.Profiler is given
+        self.profiler = get_profiler(kwargs.get('profiler'))
         self.export_details = kwargs.get('export_policy_details', False)
+        # Per-epoch decisions are streamed to the logs folder ('jsonl' or 'csv') and, unless
+        # summary_only, also returned by train()
+        self.export_actions = kwargs.get('export_actions', None)
+        self.summary_only = kwargs.get('summary_only', False)
+        # Per-scenario action traces (source.traces) are saved to the logs folder for source.rescore
+        self.export_traces = kwargs.get('export_traces', False)
         self.logs_folder = 'logs/' + kwargs.get('instance_name', 'xxx') + '/' + self.name
+        # Simulation loop of train() (see source.events.SIMULATORS): every epoch, or only epochs with events
+        self.simulator = kwargs.get('simulator', 'epochs')
+        if self.simulator not in SIMULATORS:
+            raise ValueError('Unknown simulator: {}'.format(self.simulator))
 
     def train(self, scenario: Scenario):
         now = time.time()
-        state = State(scenario)
-        scenario_actions = []
-        scenario_costs = []
-        for epoch in range(scenario.epochs):
-            actions = self.take_action(state) if state.couriers else None
-            cost, action_evaluation, state = state.update(scenario, actions)
-            scenario_actions.append(action_evaluation)
-            scenario_costs.append(cost)
-            if self.verbose:
-                print(f"Scenario: {scenario.index} - Epoch: {epoch} - Cost: {cost}")
+        profiler = self.profiler
+        state = State(scenario, order_index_kind=self.order_index_kind, profiler=profiler)
+        details = self.action_details and (self.export_actions is not None or not self.summary_only)
+        scenario_actions = None if self.summary_only else []
+        scenario_cost = 0
+        simulate = get_simulator(self.simulator)
+        recorder = TraceRecorder(scenario) if self.export_traces else None
+        with self.open_action_exporter(scenario) as exporter:
+            for epoch, cost, action_evaluation, actions in simulate(self, state, details=details):
+                if recorder is not None:
+                    recorder.add(epoch, actions)
+                if exporter is not None:
+                    exporter.write(epoch, cost, action_evaluation)
+                if scenario_actions is not None:
+                    scenario_actions.append(action_evaluation)
+                scenario_cost += cost
+                if self.verbose:
+                    print(f"Scenario: {scenario.index} - Epoch: {epoch} - Cost: {cost}")
         execution_secs = time.time() - now
         print(
             f"Policy: {self.name} - "
             f"Scenario: {scenario.index} - "
             f"Execution time: {execution_secs:.1f} - "
-            f"Cost: {np.sum(scenario_costs):.1f} - "
+            f"Cost: {scenario_cost:.1f} - "
             f"Perfect cost: {scenario.perfect_cost:.1f} - "
-            f"Gap: {(np.sum(scenario_costs) - scenario.perfect_cost) / scenario.perfect_cost * 100:.1f}%"
+            f"Gap: {(scenario_cost - scenario.perfect_cost) / scenario.perfect_cost * 100:.1f}%"
         )
         if self.export_details:
-            self.export_policy_as_dict(fname=f'{scenario.label}_{scenario.index}')
+            self.export_policy(fname=f'{scenario.label}_{scenario.index}')
+        if recorder is not None:
+            fname = ActionTrace.file_name(f'{scenario.label}_{scenario.index}')
+            recorder.trace(self.name, round(scenario_cost, 2)).save(os.path.join(self.logs_folder, 'traces', fname))
 
         return {
-            'cost': round(sum(scenario_costs), 2),
+            'cost': round(scenario_cost, 2),
             'actions': scenario_actions,
             'execution_secs': execution_secs,
-            'gap': round((sum(scenario_costs) - scenario.perfect_cost)/scenario.perfect_cost, 2)
+            'gap': round((scenario_cost - scenario.perfect_cost)/scenario.perfect_cost, 2)
             }
 
+    def open_action_exporter(self, scenario: Scenario):
+        """
+        Returns the ActionExporter of a scenario's decisions, or a null context if they are not exported.
+        """
+        if self.export_actions is None:
+            return nullcontext()
+        fname = ActionExporter.file_name(f'{scenario.label}_{scenario.index}', self.export_actions)
+        return ActionExporter(os.path.join(self.logs_folder, 'actions', fname), fmt=self.export_actions)
+
     def take_action(self, state: State):
         raise NotImplementedError
 
+    def take_action_batch(self, state):
+        """
+        Returns the move cell of every courier of a source.batch.BatchState (int array aligned with its couriers).
+        """
+        raise NotImplementedError('{} does not support batched simulation'.format(self.name))
+
+    def export_policy(self, fname: str):
+        """
+        Writes the policy to the logs folder (JSON by default, subclasses may use a checkpoint).
+        """
+        self.export_policy_as_dict(fname)
+
     def dict_from_class(cls):
         return dict(
             (key, value)
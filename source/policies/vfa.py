@@ -1,85 +1,381 @@
-from itertools import product
-from collections import defaultdict
+import os
+import ast
+import json
+import shutil
+import numpy as np
+from source.locations import LocationIndex
+from source.scenario import get_num_epochs
+from source.shared import SharedArray
 from source.state import State
 from source.policies.policy import Policy
-from source.utils import haversine_distance
+from source.utils import get_cells, is_empty
 
 POLICY_NAME = 'VFA'
+CHECKPOINT_VERSION = 1
+CHECKPOINT_PARAMS = [
+    'courier_km_per_minute', 'minutes_bucket_size', 'precision', 'order_index_kind', 'bounded_search', 'alpha',
+    'step_size', 'harmonic_a', 'epoch_window', 'nearest_field',
+]
+DEFAULT_ALPHA = 0.2
+STEP_SIZES = ['constant', 'harmonic']
+DEFAULT_HARMONIC_A = 5
+# How the nearest-order distance of every cell is sampled: the epoch's order index (exact) or a
+# grid distance transform (spatial.distance_transform), whose cost grows with the cells only
+NEAREST_FIELDS = ['index', 'transform']
 
 
-def find_closest_order(couriers, orders, distance_map):
-    nearest_order = defaultdict()
-    for j, courier in enumerate(couriers):
-        courier_location = (courier['lat'], courier['lng'])
-        nearest_order[courier_location] = {'distance': float('inf')}
-        for i, order in enumerate(orders):
-            order_lat, order_lng = order['lat'], order['lng']
-            d = distance_map[courier_location][(order_lat, order_lng)]
-            if d < nearest_order[courier_location]['distance']:
-                nearest_order[courier_location] = {
-                    'order_id': i,
-                    'distance': d,
-                    'lat': order['lat'],
-                    'lng': order['lng'],
-                }
-    return nearest_order
+class VFA(Policy):
+    """
+    Value function approximation policy.
 
+    V holds the estimated nearest-order distance of every (epoch, location) as a dense
+    `epochs x locations` array, with a `visited` mask for the entries with estimates.
+    Columns are grid cells identified by their LocationIndex key, so a column keeps
+    its meaning across scenarios; `column_keys` grows as new cells are seen.
+    A frozen VFA (`frozen=True` or `freeze()`) acts on its estimates without updating them.
+    """
+    _excluded_keys = Policy._excluded_keys + ['visited', 'column_keys', '_column_cache', '_shared_table']
+    # Parameters saved in (and restored from) checkpoints
+    checkpoint_params = CHECKPOINT_PARAMS
 
-class VFA(Policy):
     def __init__(self, **kwargs):
         super(VFA, self).__init__(
             name=POLICY_NAME,
             **kwargs,
         )
-        epoch_in_minutes = range(0, 24 * 60, self.minutes_bucket_size)
-        self.V = {t: defaultdict() for t, _ in enumerate(epoch_in_minutes)}
+        num_epochs = get_num_epochs(self.minutes_bucket_size)
+        self.V = np.zeros((num_epochs, 0))
+        self.visited = np.zeros((num_epochs, 0), dtype=bool)
+        self.column_keys = np.empty(0, dtype=np.int64)
+        self._column_cache = None
         self.n = 1   # Sample path
         self.epoch = None
+        self.frozen = kwargs.get('frozen', False)
+        # Step size of the value estimate updates: `alpha`, decayed over sample paths by the `step_size`
+        # schedule (see STEP_SIZES), and number of epochs updated on each side of a sample's epoch
+        self.alpha = kwargs.get('alpha', DEFAULT_ALPHA)
+        self.step_size = kwargs.get('step_size', 'constant')
+        if self.step_size not in STEP_SIZES:
+            raise ValueError('Unknown step size: {}'.format(self.step_size))
+        self.harmonic_a = kwargs.get('harmonic_a', DEFAULT_HARMONIC_A)
+        self.epoch_window = kwargs.get('epoch_window', 1)
+        self.nearest_field = kwargs.get('nearest_field', 'index')
+        if self.nearest_field not in NEAREST_FIELDS:
+            raise ValueError('Unknown nearest field: {}'.format(self.nearest_field))
+        self._shared_table = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_column_cache'] = None
+        if state.get('_shared_table') is not None:
+            state['V'] = state['visited'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.__dict__.setdefault('_shared_table', None) is not None:
+            self.V, self.visited = (shared.array for shared in self._shared_table)
+
+    def share(self, location_indexes: list):
+        """
+        Adds the columns of every cell of the location indexes, then moves V and the visited mask to
+        writable shared memory so that pickled copies of the policy in worker processes update the
+        same table (see source.parallel_training). Call `release` when workers are done.
+        """
+        if self._shared_table is None:
+            for location_index in location_indexes:
+                self.get_columns(location_index)
+            self._shared_table = (SharedArray(self.V, readonly=False), SharedArray(self.visited, readonly=False))
+            self.V, self.visited = (shared.array for shared in self._shared_table)
+        return self
+
+    def release(self):
+        if self._shared_table is not None:
+            self.V, self.visited = np.array(self.V), np.array(self.visited)
+            for shared in self._shared_table:
+                shared.unlink()
+            self._shared_table = None
 
     def take_action(self, state: State):
         orders = state.orders
         couriers = state.couriers
-        prev_actions = state.prev_actions
-        all_locations = state.locations
+        columns = self.get_columns(state.location_index)
         self.epoch = state.epoch
-        actions = self.compute_actions(couriers, state.neighbours_map)
-
-        if state.epoch > 0 and orders:
-            closest_order_per_location = find_closest_order(all_locations, orders, state.distance_map)
+        actions = self.compute_actions(couriers, state.location_index)
 
+        if not self.frozen and state.epoch > 0 and not is_empty(orders):
+            all_cells = state.cells
+            order_ids, distances = self.sample_nearest_orders(state, all_cells)
+            found = order_ids >= 0
             self.update_value_estimates(
                 prev_epoch=state.epoch - 1,
-                nearest_orders=closest_order_per_location
+                locations=columns[all_cells[found]],
+                sampled_values=distances[found]
             )
         return actions
 
-    def compute_actions(self, couriers, neighbours_map):
+    def sample_nearest_orders(self, state: State, cells):
+        """
+        Returns the nearest order of the previous epoch to each cell and its distance (see NEAREST_FIELDS).
+        """
+        max_distance = self.max_distance if self.bounded_search else None
+        if self.nearest_field == 'transform':
+            return state.order_index.field(cells, max_distance=max_distance)
+        return state.order_index.nearest(cells, max_distance=max_distance)
+
+    def take_action_batch(self, state):
+        """
+        Batched take_action (see source.batch): the groups of a learning VFA are one epoch of many
+        scenarios, whose samples update the estimates in scenario order.
+        """
+        columns = self.get_columns(state.location_index)
+        move_cells = self.compute_movement_locations(
+            state.courier_cells, state.location_index, epochs=state.epochs[state.courier_group]
+        )
+        if not self.frozen:
+            # Like take_action, which only runs for epochs with couriers
+            group_ix = np.flatnonzero((state.epochs > 0) & (state.order_counts > 0) & (state.courier_counts > 0))
+            cells, sample_group = state.scenario_cells(group_ix)
+            order_ids, distances = state.nearest_orders(
+                cells, sample_group, max_distance=self.max_distance if self.bounded_search else None
+            )
+            found = order_ids >= 0
+            self.update_value_estimates_batch(
+                prev_epochs=state.epochs[sample_group[found]] - 1,
+                locations=columns[cells[found]],
+                sampled_values=distances[found]
+            )
+        return move_cells
+
+    def freeze(self):
+        self.frozen = True
+        return self
+
+    def checkpoint_arrays(self):
+        """
+        Returns the arrays a checkpoint holds, {name: array}.
+        """
+        return {'V': self.V, 'visited': self.visited, 'column_keys': self.column_keys}
+
+    def set_checkpoint_arrays(self, arrays: dict):
+        self.V = arrays['V']
+        self.visited = arrays['visited']
+        self.column_keys = np.asarray(arrays['column_keys'])
+
+    def save(self, path: str):
+        """
+        Writes a checkpoint folder with one .npy per checkpoint array (for VFA: the value array V,
+        the visited mask and the cell key of every column) and the policy parameters (meta.json).
+        """
+        tmp_path = path.rstrip('/') + '.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for name, array in self.checkpoint_arrays().items():
+            np.save(os.path.join(tmp_path, f'{name}.npy'), array)
+        meta = {
+            'version': CHECKPOINT_VERSION,
+            'name': self.name,
+            'n': self.n,
+            **{key: getattr(self, key) for key in self.checkpoint_params},
+        }
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=2)
+        # Swap the checkpoint in only once it is complete
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True, **kwargs):
+        """
+        Loads a checkpoint written by `save`.
+        :param path: checkpoint folder
+        :param mmap: memory-map the arrays (copy-on-write, so training can go on from the checkpoint)
+        :param kwargs: policy parameters overriding the saved ones (e.g. frozen=True)
+        :return: VFA
+        """
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta.get('version') != CHECKPOINT_VERSION:
+            raise ValueError('Unknown checkpoint version: {}'.format(meta.get('version')))
+        params = {key: meta[key] for key in cls.checkpoint_params if key in meta}
+        params['order_index'] = params.pop('order_index_kind')
+        policy = cls(**{**params, **kwargs})
+        if policy.precision != meta['precision'] or policy.minutes_bucket_size != meta['minutes_bucket_size']:
+            raise ValueError('Checkpoint precision and bucket size cannot be overridden')
+        mmap_mode = 'c' if mmap else None
+        policy.set_checkpoint_arrays({
+            file[:-len('.npy')]: np.load(os.path.join(path, file), mmap_mode=mmap_mode)
+            for file in os.listdir(path) if file.endswith('.npy')
+        })
+        policy.n = meta['n']
+        return policy
+
+    def export_policy(self, fname: str):
+        self.save(os.path.join(self.logs_folder, fname))
+
+    @classmethod
+    def load_json(cls, path: str, **kwargs):
+        """
+        Loads a VFA from the JSON written by `export_policy_as_dict` (exports before checkpoints).
+        :param path: exported JSON file
+        :param kwargs: policy parameters overriding the exported ones (e.g. frozen=True)
+        :return: VFA
+        """
+        with open(path) as f:
+            data = json.load(f)
+        params = {
+            key: data[key] for key in ['courier_km_per_minute', 'minutes_bucket_size', 'precision', 'alpha'] if key in data
+        }
+        policy = cls(**{**params, **kwargs})
+        entries = [
+            (int(epoch), *ast.literal_eval(location), value)
+            for epoch, values in data['V'].items() for location, value in values.items()
+        ]
+        if not entries:
+            return policy
+        epochs, lats, lngs, values = (np.array(column) for column in zip(*entries))
+        keys = LocationIndex.cell_keys(np.rint(lats * 10 ** policy.precision), np.rint(lngs * 10 ** policy.precision))
+        policy.column_keys, columns = np.unique(keys, return_inverse=True)
+        policy.V = np.zeros((policy.V.shape[0], len(policy.column_keys)))
+        policy.visited = np.zeros(policy.V.shape, dtype=bool)
+        policy.V[epochs, columns] = values
+        policy.visited[epochs, columns] = True
+        return policy
+
+    def get_columns(self, location_index):
+        """
+        Returns the V column of every cell of the location index, adding columns for unseen cells.
+        The mapping is cached for the last location index seen.
+        """
+        if self._column_cache is not None and self._column_cache[0] is location_index:
+            return self._column_cache[1]
+        if location_index.precision != self.precision:
+            raise ValueError(
+                f'Location index precision {location_index.precision} does not match policy precision {self.precision}'
+            )
+        keys = location_index.keys
+        order = np.argsort(self.column_keys)
+        sorted_keys = self.column_keys[order]
+        position = np.searchsorted(sorted_keys, keys).clip(max=max(len(sorted_keys) - 1, 0))
+        found = (sorted_keys[position] == keys) if len(sorted_keys) else np.zeros(len(keys), dtype=bool)
+        columns = np.where(found, order[position] if len(order) else -1, -1)
+        new = np.flatnonzero(~found)
+        if len(new):
+            if self._shared_table is not None:
+                raise ValueError('Cannot add columns to a shared value table')
+            columns[new] = len(self.column_keys) + np.arange(len(new))
+            self.column_keys = np.concatenate([self.column_keys, keys[new]])
+            self.V = np.concatenate([self.V, np.zeros((self.V.shape[0], len(new)))], axis=1)
+            self.visited = np.concatenate([self.visited, np.zeros((self.V.shape[0], len(new)), dtype=bool)], axis=1)
+        self._column_cache = (location_index, columns)
+        return columns
+
+    def compute_actions(self, couriers, location_index):
+        courier_cells = get_cells(couriers, location_index)
+        move_cells = self.compute_movement_locations(courier_cells, location_index)
         actions = {}
-        for ix, courier in enumerate(couriers):
-            move_lat, move_lng = self.compute_movement_location(courier['lat'], courier['lng'], neighbours_map)
-            actions[ix] = {'lat': move_lat, 'lng': move_lng}
+        for ix, move_cell in enumerate(move_cells.tolist()):
+            move_lat, move_lng = location_index.location(move_cell)
+            actions[ix] = {'lat': move_lat, 'lng': move_lng, 'cell': move_cell}
         return actions
 
-    def update_value_estimates(self, prev_epoch: int, nearest_orders: dict):
-        alpha = 0.2 #* (1 - (self.num_iteration + 1) / self.total_iterations)
-        # delta = ceil(10 * (1 - (self.num_iteration + 1) / self.total_iterations))
+    def current_step_size(self):
+        """
+        Returns the step size of sample path `n` (the n-th pass over the training scenarios):
+        * constant: alpha.
+        * harmonic: alpha * a / (a + n - 1), which decays so that estimates settle over passes.
+        """
+        if self.step_size == 'harmonic':
+            return self.alpha * self.harmonic_a / (self.harmonic_a + self.n - 1)
+        return self.alpha
+
+    def value_table(self):
+        """
+        Returns the value estimates and the mask of the entries that have one, e.g. to track convergence.
+        """
+        return self.V, self.visited
+
+    def update_value_estimates(self, prev_epoch: int, locations: np.ndarray, sampled_values: np.ndarray):
+        """
+        Smooths the sampled values of V columns `locations` into the epochs within `epoch_window` of `prev_epoch`.
+        """
+        alpha = self.current_step_size()
         if prev_epoch < 0:
             return
+        sampled_values = np.asarray(sampled_values, dtype=np.float64)
         # Value function update algorithm
-        for location in nearest_orders:
-            sampled_value = nearest_orders[location]['distance']
-            for epoch in [prev_epoch - 1, prev_epoch, prev_epoch + 1]:  # Idea - start updating multiples but then reduce it
-                if epoch < 0:
-                    continue
-                prev_value = self.V[epoch].get(location, sampled_value)
-                self.V[epoch][location] = (1-alpha) * prev_value + alpha * sampled_value
-
-    def compute_movement_location(self, start_lat, start_lng, neighbours_map):
-        movements = neighbours_map[(start_lat, start_lng)]
-        d = float('inf')
-        best_move = (start_lat, start_lng)
-        for i, move in enumerate(movements):
-            if self.V[self.epoch].get(move, d) < d:
-                best_move = move
-                d = self.V[self.epoch][move]
-        return best_move
+        for epoch in range(prev_epoch - self.epoch_window, prev_epoch + self.epoch_window + 1):
+            if epoch < 0 or epoch >= self.V.shape[0]:
+                continue
+            prev_value = np.where(self.visited[epoch, locations], self.V[epoch, locations], sampled_values)
+            self.V[epoch, locations] = (1-alpha) * prev_value + alpha * sampled_values
+            self.visited[epoch, locations] = True
+
+    def update_value_estimates_batch(self, prev_epochs, locations, sampled_values):
+        """
+        Same as calling update_value_estimates once per sample, in sample order, in a single pass
+        (exactly so when all samples share their epoch): the k samples x_1..x_k of an entry v give
+        (1-alpha)^k v + sum_i alpha (1-alpha)^(k-i) x_i, with v = x_1 if the entry was not visited.
+        :param prev_epochs: epoch of each sample
+        :param locations: V column of each sample
+        :param sampled_values: sampled value of each sample
+        """
+        alpha = self.current_step_size()
+        prev_epochs = np.asarray(prev_epochs, dtype=np.int64)
+        sampled_values = np.asarray(sampled_values, dtype=np.float64)
+        num_epochs, num_columns = self.V.shape
+        keep = prev_epochs >= 0
+        # Samples grouped by (epoch, column), keeping their order within a group
+        entries = prev_epochs[keep] * num_columns + np.asarray(locations)[keep]
+        order = np.argsort(entries, kind='stable')
+        entries, values = entries[order], sampled_values[keep][order]
+        entries, starts, counts = np.unique(entries, return_index=True, return_counts=True)
+        sample_epochs, columns = np.divmod(entries, num_columns)
+        rank = np.arange(len(values)) - np.repeat(starts, counts)
+        weights = alpha * (1 - alpha) ** (np.repeat(counts, counts) - 1 - rank)
+        smoothed = np.bincount(
+            np.repeat(np.arange(len(entries)), counts), weights=weights * values, minlength=len(entries)
+        )
+        decay = (1 - alpha) ** counts
+        for shift in range(-self.epoch_window, self.epoch_window + 1):
+            epochs = sample_epochs + shift
+            valid = (epochs >= 0) & (epochs < num_epochs)
+            rows, cols = epochs[valid], columns[valid]
+            prev_value = np.where(self.visited[rows, cols], self.V[rows, cols], values[starts[valid]])
+            self.V[rows, cols] = decay[valid] * prev_value + smoothed[valid]
+            self.visited[rows, cols] = True
+
+    def compute_movement_locations(self, start_cells, location_index, epochs=None):
+        """
+        Moves each courier to the neighbour with the lowest value estimate (first one on ties).
+        Couriers whose neighbours have no estimates stay where they are.
+        :param epochs: optional epoch of each courier (default: the current epoch)
+        """
+        columns = self.get_columns(location_index)
+        movements = location_index.neighbours[start_cells]
+        movement_columns = columns[movements.clip(min=0)]
+        epoch = self.epoch if epochs is None else np.asarray(epochs)[:, None]
+        values = np.where(
+            (movements >= 0) & self.visited[epoch, movement_columns],
+            self.V[epoch, movement_columns],
+            np.inf
+        )
+        best = values.argmin(axis=1)
+        rows = np.arange(len(start_cells))
+        return np.where(np.isfinite(values[rows, best]), movements[rows, best], start_cells)
+
+    def value_table_as_dict(self):
+        """
+        Returns V as {epoch: {(lat, lng): value}} with the visited entries only.
+        """
+        lats, lngs = LocationIndex.key_coordinates(self.column_keys, self.precision)
+        locations = list(zip(lats.tolist(), lngs.tolist()))
+        return {
+            t: {locations[column]: float(self.V[t, column]) for column in np.flatnonzero(self.visited[t])}
+            for t in range(self.V.shape[0])
+        }
+
+    def dict_from_class(self):
+        data = super(VFA, self).dict_from_class()
+        data['V'] = self.value_table_as_dict()
+        return data
@@ -0,0 +1,193 @@
+import csv
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+import numpy as np
+
+EPOCH_FIELDS = ['policy', 'scenario_label', 'scenario', 'epoch', 'orders', 'couriers']
+STAGE_FIELDS = ['stage', 'scenario_label', 'scenario', 'seconds', 'peak_bytes']
+PHASES = ['take_action', 'update', 'evaluate']
+
+
+class Profiler:
+    """
+    Opt-in instrumentation of the simulation.
+
+    `epochs` holds one record per simulated epoch with the seconds spent in each phase
+    (see PHASES) and the order and courier counts. Phases are disjoint: the time of a phase
+    nested in another (e.g. 'evaluate', run by State.step inside 'update') only counts
+    towards the inner one. `stages` holds one record per timed
+    preprocessing stage (e.g. Scenario construction) with its seconds and, if `memory`,
+    the peak of memory allocated while it ran (tracemalloc).
+    """
+    enabled = True
+
+    def __init__(self, memory: bool = True):
+        self.memory = memory
+        self.epochs = []
+        self.stages = []
+        self._current = None
+        # Seconds spent in the phases nested in each open phase
+        self._nested = []
+
+    def start_epoch(self, policy: str, scenario, epoch: int, orders, couriers):
+        self._current = {
+            'policy': policy,
+            'scenario_label': scenario.label,
+            'scenario': scenario.index,
+            'epoch': epoch,
+            'orders': 0 if orders is None else len(orders),
+            'couriers': 0 if couriers is None else len(couriers),
+            **{phase: 0.0 for phase in PHASES},
+        }
+        self.epochs.append(self._current)
+
+    @contextmanager
+    def phase(self, name: str):
+        """
+        Adds the time spent in the block, outside of nested phases, to phase `name` of the current epoch.
+        """
+        start = time.perf_counter()
+        self._nested.append(0.0)
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            nested = self._nested.pop()
+            if self._nested:
+                self._nested[-1] += seconds
+            if self._current is not None:
+                self._current[name] += seconds - nested
+
+    @contextmanager
+    def stage(self, name: str, scenario_label: str = None, scenario: int = None):
+        """
+        Records the time and peak memory of a preprocessing stage.
+        """
+        tracing = self.memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        if self.memory:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            peak_bytes = tracemalloc.get_traced_memory()[1] - baseline if self.memory else None
+            if tracing:
+                tracemalloc.stop()
+            self.stages.append({
+                'stage': name, 'scenario_label': scenario_label, 'scenario': scenario,
+                'seconds': seconds, 'peak_bytes': peak_bytes,
+            })
+
+    def extend(self, other):
+        """
+        Adds the records of another profiler (e.g. returned from a worker process).
+        """
+        self.epochs.extend(other.epochs)
+        self.stages.extend(other.stages)
+
+    def to_csv(self, epochs_path: str, stages_path: str = None):
+        write_csv(epochs_path, self.epochs, EPOCH_FIELDS + PHASES)
+        if stages_path is not None:
+            write_csv(stages_path, self.stages, STAGE_FIELDS)
+
+    def to_json(self, path: str):
+        with open(path, 'w') as f:
+            json.dump({'epochs': self.epochs, 'stages': self.stages}, f, indent=2)
+
+    def summary(self):
+        """
+        Returns one row per policy with the total seconds of each phase, the mean and max seconds
+        per epoch and the slowest epoch (scenario label, scenario, epoch).
+        """
+        rows = []
+        policies = list(dict.fromkeys(record['policy'] for record in self.epochs))
+        for policy in policies:
+            records = [record for record in self.epochs if record['policy'] == policy]
+            epoch_secs = np.array([sum(record[phase] for phase in PHASES) for record in records])
+            slowest = records[int(epoch_secs.argmax())]
+            rows.append({
+                'policy': policy,
+                'epochs': len(records),
+                **{phase: sum(record[phase] for record in records) for phase in PHASES},
+                'mean_epoch_secs': float(epoch_secs.mean()),
+                'max_epoch_secs': float(epoch_secs.max()),
+                'slowest_epoch': (slowest['scenario_label'], slowest['scenario'], slowest['epoch']),
+                'slowest_epoch_orders': slowest['orders'],
+                'slowest_epoch_couriers': slowest['couriers'],
+            })
+        return rows
+
+    def stage_summary(self):
+        """
+        Returns one row per stage with its total seconds and largest peak memory.
+        """
+        rows = []
+        for stage in dict.fromkeys(record['stage'] for record in self.stages):
+            records = [record for record in self.stages if record['stage'] == stage]
+            peaks = [record['peak_bytes'] for record in records if record['peak_bytes'] is not None]
+            rows.append({
+                'stage': stage,
+                'count': len(records),
+                'seconds': sum(record['seconds'] for record in records),
+                'max_peak_bytes': max(peaks) if peaks else None,
+            })
+        return rows
+
+    def print_summary(self):
+        for row in self.stage_summary():
+            peak = f"{row['max_peak_bytes'] / 2 ** 20:.1f} MB" if row['max_peak_bytes'] is not None else '-'
+            print(f"Stage: {row['stage']} | Count: {row['count']} | Time: {row['seconds']:.2f}s | Max. peak: {peak}")
+        for row in self.summary():
+            print(
+                f"Profile -> Policy: {row['policy']} "
+                f"| Epochs: {row['epochs']} "
+                + ''.join(f"| {phase}: {row[phase]:.2f}s " for phase in PHASES)
+                + f"| Mean epoch: {row['mean_epoch_secs'] * 1e3:.2f}ms "
+                f"| Slowest epoch: {row['slowest_epoch']} ({row['max_epoch_secs'] * 1e3:.2f}ms, "
+                f"{row['slowest_epoch_orders']} orders, {row['slowest_epoch_couriers']} couriers)"
+            )
+
+
+class NullProfiler:
+    """
+    Profiler that records nothing; its hooks cost a method call per use.
+    """
+    enabled = False
+    epochs = ()
+    stages = ()
+    _null = nullcontext()
+
+    def start_epoch(self, policy, scenario, epoch, orders, couriers):
+        pass
+
+    def phase(self, name):
+        return self._null
+
+    def stage(self, name, scenario_label=None, scenario=None):
+        return self._null
+
+    def __reduce__(self):
+        return get_profiler, (None,)
+
+
+NULL_PROFILER = NullProfiler()
+
+
+def get_profiler(profiler=None):
+    """
+    Returns `profiler`, or the shared no-op profiler if it is None.
+    """
+    return NULL_PROFILER if profiler is None else profiler
+
+
+def write_csv(path: str, records: list, fields: list):
+    with open(path, 'w') as out:
+        writer = csv.DictWriter(out, fieldnames=fields, lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(records)
@@ -0,0 +1,142 @@
+"""
+Re-scoring of recorded action traces (source.traces) without running the policies again.
+
+    python -m source --export-traces
+    python -m source.rescore --traces logs/robotex5/VFA/traces --delivery-minutes 30 --cost squared
+
+Scenarios are built like the runner does (PARAMS, with the given delivery duration), and each
+trace is matched to the scenario with its label and index. Every courier with a recorded
+decision moves to its target cell in the epoch it becomes available in that scenario, the
+others stay where they are, and the couriers of all scenarios are scored in one vectorized
+evaluation (source.batch.ScenarioBatch.evaluate) with a cost function of the distance to the
+nearest order of their epoch. Replaying a trace against the scenario it was recorded on gives
+the recorded cost.
+"""
+import os
+import time
+import argparse
+import numpy as np
+from source.batch import ScenarioBatch
+from source.config import PARAMS, load_scenarios
+from source.parallel import SPLITS
+from source.profiling import write_csv
+from source.traces import ActionTrace
+
+COST_FUNCTIONS = ['distance', 'squared', 'capped']
+RESCORE_FIELDS = [
+    'policy', 'scenario_label', 'scenario', 'recorded_cost', 'cost', 'perfect_cost', 'gap', 'decisions', 'matched',
+]
+
+
+def get_cost_function(name: str, max_distance: float = None):
+    """
+    Returns the function mapping nearest-order distances (km) to courier costs (None for the distances).
+    """
+    if name == 'distance':
+        return None
+    elif name == 'squared':
+        return np.square
+    elif name == 'capped':
+        if max_distance is None:
+            raise ValueError('The capped cost needs a max distance')
+        return lambda distances: np.minimum(distances, max_distance)
+    else:
+        raise ValueError('Unknown cost function: {}'.format(name))
+
+
+def trace_move_cells(batch: ScenarioBatch, scenario_ix: int, trace: ActionTrace):
+    """
+    Returns the batch courier rows of a scenario that have a decision in the trace, and their target cells.
+    Decisions whose trip is not a courier of the scenario or whose target is not indexed are dropped.
+    """
+    scenario = batch.scenarios[scenario_ix]
+    if trace.meta.get('precision', scenario.precision) != scenario.precision:
+        raise ValueError(
+            f"Trace precision {trace.meta['precision']} does not match scenario precision {scenario.precision}"
+        )
+    trips = scenario.courier_table.rows['trip']
+    row_of_trip = np.full(max(trips.max(initial=-1), trace.trips.max(initial=-1)) + 1, -1, dtype=np.int64)
+    row_of_trip[trips] = np.arange(len(trips))
+    rows = row_of_trip[trace.trips]
+    targets = batch.location_index.lookup_keys(trace.target_keys)
+    matched = (rows >= 0) & (targets >= 0)
+    return batch.courier_offsets[scenario_ix * batch.epochs] + rows[matched], targets[matched]
+
+
+def rescore(traces: list, scenarios: list, cost_function=None):
+    """
+    Scores recorded decisions against scenarios in a single batched evaluation.
+    :param traces: ActionTrace of each scenario (None: all its couriers stay)
+    :param scenarios: scenarios with the same number of epochs
+    :param cost_function: see get_cost_function
+    :return: dict with the cost of each scenario ('costs'), of each epoch ('epoch_costs', scenarios x epochs)
+             and the number of decisions applied to each scenario ('matched')
+    """
+    batch = ScenarioBatch(scenarios)
+    move_cells = batch.courier_cells.copy()
+    matched = np.zeros(len(scenarios), dtype=np.int64)
+    for scenario_ix, trace in enumerate(traces):
+        if trace is not None:
+            rows, cells = trace_move_cells(batch, scenario_ix, trace)
+            move_cells[rows] = cells
+            matched[scenario_ix] = len(rows)
+    epoch_costs = batch.evaluate(move_cells, cost_function)
+    return {'costs': epoch_costs.sum(axis=1), 'epoch_costs': epoch_costs, 'matched': matched}
+
+
+def load_traces(folder: str, scenarios: list):
+    """
+    Returns the trace of each scenario in the folder (None if it has none).
+    """
+    paths = [
+        os.path.join(folder, ActionTrace.file_name(f'{scenario.label}_{scenario.index}')) for scenario in scenarios
+    ]
+    return [ActionTrace.load(path) if os.path.exists(path) else None for path in paths]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--traces', required=True, help='Folder of traces saved with --export-traces')
+    parser.add_argument('--data', default=PARAMS['input_data_path'], help='Input CSV or Parquet file')
+    parser.add_argument('--delivery-minutes', type=float, default=PARAMS['delivery_duration_seconds'] / 60,
+                        help='Delivery duration of the replayed scenarios')
+    parser.add_argument('--cost', default='distance', choices=COST_FUNCTIONS)
+    parser.add_argument('--max-distance', type=float, help='Cap of the capped cost (km)')
+    parser.add_argument('--output', help='Results table (default: <traces>/rescore.csv)')
+    args = parser.parse_args()
+
+    PARAMS['input_data_path'] = args.data
+    PARAMS['delivery_duration_seconds'] = int(round(args.delivery_minutes * 60))
+    cost_function = get_cost_function(args.cost, args.max_distance)
+    scenarios = load_scenarios()
+    rows = []
+    for split in SPLITS:
+        traces = load_traces(args.traces, scenarios[split])
+        split_scenarios = [scenario for scenario, trace in zip(scenarios[split], traces) if trace is not None]
+        traces = [trace for trace in traces if trace is not None]
+        if not traces:
+            continue
+        start = time.perf_counter()
+        result = rescore(traces, split_scenarios, cost_function)
+        seconds = time.perf_counter() - start
+        print(
+            f"Rescore: {split} ({len(traces)} scenarios) - Time: {seconds:.3f}s - "
+            f"Scenario-epochs/s: {len(traces) * split_scenarios[0].epochs / max(seconds, 1e-9):.0f}"
+        )
+        for scenario, trace, cost, matched in zip(
+                split_scenarios, traces, result['costs'].tolist(), result['matched'].tolist()):
+            perfect_cost = scenario.perfect_cost if args.cost == 'distance' else np.nan
+            rows.append({
+                'policy': trace.meta.get('policy'),
+                'scenario_label': scenario.label,
+                'scenario': scenario.index,
+                'recorded_cost': trace.meta.get('cost'),
+                'cost': round(cost, 2),
+                'perfect_cost': perfect_cost,
+                'gap': round((cost - perfect_cost) / perfect_cost, 2) if args.cost == 'distance' else np.nan,
+                'decisions': len(trace),
+                'matched': matched,
+            })
+    output = args.output or os.path.join(args.traces, 'rescore.csv')
+    write_csv(output, rows, RESCORE_FIELDS)
+    print(f"Rescored {len(rows)} traces exported to {output}")
@@ -1,177 +1,353 @@
+from functools import cached_property
 import numpy as np
 import pandas as pd
-from source.utils import haversine_distance, get_nearest_order_per_courier
+from source.bounds import PerfectSolution, perfect_information_solution
+from source.locations import LocationIndex
+from source.profiling import get_profiler
 
 DEFAULT_PRECISION = 2
 DEFAULT_DELIVERY_DURATION_SECONDS = 20 * 60
 TIME_BUCKET_SIZE = '10min'
+SECONDS_PER_DAY = 24 * 60 * 60
+EPOCH_DTYPE = np.dtype([
+    ('lat', np.float64), ('lng', np.float64), ('cell', np.int32), ('time_seconds', np.int32), ('trip', np.int32)
+])
 
 
 class Scenario:
+    """
+    One day of orders and couriers, bucketed into epochs.
+
+    Cells refer to `location_index`: the scenario's own index, built from its data, or a
+    dataset-wide one shared by many scenarios (see `build_location_index`). Either way `cells`
+    and `data_cells` are the ids of the cells the day's data covers (plus their neighbours for
+    `cells`), so that a shared index does not change what policies see of a day. The courier
+    of an order becomes available `delivery_duration_seconds` after the order starts.
+    """
+
     def __init__(
             self, index: int,
             label: str,
             data: pd.DataFrame,
             minutes_bucket_size: int,
-            precision: int = DEFAULT_PRECISION
+            precision: int = DEFAULT_PRECISION,
+            profiler=None,
+            location_index: LocationIndex = None,
+            delivery_duration_seconds: int = DEFAULT_DELIVERY_DURATION_SECONDS
             ):
+        profiler = get_profiler(profiler)
+        own_index = location_index is None
+        if not own_index and location_index.precision != precision:
+            raise ValueError(
+                f'Location index precision {location_index.precision} does not match scenario precision {precision}'
+            )
+        with profiler.stage('locations', label, index):
+            locations = get_locations(data, precision=precision)
+            if own_index:
+                location_index = LocationIndex.from_locations(locations, precision=precision)
+                cells, data_cells = None, None
+            else:
+                cells, data_cells = location_index.region(
+                    [loc['lat'] for loc in locations], [loc['lng'] for loc in locations]
+                )
+        with profiler.stage('epoch_tables', label, index):
+            order_table, courier_table = df_to_epoch_tables(
+                data, minutes_bucket_size=minutes_bucket_size, precision=precision, location_index=location_index,
+                delivery_duration_seconds=delivery_duration_seconds
+            )
+        if profiler.enabled and own_index:
+            # Otherwise computed lazily on first use
+            with profiler.stage('distances', label, index):
+                location_index.get_distances()
+        self._init_components(
+            index, label, minutes_bucket_size, precision, location_index, order_table, courier_table, cells, data_cells,
+            delivery_duration_seconds
+        )
+
+    @classmethod
+    def from_components(cls, index: int, label: str, minutes_bucket_size: int, precision: int,
+                        location_index: LocationIndex, order_table, courier_table,
+                        perfect_solution: PerfectSolution = None, cells=None, data_cells=None,
+                        delivery_duration_seconds: int = DEFAULT_DELIVERY_DURATION_SECONDS):
+        """
+        Builds a scenario from already preprocessed structures (e.g. loaded from the ScenarioCache).
+        `cells` and `data_cells` default to every cell and every data cell of the location index.
+        """
+        scenario = cls.__new__(cls)
+        scenario._init_components(
+            index, label, minutes_bucket_size, precision, location_index, order_table, courier_table, cells, data_cells,
+            delivery_duration_seconds
+        )
+        scenario._perfect_solution = perfect_solution
+        return scenario
+
+    def _init_components(self, index, label, minutes_bucket_size, precision, location_index, order_table,
+                         courier_table, cells=None, data_cells=None,
+                         delivery_duration_seconds=DEFAULT_DELIVERY_DURATION_SECONDS):
         self.index = index
         self.label = label
         self.minutes_bucket_size = minutes_bucket_size
-        self.orders = orders_df_to_bucket_list(
-            data, time_bucket_size=str(self.minutes_bucket_size) + "min", precision=precision
-        )
-        self.couriers = couriers_df_to_bucket_list(
-            data, time_bucket_size=str(self.minutes_bucket_size) + "min", precision=precision
-        )
-        self.epochs = len(self.orders)
+        self.delivery_duration_seconds = delivery_duration_seconds
         self.precision = precision
-        self.data_locations = get_locations(data, precision=self.precision)
+        self.location_index = location_index
+        self.cells = np.arange(len(location_index)) if cells is None else np.asarray(cells, dtype=np.int64)
+        self.data_cells = (
+            np.flatnonzero(location_index.is_data) if data_cells is None else np.asarray(data_cells, dtype=np.int64)
+        )
+        self.neighbours = self.location_index.neighbours
         self.neighbours_map = self.get_neighbours_map()
-        self.locations = self.get_all_locations()
         self.distance_map = self.get_distance_map()
-        self.perfect_cost, _ = self.get_perfect_solution()
+        self.order_table, self.courier_table = order_table, courier_table
+        self.epochs = len(self.order_table)
+        self._perfect_solution = None
 
     @classmethod
-    def generate_scenarios(cls, label: str, data: pd.DataFrame, minutes_bucket_size: int):
+    def generate_scenarios(cls, label: str, data: pd.DataFrame, minutes_bucket_size: int,
+                           precision: int = DEFAULT_PRECISION, location_index: LocationIndex = None,
+                           delivery_duration_seconds: int = DEFAULT_DELIVERY_DURATION_SECONDS):
         unique_dates = np.sort(data.start_date.unique())
-        return [Scenario(i, label, data[lambda x: x.start_date == date], minutes_bucket_size) for i, date in enumerate(unique_dates)]
+        days = ((date, data[lambda x: x.start_date == date]) for date in unique_dates)
+        return list(cls.iter_scenarios(
+            label, days, minutes_bucket_size, precision=precision, location_index=location_index,
+            delivery_duration_seconds=delivery_duration_seconds
+        ))
+
+    @classmethod
+    def iter_scenarios(cls, label: str, days, minutes_bucket_size: int, precision: int = DEFAULT_PRECISION,
+                       profiler=None, location_index: LocationIndex = None,
+                       delivery_duration_seconds: int = DEFAULT_DELIVERY_DURATION_SECONDS):
+        """
+        Builds scenarios lazily from an iterable of (date, day data), e.g. `utils.iter_daily_data`.
+        All of them share `location_index` if given.
+        """
+        for i, (_, day) in enumerate(days):
+            yield Scenario(
+                i, label, day, minutes_bucket_size, precision=precision, profiler=profiler,
+                location_index=location_index, delivery_duration_seconds=delivery_duration_seconds
+            )
+
+    @property
+    def distance_matrix(self):
+        return self.location_index.distances
+
+    @cached_property
+    def orders(self):
+        """
+        List of dicts per epoch, kept for backward compatibility (built on first access).
+        """
+        return self.order_table.to_bucket_list()
+
+    @cached_property
+    def couriers(self):
+        return self.courier_table.to_bucket_list()
 
     def get_orders(self, epoch):
-        return self.orders[epoch] if epoch >= 0 else None
+        return self.order_table[epoch] if epoch >= 0 else None
 
     def get_couriers(self, epoch):
-        return self.couriers[epoch]
+        return self.courier_table[epoch]
 
     def get_neighbours_map(self):
         """
         Returns a map of neighbours for each location.
-        :return: dict of dicts {source: [destinations]}
+        Backward compatible view over `self.neighbours`, the (locations x 9) array of cell ids.
+        :return: mapping {source: [destinations]}
         """
-        return {
-            (loc['lat'], loc['lng']): get_location_neighbours(loc['lat'], loc['lng'], self.precision)
-            for loc in self.data_locations
-        }
+        return self.location_index.neighbours_map
 
-    def get_all_locations(self):
-        neighbours_locations = [
-            {'lat': loc[0], 'lng': loc[1]}
-            for locations in list(self.neighbours_map.values())
-            for loc in locations
-        ]
+    @cached_property
+    def data_locations(self):
+        """
+        Records of the data cells, built on first access.
+        """
+        return self.location_index.records(cells=self.data_cells)
 
-        locations = pd.DataFrame(
-            self.data_locations + neighbours_locations,
-            columns=["lat", "lng"]
-        ).drop_duplicates()
+    @cached_property
+    def locations(self):
+        return self.get_all_locations()
 
-        return locations.to_dict(orient="records")
+    def get_all_locations(self):
+        return self.location_index.records(cells=self.cells)
 
     def get_distance_map(self):
         """
         Returns a map of distances between locations.
-        :return: dict of dicts {source: {destination: distance}}
+        Backward compatible view over `self.distance_matrix`, indexed by `self.location_index` cell ids.
+        :return: mapping {source: {destination: distance}}
         """
-        location_df = pd.DataFrame(self.locations, columns=["lat", "lng"])
+        return self.location_index.distance_map
+
+    @property
+    def has_perfect_solution(self):
+        return self._perfect_solution is not None
 
-        distance_df = (
-            location_df
-            .merge(location_df, how='cross')
-            .assign(
-                source=lambda x: list(zip(x.lat_x, x.lng_x)),
-                target=lambda x: list(zip(x.lat_y, x.lng_y)),
-                distance=lambda x: haversine_distance(x.lat_x, x.lng_x, x.lat_y, x.lng_y)
+    @property
+    def perfect_solution(self):
+        """
+        Perfect-information solution, computed on first access and memoized.
+        """
+        if self._perfect_solution is None:
+            self._perfect_solution = perfect_information_solution(
+                self.order_table, self.courier_table, self.location_index
             )
-            [["source", "target", "distance"]]
-            .pivot(index="source", columns="target", values="distance")
-        )
-        return distance_df.to_dict(orient='index')
+            print(
+                f"Policy: Perfect information - "
+                f"Scenario: {self.index} - "
+                f"Execution time: - - "
+                f"Cost: {self.perfect_cost:.1f} - "
+                f"Perfect cost: {self.perfect_cost:.1f} - "
+                f"Matched reference cost: {self.matched_reference_cost:.1f} - "
+                f"Gap: 0%"
+            )
+        return self._perfect_solution
+
+    @perfect_solution.setter
+    def perfect_solution(self, solution: PerfectSolution):
+        self._perfect_solution = solution
+
+    @property
+    def perfect_cost(self):
+        return self.perfect_solution.cost
+
+    @property
+    def matched_reference_cost(self):
+        """
+        Perfect-information cost when every order goes to at most one courier (bounds.matched_assignment).
+        Not a bound on policy costs, see perfect_cost for that.
+        """
+        return self.perfect_solution.matched_cost
 
     def get_perfect_solution(self):
         """
         Returns the perfect cost and solution for the scenario.
-        :return:
-        """
-        best_decisions = dict()
-        perfect_cost = 0
-        for epoch in range(self.epochs):
-            best_decisions[epoch] = dict()
-            orders = self.get_orders(epoch)
-            couriers = self.get_couriers(epoch)
-            if orders is None or couriers is None:
-                continue
-            best_decisions[epoch]['actions'] = get_nearest_order_per_courier(
-                orders, couriers, self.distance_map, self.neighbours_map
-            )
-            best_decisions[epoch]['cost'] = sum(v['move_distance'] for k, v in best_decisions[epoch]['actions'].items())
-            perfect_cost += best_decisions[epoch]['cost']
-            if False:
-                print(f"Scenario: {self.index} - Epoch: {epoch} - Cost: {best_decisions[epoch]['cost']}")
-        print(
-            f"Policy: Perfect information - "
-            f"Scenario: {self.index} - "
-            f"Execution time: - - "
-            f"Cost: {perfect_cost:.1f} - "
-            f"Perfect cost: {perfect_cost:.1f} - "
-            f"Gap: 0%"
-        )
-        return perfect_cost, best_decisions
+        :return: tuple (perfect cost, {epoch: {'actions': ..., 'cost': ...}})
+        """
+        return self.perfect_cost, self.perfect_solution.decisions(self.courier_table, self.location_index)
 
 
-def orders_df_to_bucket_list(data: pd.DataFrame, time_bucket_size: str, precision: int):
-    num_epochs = 24 * 60 // int(time_bucket_size[:-3])
-    orders_per_epoch = [None] * num_epochs
-    orders = (
-        data
-        .rename(columns={"start_lat": "lat", "start_lng": "lng"})
-        .sort_values(by="time_seconds")
-        .reset_index(drop=True)
-        .assign(
-                floor_startdatetime=lambda x: x.start_time.dt.floor(time_bucket_size),
-                floor_time_seconds=lambda x: (
-                        (x.floor_startdatetime - x.floor_startdatetime.dt.normalize())/pd.Timedelta('1 second')
-                ).astype(int),
-                epoch=lambda x: (x.floor_time_seconds/60 // int(time_bucket_size[:-3])).astype(int),
-                lat=lambda x: x.lat.round(precision),
-                lng=lambda x: x.lng.round(precision)
-        )
-        .drop(columns=["floor_startdatetime", "floor_time_seconds"])
-        .groupby('epoch')
-    )
-    for epoch in orders.groups.keys():
-        orders_per_epoch[epoch] = list(orders.get_group(epoch).to_dict(orient="index").values())
+class EpochTable:
+    """
+    Columnar storage of the orders (or couriers) of a scenario.
+    Rows are a structured array (see EPOCH_DTYPE) sorted by epoch and time, and the
+    CSR `offsets` delimit the rows of each epoch: rows[offsets[t]:offsets[t + 1]].
+    """
+
+    def __init__(self, rows: np.ndarray, offsets: np.ndarray):
+        self.rows = rows
+        self.offsets = offsets
 
-    return orders_per_epoch
+    @classmethod
+    def from_arrays(cls, lat, lng, time_seconds, epoch, num_epochs: int, precision: int,
+                    location_index: LocationIndex = None):
+        lat = np.round(np.asarray(lat, dtype=float), precision)
+        lng = np.round(np.asarray(lng, dtype=float), precision)
+        epoch = np.asarray(epoch, dtype=np.int64)
+        time_seconds = np.asarray(time_seconds, dtype=np.int64)
+        order = np.lexsort((time_seconds, epoch))
+        rows = np.empty(len(order), dtype=EPOCH_DTYPE)
+        rows['lat'] = lat[order]
+        rows['lng'] = lng[order]
+        rows['cell'] = location_index.lookup(rows['lat'], rows['lng']) if location_index is not None else -1
+        rows['time_seconds'] = time_seconds[order]
+        rows['trip'] = order
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(epoch, minlength=num_epochs))])
+        return cls(rows, offsets)
 
+    def __len__(self):
+        return len(self.offsets) - 1
 
-def couriers_df_to_bucket_list(data: pd.DataFrame, time_bucket_size: str, precision: int):
-    num_epochs = 24 * 60 // int(time_bucket_size[:-3])
-    couriers_per_epoch = [None] * num_epochs
-    couriers = (
-        data
-        .drop(columns=["start_lat", "start_lng"])
-        .rename(columns={"end_lat": "lat", "end_lng": "lng"})
-        .assign(start_time=lambda x: x.start_time + pd.Timedelta(DEFAULT_DELIVERY_DURATION_SECONDS, "seconds"),
-                time_seconds=lambda x: x.time_seconds + DEFAULT_DELIVERY_DURATION_SECONDS
-                )
-        .sort_values(by="time_seconds")
-        .reset_index(drop=True)
-        .assign(
-                floor_startdatetime=lambda x: x.start_time.dt.floor(time_bucket_size),
-                floor_time_seconds=lambda x: (
-                    (x.floor_startdatetime - x.floor_startdatetime.dt.normalize()) / pd.Timedelta('1 second')
-                ).astype(int),
-                epoch=lambda x: (x.floor_time_seconds / 60 // int(time_bucket_size[:-3])).astype(int),
-                lat=lambda x: x.lat.round(precision),
-                lng=lambda x: x.lng.round(precision)
-        )
-        .drop(columns=["floor_startdatetime", "floor_time_seconds"])
-        .groupby('epoch')
+    def __getitem__(self, epoch):
+        """
+        Returns a zero-copy slice with the rows of an epoch (None if it is empty).
+        """
+        start, end = self.offsets[epoch], self.offsets[epoch + 1]
+        return self.rows[start:end] if end > start else None
+
+    @property
+    def epoch(self):
+        return np.repeat(np.arange(len(self)), np.diff(self.offsets))
+
+    def records(self, epoch):
+        rows = self[epoch]
+        if rows is None:
+            return None
+        return [dict(record, epoch=epoch) for record in pd.DataFrame(rows).to_dict(orient='records')]
+
+    def to_bucket_list(self):
+        return [self.records(epoch) for epoch in range(len(self))]
+
+
+def get_bucket_seconds(minutes_bucket_size: float):
+    """
+    Returns the length of an epoch in whole seconds (fractional minutes allow sub-minute epochs, e.g. 0.5).
+    """
+    bucket_seconds = int(round(minutes_bucket_size * 60))
+    if bucket_seconds <= 0:
+        raise ValueError('Bucket size must be at least one second: {}'.format(minutes_bucket_size))
+    return bucket_seconds
+
+
+def get_num_epochs(minutes_bucket_size: float):
+    return -(-SECONDS_PER_DAY // get_bucket_seconds(minutes_bucket_size))
+
+
+def df_to_epoch_tables(data: pd.DataFrame, minutes_bucket_size: float, precision: int,
+                       location_index: LocationIndex = None,
+                       delivery_duration_seconds: int = DEFAULT_DELIVERY_DURATION_SECONDS):
+    """
+    Builds the orders and couriers EpochTables of a scenario in a single pass over the data.
+    Couriers become available `delivery_duration_seconds` after the order starts;
+    availabilities after midnight wrap to the first epochs of the day.
+    :return: tuple (orders, couriers)
+    """
+    bucket_seconds = get_bucket_seconds(minutes_bucket_size)
+    num_epochs = get_num_epochs(minutes_bucket_size)
+    time_seconds = data.time_seconds.to_numpy(dtype=np.int64)
+    courier_time_seconds = time_seconds + delivery_duration_seconds
+    orders = EpochTable.from_arrays(
+        data.start_lat.to_numpy(), data.start_lng.to_numpy(), time_seconds,
+        epoch=time_seconds // bucket_seconds, num_epochs=num_epochs,
+        precision=precision, location_index=location_index
+    )
+    couriers = EpochTable.from_arrays(
+        data.end_lat.to_numpy(), data.end_lng.to_numpy(), courier_time_seconds,
+        epoch=courier_time_seconds % SECONDS_PER_DAY // bucket_seconds, num_epochs=num_epochs,
+        precision=precision, location_index=location_index
     )
-    for epoch in couriers.groups.keys():
-        couriers_per_epoch[epoch] = list(couriers.get_group(epoch).to_dict(orient="index").values())
+    return orders, couriers
 
-    return couriers_per_epoch
+
+def orders_df_to_bucket_list(data: pd.DataFrame, time_bucket_size: str, precision: int,
+                             location_index: LocationIndex = None):
+    orders, _ = df_to_epoch_tables(data, int(time_bucket_size[:-3]), precision, location_index)
+    return orders.to_bucket_list()
+
+
+def couriers_df_to_bucket_list(data: pd.DataFrame, time_bucket_size: str, precision: int,
+                               location_index: LocationIndex = None):
+    _, couriers = df_to_epoch_tables(data, int(time_bucket_size[:-3]), precision, location_index)
+    return couriers.to_bucket_list()
+
+
+def build_location_index(days, precision: int):
+    """
+    Builds the dataset-wide LocationIndex of an iterable of (date, day data), e.g. `utils.iter_daily_data`,
+    for scenarios to share. Only the distinct cells of each day are kept while iterating.
+    :return: LocationIndex
+    """
+    scale = 10 ** precision
+    keys = np.empty(0, dtype=np.int64)
+    for _, day in days:
+        day_keys = [
+            LocationIndex.cell_keys(
+                np.rint(day[f'{prefix}_lat'].round(precision).to_numpy(dtype=float) * scale),
+                np.rint(day[f'{prefix}_lng'].round(precision).to_numpy(dtype=float) * scale)
+            )
+            for prefix in ['start', 'end']
+        ]
+        keys = np.unique(np.concatenate([keys, *day_keys]))
+    lats, lngs = LocationIndex.key_coordinates(keys, precision)
+    return LocationIndex.from_coordinates(lats, lngs, precision)
 
 
 def get_locations(data: pd.DataFrame, precision: int):
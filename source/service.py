@@ -0,0 +1,423 @@
+"""
+Online repositioning service.
+
+Serves repositioning decisions over JSON lines on a TCP socket while orders arrive:
+
+    python -m source.service serve --data data/robotex5.csv --policy vfa --vfa models/robotex5/vfa
+    python -m source.service replay --data data/robotex5.csv --date 2022-03-05 --speed 60
+
+Messages (one JSON object per line, `id` is echoed back in the reply):
+* {"type": "order", "lat", "lng", "time_seconds"[, "date"]}: an order arose.
+* {"type": "take_action", "id", "time_seconds", "couriers": [{"lat", "lng"}][, "date"]}:
+  replies {"type": "actions", "id", "epoch", "actions": [{"lat", "lng"}], "degraded", "latency_ms"}.
+* {"type": "stats", "id"[, "end_day": true]}: replies the service counters and the cost of the
+  scored epochs (with `end_day`, every pending action is scored first).
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+from itertools import count, groupby
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from source.locations import LocationIndex
+from source.profiling import get_profiler
+from source.scenario import EPOCH_DTYPE, SECONDS_PER_DAY, Scenario, get_bucket_seconds, get_locations, get_num_epochs
+from source.state import State
+from source.utils import get_cells, load_data
+from source.policies.do_nothing import DoNothing
+from source.policies.last_nearest_order import LastNearestOrder
+from source.policies.vfa import VFA
+from source.policies.hierarchical_vfa import HierarchicalVFA
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+DEFAULT_LATENCY_BUDGET_MS = 50
+DEFAULT_BATCH_WINDOW_MS = 2
+MAX_BATCH_COURIERS = 10000
+
+
+class OnlineState(State):
+    """
+    State fed by events instead of a prebuilt Scenario; unlike State, it is updated in place.
+
+    Orders are buffered per epoch as they arrive. Moving to epoch t exposes the orders of
+    epoch t-1 (like State.update) and scores the actions taken in each closed epoch against
+    that epoch's orders, so a replayed day costs the same as Policy.train over it.
+    """
+
+    def __init__(self, location_index: LocationIndex, minutes_bucket_size: int, order_index_kind: str = 'grid'):
+        self.scenario = None
+        self.location_index = location_index
+        self.bucket_seconds = get_bucket_seconds(minutes_bucket_size)
+        self.num_epochs = get_num_epochs(minutes_bucket_size)
+        self.order_index_kind = order_index_kind
+        self.profiler = get_profiler()
+        self.prev_actions = dict()
+        self.date = None
+        self.cost = 0.0
+        self.late_orders = 0
+        self.unknown_locations = 0
+        self.reset()
+
+    @property
+    def cells(self):
+        return np.arange(len(self.location_index))
+
+    @property
+    def data_cells(self):
+        return np.flatnonzero(self.location_index.is_data)
+
+    def reset(self, date=None):
+        self.date = date
+        self.epoch = 0
+        self.orders = None
+        self.couriers = None
+        self._order_index = None
+        self._pending_orders = {}
+        self._actions = []
+
+    def epoch_of(self, time_seconds):
+        return int(time_seconds) % SECONDS_PER_DAY // self.bucket_seconds
+
+    def start_day(self, date):
+        """
+        Scores the rest of the current day and starts `date` if it is a new one.
+        """
+        if date is not None and date != self.date:
+            if self.date is not None:
+                self.advance(self.num_epochs)
+            self.reset(date)
+
+    def add_order(self, lat, lng, time_seconds, date=None):
+        self.start_day(date)
+        epoch = self.epoch_of(time_seconds)
+        if epoch < self.epoch:
+            self.late_orders += 1
+            return
+        self._pending_orders.setdefault(epoch, []).append((lat, lng, time_seconds))
+
+    def advance(self, epoch: int):
+        """
+        Moves to `epoch`, closing (and scoring) every epoch before it.
+        """
+        while self.epoch < epoch:
+            self.orders = self.epoch_rows(self._pending_orders.pop(self.epoch, []))
+            self._order_index = None
+            if self._actions:
+                self.cost += float(self.evaluate_action_cells(np.concatenate(self._actions))[0])
+                self._actions = []
+            self.epoch += 1
+
+    def epoch_rows(self, records):
+        """
+        Returns (lat, lng, time_seconds) records as EPOCH_DTYPE rows, None if there are none.
+        Locations outside the location index are dropped.
+        """
+        if not records:
+            return None
+        lat, lng, time_seconds = (np.asarray(column) for column in zip(*records))
+        rows = np.empty(len(records), dtype=EPOCH_DTYPE)
+        rows['lat'] = np.round(lat.astype(float), self.location_index.precision)
+        rows['lng'] = np.round(lng.astype(float), self.location_index.precision)
+        rows['cell'] = self.location_index.lookup(rows['lat'], rows['lng'])
+        rows['time_seconds'] = time_seconds
+        rows['trip'] = np.arange(len(records))
+        known = rows['cell'] >= 0
+        self.unknown_locations += int((~known).sum())
+        return rows[known] if known.any() else None
+
+    def decide(self, policy, epoch: int, requests: list):
+        """
+        Takes one vectorized decision for the couriers of several requests of the same epoch.
+        :param policy: Policy
+        :param epoch: epoch of the requests
+        :param requests: list of courier lists [{'lat', 'lng'}]
+        :return: list with the target cell of each courier of each request
+        """
+        self.advance(epoch)
+        couriers = [(c['lat'], c['lng'], epoch * self.bucket_seconds) for request in requests for c in request]
+        rows = self.epoch_rows(couriers)
+        cells = self.location_index.lookup([c[0] for c in couriers], [c[1] for c in couriers])
+        targets = cells.copy()
+        if rows is not None:
+            self.couriers = rows
+            actions = policy.take_action(self)
+            targets[cells >= 0] = get_cells((actions[j] for j in range(len(rows))), self.location_index)
+        return np.split(targets, np.cumsum([len(request) for request in requests])[:-1])
+
+    def record_actions(self, epoch: int, cells):
+        """
+        Keeps the target cells returned for `epoch` to be scored once the epoch closes.
+        """
+        self.advance(epoch)
+        if epoch == self.epoch:
+            cells = np.asarray(cells, dtype=np.int64)
+            self._actions.append(cells[cells >= 0])
+
+
+class DecisionService:
+    """
+    asyncio JSON-lines server around an OnlineState and a (frozen) policy.
+
+    State changes and decisions run one at a time on a single worker thread, in arrival order,
+    so the event loop keeps accepting requests while a decision is computed. take_action
+    requests arriving within `batch_window_ms` of each other are answered by a single
+    policy call, and a request not answered within `latency_budget_ms` gets a stay-put
+    fallback flagged as degraded.
+    """
+
+    def __init__(self, policy, location_index: LocationIndex, minutes_bucket_size: int,
+                 latency_budget_ms: float = DEFAULT_LATENCY_BUDGET_MS,
+                 batch_window_ms: float = DEFAULT_BATCH_WINDOW_MS):
+        self.policy = policy
+        self.state = OnlineState(location_index, minutes_bucket_size, order_index_kind=policy.order_index_kind)
+        self.latency_budget = latency_budget_ms / 1000
+        self.batch_window = batch_window_ms / 1000
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+        self.counters = {'orders': 0, 'requests': 0, 'batches': 0, 'degraded': 0}
+
+    def run_in_state(self, fn, *args):
+        return asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def serve(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT):
+        self.queue = asyncio.Queue()
+        batcher = asyncio.create_task(self.batch_requests())
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"Decision service - Policy: {self.policy.name} - Listening on {host}:{port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+            self.executor.shutdown()
+
+    async def handle_connection(self, reader, writer):
+        lock = asyncio.Lock()
+        tasks = set()
+
+        async def reply(awaitable):
+            response = await awaitable
+            async with lock:
+                writer.write((json.dumps(response) + '\n').encode())
+                await writer.drain()
+
+        while line := await reader.readline():
+            message = json.loads(line)
+            # Dispatched in arrival order; only the replies are awaited concurrently
+            response = self.dispatch(message)
+            if response is not None:
+                task = asyncio.create_task(reply(response))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+        writer.close()
+
+    def dispatch(self, message: dict):
+        kind = message.get('type')
+        if kind == 'order':
+            self.counters['orders'] += 1
+            self.run_in_state(
+                self.state.add_order, message['lat'], message['lng'], message['time_seconds'], message.get('date')
+            )
+            return None
+        if kind == 'take_action':
+            return self.take_action(message)
+        if kind == 'stats':
+            return self.stats(message)
+        raise ValueError('Unknown message type: {}'.format(kind))
+
+    async def take_action(self, message: dict):
+        start = time.perf_counter()
+        couriers = message['couriers']
+        if 'date' in message:
+            self.run_in_state(self.state.start_day, message['date'])
+        epoch = self.state.epoch_of(message['time_seconds'])
+        self.counters['requests'] += 1
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((epoch, couriers, future))
+        try:
+            cells = await asyncio.wait_for(asyncio.shield(future), timeout=self.latency_budget)
+            degraded = False
+        except asyncio.TimeoutError:
+            cells = self.state.location_index.lookup([c['lat'] for c in couriers], [c['lng'] for c in couriers])
+            degraded = True
+            self.counters['degraded'] += 1
+        self.run_in_state(self.state.record_actions, epoch, cells)
+        actions = [
+            {'lat': c['lat'], 'lng': c['lng']} if cell < 0 else dict(zip(('lat', 'lng'), self.state.location_index.location(cell)))
+            for c, cell in zip(couriers, cells.tolist())
+        ]
+        return {
+            'type': 'actions', 'id': message.get('id'), 'epoch': epoch, 'actions': actions,
+            'degraded': degraded, 'latency_ms': (time.perf_counter() - start) * 1e3,
+        }
+
+    async def batch_requests(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.batch_window
+            num_couriers = len(batch[0][1])
+            while num_couriers < MAX_BATCH_COURIERS:
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout=max(deadline - loop.time(), 0)))
+                except asyncio.TimeoutError:
+                    break
+                num_couriers += len(batch[-1][1])
+            for epoch, group in groupby(batch, key=lambda request: request[0]):
+                group = list(group)
+                self.counters['batches'] += 1
+                try:
+                    targets = await self.run_in_state(
+                        self.state.decide, self.policy, epoch, [couriers for _, couriers, _ in group]
+                    )
+                except Exception as e:
+                    for _, _, future in group:
+                        future.set_exception(e)
+                    continue
+                for (_, _, future), cells in zip(group, targets):
+                    if not future.cancelled():
+                        future.set_result(cells)
+
+    async def stats(self, message: dict):
+        if message.get('end_day'):
+            await self.run_in_state(self.state.advance, self.state.num_epochs)
+        # Wait for the events already dispatched
+        await self.run_in_state(lambda: None)
+        return {
+            'type': 'stats', 'id': message.get('id'), 'date': self.state.date, 'epoch': self.state.epoch,
+            'cost': round(self.state.cost, 2), 'late_orders': self.state.late_orders,
+            'unknown_locations': self.state.unknown_locations, **self.counters,
+        }
+
+
+async def replay(scenario: Scenario, date: str, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT,
+                 speed: float = 0, split: int = 1):
+    """
+    Feeds a historical day to the service as timed events and reports the decision latencies.
+    :param scenario: Scenario of the day
+    :param date: date sent with the events (starts a new day in the service)
+    :param speed: simulated seconds per wall-clock second (0 sends events as fast as possible)
+    :param split: number of concurrent take_action requests each epoch's couriers are split into
+    :return: dict with the service stats and the latency percentiles (ms)
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    pending, latencies, ids = {}, [], count()
+
+    async def read_replies():
+        while line := await reader.readline():
+            response = json.loads(line)
+            future = pending.pop(response['id'], None)
+            if future is not None:
+                future.set_result(response)
+
+    def send(message: dict):
+        writer.write((json.dumps(message) + '\n').encode())
+
+    async def request(message: dict):
+        message['id'] = next(ids)
+        future = asyncio.get_running_loop().create_future()
+        pending[message['id']] = future
+        start = time.perf_counter()
+        send(message)
+        await writer.drain()
+        response = await future
+        latencies.append((time.perf_counter() - start) * 1e3)
+        return response
+
+    replies = asyncio.create_task(read_replies())
+    bucket_seconds = get_bucket_seconds(scenario.minutes_bucket_size)
+    wall_start = time.perf_counter()
+    decisions = []
+    for epoch in range(scenario.epochs):
+        if speed > 0:
+            await asyncio.sleep(max(epoch * bucket_seconds / speed - (time.perf_counter() - wall_start), 0))
+        couriers = scenario.get_couriers(epoch)
+        if couriers is not None:
+            couriers = [{'lat': float(c['lat']), 'lng': float(c['lng'])} for c in couriers]
+            decisions += [asyncio.create_task(request({
+                'type': 'take_action', 'time_seconds': epoch * bucket_seconds, 'date': date, 'couriers': part.tolist()
+            })) for part in np.array_split(np.array(couriers, dtype=object), split) if len(part)]
+            # Couriers of the epoch are decided before its orders arrive
+            await asyncio.gather(*decisions)
+            decisions = []
+        orders = scenario.get_orders(epoch)
+        for order in [] if orders is None else orders:
+            if speed > 0:
+                await asyncio.sleep(max(order['time_seconds'] / speed - (time.perf_counter() - wall_start), 0))
+            send({'type': 'order', 'lat': float(order['lat']), 'lng': float(order['lng']),
+                  'time_seconds': int(order['time_seconds']), 'date': date})
+        await writer.drain()
+    stats = await request({'type': 'stats', 'end_day': True})
+    latencies.pop()
+    replies.cancel()
+    writer.close()
+    latencies = np.array(latencies)
+    return {
+        **stats,
+        'perfect_cost': round(scenario.perfect_cost, 2),
+        'latency_ms_p50': float(np.percentile(latencies, 50)) if len(latencies) else None,
+        'latency_ms_p95': float(np.percentile(latencies, 95)) if len(latencies) else None,
+        'latency_ms_max': float(latencies.max()) if len(latencies) else None,
+    }
+
+
+def get_policy(name: str, vfa_path: str = None, **kwargs):
+    if name == 'last_nearest_order':
+        return LastNearestOrder(**kwargs)
+    elif name == 'do_nothing':
+        return DoNothing(**kwargs)
+    elif name == 'vfa':
+        if vfa_path is None:
+            raise ValueError('A trained VFA (--vfa) is required')
+        if os.path.isdir(vfa_path):
+            return VFA.load(vfa_path, **kwargs).freeze()
+        return VFA.load_json(vfa_path, **kwargs).freeze()
+    elif name == 'hvfa':
+        if vfa_path is None:
+            raise ValueError('A trained hierarchical VFA checkpoint (--vfa) is required')
+        return HierarchicalVFA.load(vfa_path, **kwargs).freeze()
+    else:
+        raise ValueError('Unknown policy: {}'.format(name))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['serve', 'replay'])
+    parser.add_argument('--data', required=True, help='Historical data: service area (serve) or day to replay')
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--minutes-bucket-size', type=float, default=10)
+    parser.add_argument('--precision', type=int, default=2)
+    parser.add_argument('--policy', default='vfa', help='serve: policy name')
+    parser.add_argument('--vfa', help='serve: VFA checkpoint folder (or JSON export)')
+    parser.add_argument('--latency-budget-ms', type=float, default=DEFAULT_LATENCY_BUDGET_MS)
+    parser.add_argument('--batch-window-ms', type=float, default=DEFAULT_BATCH_WINDOW_MS)
+    parser.add_argument('--date', help='replay: day to replay (default: last day of the data)')
+    parser.add_argument('--speed', type=float, default=0, help='replay: simulated seconds per second (0: no pacing)')
+    parser.add_argument('--split', type=int, default=1, help='replay: concurrent requests per epoch')
+    args = parser.parse_args()
+
+    data = load_data(args.data)
+    if args.command == 'serve':
+        locations = get_locations(data, precision=args.precision)
+        service = DecisionService(
+            get_policy(args.policy, args.vfa, minutes_bucket_size=args.minutes_bucket_size, precision=args.precision),
+            LocationIndex.from_locations(locations, precision=args.precision),
+            args.minutes_bucket_size,
+            latency_budget_ms=args.latency_budget_ms,
+            batch_window_ms=args.batch_window_ms,
+        )
+        try:
+            asyncio.run(service.serve(args.host, args.port))
+        except KeyboardInterrupt:
+            sys.exit(0)
+    else:
+        date = str(args.date or max(data.start_date))
+        day = data[data.start_date.astype(str) == date]
+        scenario = Scenario(0, 'replay', day, args.minutes_bucket_size, precision=args.precision)
+        print(json.dumps(asyncio.run(replay(scenario, date, args.host, args.port, args.speed, args.split)), indent=2))
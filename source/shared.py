@@ -0,0 +1,43 @@
+from multiprocessing import shared_memory
+import numpy as np
+
+
+class SharedArray:
+    """
+    NumPy array held in multiprocessing shared memory.
+
+    Pickling only sends the segment name, shape and dtype, so worker processes attach
+    to the same buffer instead of receiving a copy. The process that created the array
+    owns the segment and must `unlink` it once workers are done.
+    """
+
+    def __init__(self, array: np.ndarray, readonly: bool = True):
+        array = np.asarray(array)
+        self.readonly = readonly
+        self.shape, self.dtype = array.shape, array.dtype
+        self._shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.name = self._shm.name
+        self.owner = True
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self._shm.buf)
+        self.array[...] = array
+
+    def __getstate__(self):
+        return {'name': self.name, 'shape': self.shape, 'dtype': self.dtype.str, 'readonly': self.readonly}
+
+    def __setstate__(self, state):
+        self.name, self.shape, self.dtype = state['name'], state['shape'], np.dtype(state['dtype'])
+        self.readonly = state['readonly']
+        # Workers share the creator's resource tracker, so attaching does not take ownership
+        self._shm = shared_memory.SharedMemory(name=self.name)
+        self.owner = False
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self._shm.buf)
+        self.array.flags.writeable = not self.readonly
+
+    def close(self):
+        self.array = None
+        self._shm.close()
+
+    def unlink(self):
+        self.close()
+        if self.owner:
+            self._shm.unlink()
@@ -0,0 +1,383 @@
+import numpy as np
+
+from source.locations import DISTANCE_DTYPE, LocationIndex
+from source.utils import haversine_distance
+
+EARTH_RADIUS_KM = 6367
+KM_PER_DEGREE = EARTH_RADIUS_KM * np.pi / 180
+DENSE_MAX_PAIRS = 1 << 16
+POINTS_PER_BUCKET = 4
+MAX_RADIUS_DOUBLINGS = 4
+MAX_PAIRS_PER_CHUNK = 1 << 22
+# Largest raster (cells of the bounding box of queries and seeds) of distance_transform
+MAX_FIELD_PIXELS = 1 << 22
+
+
+class OrderIndex:
+    """
+    Nearest-neighbour index over the orders of an epoch.
+
+    Orders are grouped by cell ("points") in order of first appearance so that ties
+    resolve to the lowest order position, like a linear scan over the orders would.
+    Queries are cell ids of the LocationIndex and distances come from its matrix.
+    Subclasses only decide which (query, point) pairs are candidates for a radius.
+    """
+
+    def __init__(self, location_index: LocationIndex, order_cells):
+        self.location_index = location_index
+        self.order_cells = np.asarray(order_cells, dtype=np.int64)
+        cells, first, inverse = np.unique(self.order_cells, return_index=True, return_inverse=True)
+        by_first = np.argsort(first)
+        rank = np.empty_like(by_first)
+        rank[by_first] = np.arange(len(by_first))
+        self.point_cells = cells[by_first]
+        self.point_of_order = rank[inverse.ravel()]
+        # CSR: orders of each point, in order position
+        self.point_orders = np.argsort(self.point_of_order, kind='stable')
+        self.point_offsets = np.concatenate(
+            [[0], np.cumsum(np.bincount(self.point_of_order, minlength=len(self.point_cells)))]
+        )
+
+    def __len__(self):
+        return len(self.order_cells)
+
+    def nearest(self, query_cells, max_distance: float = None):
+        """
+        Returns the nearest order of each query cell.
+        :param query_cells: cell ids
+        :param max_distance: optional search radius (km). Queries without orders within it get -1 / inf.
+        :return: tuple (order positions, distances)
+        """
+        query_cells = np.asarray(query_cells, dtype=np.int64)
+        if not len(self.point_cells) or (
+                max_distance is None and len(query_cells) * len(self.point_cells) <= DENSE_MAX_PAIRS):
+            return self._dense_nearest(query_cells)
+        queries, points, distances = self._candidates(query_cells, max_distance)
+        point_ix, best = self._reduce_nearest(len(query_cells), queries, points, distances)
+        order_ix = np.where(point_ix >= 0, self.point_orders[self.point_offsets[point_ix.clip(min=0)]], -1)
+        return order_ix, best
+
+    def field(self, query_cells, max_distance: float = None):
+        """
+        Nearest order of many query cells at once (e.g. every cell of a scenario) with distance_transform,
+        whose cost grows with the cells of the bounding box rather than with queries x orders. Falls back
+        to `nearest` when the box is larger than MAX_FIELD_PIXELS.
+        :return: tuple (order positions, distances), like `nearest`
+        """
+        query_cells = np.asarray(query_cells, dtype=np.int64)
+        result = distance_transform(self.location_index, self.point_cells, query_cells) if len(self) else None
+        if result is None:
+            return self.nearest(query_cells, max_distance)
+        point_ix, distances = result
+        order_ix = self.point_orders[self.point_offsets[point_ix]]
+        if max_distance is not None:
+            beyond = distances > max_distance
+            order_ix[beyond] = -1
+            distances[beyond] = np.inf
+        return order_ix, distances
+
+    def k_nearest(self, query_cells, k: int, max_distance: float = None):
+        """
+        Returns the k nearest orders of each query cell, sorted by distance.
+        :param query_cells: cell ids
+        :param k: number of orders per query
+        :param max_distance: optional search radius (km)
+        :return: tuple (order positions (n, k) padded with -1, distances (n, k) padded with inf)
+        """
+        query_cells = np.asarray(query_cells, dtype=np.int64)
+        queries, orders, distances = self._expand(*self._candidates(query_cells, max_distance, k=k))
+        order = np.lexsort((orders, distances, queries))
+        queries, orders, distances = queries[order], orders[order], distances[order]
+        starts = np.searchsorted(queries, queries, side='left')
+        rank = np.arange(len(queries)) - starts
+        keep = rank < k
+        order_ix = np.full((len(query_cells), k), -1, dtype=np.int64)
+        best = np.full((len(query_cells), k), np.inf, dtype=np.float32)
+        order_ix[queries[keep], rank[keep]] = orders[keep]
+        best[queries[keep], rank[keep]] = distances[keep]
+        return order_ix, best
+
+    def within(self, query_cells, radius: float):
+        """
+        Returns all orders within `radius` km of each query cell, sorted by distance.
+        :param query_cells: cell ids
+        :param radius: search radius (km)
+        :return: tuple (offsets, order positions, distances) in CSR layout
+        """
+        query_cells = np.asarray(query_cells, dtype=np.int64)
+        queries, orders, distances = self._expand(*self._candidates(query_cells, radius))
+        order = np.lexsort((orders, distances, queries))
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(queries, minlength=len(query_cells)))])
+        return offsets, orders[order], distances[order]
+
+    def _candidates(self, query_cells, radius: float = None, k: int = 1):
+        """
+        Returns (query, point, distance) candidate triplets within `radius`.
+        Without a radius, every query gets at least its k nearest points.
+        """
+        raise NotImplementedError
+
+    def _all_pairs(self, query_ix, query_cells):
+        queries = np.repeat(query_ix, len(self.point_cells))
+        points = np.tile(np.arange(len(self.point_cells)), len(query_ix))
+        return queries, points, self.location_index.distances[query_cells[queries], self.point_cells[points]]
+
+    def _dense_nearest(self, query_cells):
+        if not len(self.point_cells):
+            return np.full(len(query_cells), -1), np.full(len(query_cells), np.inf, dtype=np.float32)
+        distances = self.location_index.distances[np.ix_(query_cells, self.point_cells)]
+        point_ix = distances.argmin(axis=1)
+        return self.point_orders[self.point_offsets[point_ix]], distances[np.arange(len(query_cells)), point_ix]
+
+    @staticmethod
+    def _reduce_nearest(num_queries, queries, points, distances):
+        point_ix = np.full(num_queries, -1, dtype=np.int64)
+        best = np.full(num_queries, np.inf, dtype=np.float32)
+        order = np.lexsort((points, distances, queries))
+        queries = queries[order]
+        first = np.flatnonzero(np.r_[True, queries[1:] != queries[:-1]]) if len(queries) else queries
+        point_ix[queries[first]] = points[order][first]
+        best[queries[first]] = distances[order][first]
+        return point_ix, best
+
+    def _expand(self, queries, points, distances):
+        """
+        Expands (query, point) pairs to (query, order) pairs.
+        """
+        counts = np.diff(self.point_offsets)[points]
+        starts = np.repeat(self.point_offsets[points], counts)
+        within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return np.repeat(queries, counts), self.point_orders[starts + within], np.repeat(distances, counts)
+
+
+class BruteForceIndex(OrderIndex):
+    """
+    Compares every query against every order cell.
+    """
+
+    def _candidates(self, query_cells, radius: float = None, k: int = 1):
+        queries, points, distances = self._all_pairs(np.arange(len(query_cells)), query_cells)
+        if radius is None:
+            return queries, points, distances
+        keep = distances <= radius
+        return queries[keep], points[keep], distances[keep]
+
+
+class GridIndex(OrderIndex):
+    """
+    Buckets order cells in a regular grid so that radius queries only visit nearby buckets.
+    Unbounded queries start from a one-bucket radius and double it for unresolved queries,
+    falling back to a dense scan after `MAX_RADIUS_DOUBLINGS`.
+    """
+
+    def __init__(self, location_index: LocationIndex, order_cells, bucket_cells: int = None):
+        super().__init__(location_index, order_cells)
+        lat_ix = location_index.lat_ix[self.point_cells]
+        lng_ix = location_index.lng_ix[self.point_cells]
+        if bucket_cells is None:
+            area = (np.ptp(lat_ix) + 1) * (np.ptp(lng_ix) + 1) if len(lat_ix) else 1
+            bucket_cells = int(np.ceil(np.sqrt(area * POINTS_PER_BUCKET / max(len(lat_ix), 1))))
+        self.bucket_cells = max(int(bucket_cells), 1)
+        keys = LocationIndex.cell_keys(lat_ix // self.bucket_cells, lng_ix // self.bucket_cells)
+        self.bucket_order = np.argsort(keys, kind='stable')
+        self.bucket_keys = keys[self.bucket_order]
+        self.bucket_km = self.bucket_cells / location_index.scale * KM_PER_DEGREE
+
+    def _candidates(self, query_cells, radius: float = None, k: int = 1):
+        if radius is not None:
+            return self._within_radius(np.arange(len(query_cells)), query_cells, radius)
+        results = []
+        pending = np.arange(len(query_cells))
+        radius = self.bucket_km
+        for _ in range(MAX_RADIUS_DOUBLINGS + 1):
+            if not len(pending) or not len(self.point_cells):
+                break
+            queries, points, distances = self._within_radius(pending, query_cells, radius)
+            found = np.bincount(queries, minlength=len(query_cells))[pending] >= min(k, len(self.point_cells))
+            keep = np.isin(queries, pending[found])
+            results.append((queries[keep], points[keep], distances[keep]))
+            pending = pending[~found]
+            radius *= 2
+        if len(pending) and len(self.point_cells):
+            results.append(self._all_pairs(pending, query_cells))
+        if not results:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        return tuple(np.concatenate(arrays) for arrays in zip(*results))
+
+    def _within_radius(self, query_ix, query_cells, radius: float):
+        index = self.location_index
+        cells = query_cells[query_ix]
+        lat_ix, lng_ix = index.lat_ix[cells], index.lng_ix[cells]
+        max_lat = np.abs(np.concatenate([index.coords[cells, 0], index.coords[self.point_cells, 0]])).max()
+        # One extra bucket on each side keeps the window conservative for the haversine metric
+        lat_window = int(np.ceil(radius / KM_PER_DEGREE * index.scale / self.bucket_cells)) + 1
+        lng_window = int(np.ceil(
+            radius / (KM_PER_DEGREE * np.cos(np.radians(min(max_lat, 89.0)))) * index.scale / self.bucket_cells
+        )) + 1
+        bucket_lat = lat_ix // self.bucket_cells
+        bucket_lng = lng_ix // self.bucket_cells
+        # Buckets are sorted lat-major, so each bucket row of the window is one contiguous key range
+        rows = bucket_lat[:, None] + np.arange(-lat_window, lat_window + 1)
+        starts = np.searchsorted(
+            self.bucket_keys, LocationIndex.cell_keys(rows, (bucket_lng - lng_window)[:, None]), side='left'
+        ).ravel()
+        ends = np.searchsorted(
+            self.bucket_keys, LocationIndex.cell_keys(rows, (bucket_lng + lng_window)[:, None]), side='right'
+        ).ravel()
+        counts = ends - starts
+        queries = np.repeat(np.repeat(query_ix, rows.shape[1]), counts)
+        positions = np.repeat(starts, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        points = self.bucket_order[positions]
+        distances = index.distances[query_cells[queries], self.point_cells[points]]
+        keep = distances <= radius
+        return queries[keep], points[keep], distances[keep]
+
+
+INDEXES = {
+    'brute_force': BruteForceIndex,
+    'grid': GridIndex,
+}
+
+
+def build_order_index(location_index: LocationIndex, order_cells, kind: str = 'grid', **kwargs):
+    """
+    Builds the nearest-order index of an epoch.
+    :param location_index: LocationIndex of the scenario
+    :param order_cells: cell id of each order
+    :param kind: one of INDEXES
+    :return: OrderIndex
+    """
+    if kind not in INDEXES:
+        raise ValueError('Unknown order index: {}'.format(kind))
+    return INDEXES[kind](location_index, order_cells, **kwargs)
+
+
+def grouped_nearest(location_index: LocationIndex, query_cells, query_groups, target_cells, target_offsets,
+                    max_distance: float = None):
+    """
+    Returns, for each query, its nearest target among the targets of its own group (e.g. the
+    couriers and orders of many epochs or scenarios at once). The (query, target) pairs of all
+    groups are laid out as one ragged array, processed in chunks of at most MAX_PAIRS_PER_CHUNK pairs.
+    :param location_index: LocationIndex the cells refer to
+    :param query_cells: cell id of each query
+    :param query_groups: group of each query
+    :param target_cells: cell id of each target, sorted by group
+    :param target_offsets: CSR offsets (groups + 1) of the targets of each group
+    :param max_distance: optional search radius (km)
+    :return: tuple (target positions within the group, -1 if none (within max_distance); distances)
+    """
+    query_cells = np.asarray(query_cells, dtype=np.int64)
+    query_groups = np.asarray(query_groups, dtype=np.int64)
+    num_queries = len(query_cells)
+    pairs_per_query = np.diff(target_offsets)[query_groups]
+
+    position = np.full(num_queries, -1, dtype=np.int64)
+    distance = np.full(num_queries, np.inf, dtype=np.float32)
+    cumulative = np.cumsum(pairs_per_query)
+    start = 0
+    while start < num_queries:
+        offset = cumulative[start - 1] if start else 0
+        end = max(int(np.searchsorted(cumulative, offset + MAX_PAIRS_PER_CHUNK, side='right')), start + 1)
+        rows = np.arange(start, end)
+        rows = rows[pairs_per_query[rows] > 0]
+        if len(rows):
+            counts = pairs_per_query[rows]
+            pair_query = np.repeat(rows, counts)
+            group_starts = np.cumsum(counts) - counts
+            within = np.arange(counts.sum()) - np.repeat(group_starts, counts)
+            pair_target = target_offsets[query_groups[pair_query]] + within
+            d = location_index.distances[query_cells[pair_query], target_cells[pair_target]]
+            best = np.minimum.reduceat(d, group_starts)
+            # First pair reaching the minimum, i.e. the lowest target position on ties
+            ties = np.flatnonzero(d == np.repeat(best, counts))
+            first = ties[np.searchsorted(ties, group_starts)]
+            position[rows] = within[first]
+            distance[rows] = best
+        start = end
+    if max_distance is not None:
+        beyond = distance > max_distance
+        position[beyond] = -1
+        distance[beyond] = np.inf
+    return position, distance
+
+
+def _jump(labels, step: int, seed_rows, seed_cols, rows, cols, cos_rows):
+    """
+    One jump-flooding pass: every pixel takes the nearest seed among its own and those of the 8
+    pixels `step` away, nearest in the local equirectangular metric (lowest seed position on ties).
+    """
+    height, width = labels.shape
+    padded = np.pad(labels, step, constant_values=-1)
+    candidates = np.stack([
+        padded[step + d_lat:step + d_lat + height, step + d_lng:step + d_lng + width]
+        for d_lat in (-step, 0, step) for d_lng in (-step, 0, step)
+    ])
+    seeds = candidates.clip(min=0)
+    d_row = seed_rows[seeds] - rows[:, None]
+    d_col = (seed_cols[seeds] - cols[None, :]) * cos_rows[:, None]
+    squared = np.where(candidates >= 0, d_row * d_row + d_col * d_col, np.inf)
+    best = squared.min(axis=0)
+    labels = np.where(squared == best, candidates, len(seed_rows)).min(axis=0)
+    labels[np.isinf(best)] = -1
+    return labels
+
+
+def distance_transform(location_index: LocationIndex, seed_cells, query_cells):
+    """
+    Returns the nearest seed of each query cell with a jump-flooding distance transform.
+
+    Seeds are painted on the raster of the bounding box of the query and seed cells. Each pass
+    lets every pixel adopt the nearest seed among its own and those of the pixels `step` away in
+    the 8 directions, for steps of half the raster side down to 1, then 2 and 1 again (JFA+2),
+    which spreads every seed over its Voronoi region in O(pixels log side). Passes compare
+    distances in the local equirectangular projection; each query then picks the exact nearest
+    seed (haversine, lowest seed position on ties) among those of its 3 x 3 pixel neighbourhood.
+    Distances come from the cell coordinates, so the distance matrix is never built. Jump flooding
+    can, rarely, miss a seed whose region is a thin sliver, so the result is a close approximation
+    of OrderIndex.nearest rather than a guarantee.
+    :param location_index: LocationIndex the cells refer to
+    :param seed_cells: distinct cell ids of the seeds (e.g. OrderIndex.point_cells)
+    :param query_cells: cell ids
+    :return: tuple (seed positions, float32 distances), or None if the raster exceeds MAX_FIELD_PIXELS
+    """
+    seed_cells = np.asarray(seed_cells, dtype=np.int64)
+    query_cells = np.asarray(query_cells, dtype=np.int64)
+    lat_ix, lng_ix = location_index.lat_ix, location_index.lng_ix
+    cells = np.concatenate([seed_cells, query_cells])
+    lat0, lng0 = lat_ix[cells].min(), lng_ix[cells].min()
+    height = int(lat_ix[cells].max() - lat0) + 1
+    width = int(lng_ix[cells].max() - lng0) + 1
+    if height * width > MAX_FIELD_PIXELS:
+        return None
+
+    seed_rows = (lat_ix[seed_cells] - lat0).astype(np.float64)
+    seed_cols = (lng_ix[seed_cells] - lng0).astype(np.float64)
+    labels = np.full((height, width), -1, dtype=np.int64)
+    labels[lat_ix[seed_cells] - lat0, lng_ix[seed_cells] - lng0] = np.arange(len(seed_cells))
+    rows, cols = np.arange(height, dtype=np.float64), np.arange(width, dtype=np.float64)
+    cos_rows = np.cos(np.radians((lat0 + rows) / location_index.scale))
+    step = 1 << max(int(np.ceil(np.log2(max(height, width)))) - 1, 0)
+    steps = []
+    while step >= 1:
+        steps.append(step)
+        step //= 2
+    for step in steps + [2, 1]:
+        labels = _jump(labels, step, seed_rows, seed_cols, rows, cols, cos_rows)
+
+    # Exact refinement over the seeds of each query's 3 x 3 neighbourhood
+    padded = np.pad(labels, 1, constant_values=-1)
+    query_rows = lat_ix[query_cells] - lat0 + 1
+    query_cols = lng_ix[query_cells] - lng0 + 1
+    candidates = np.stack([
+        padded[query_rows + d_lat, query_cols + d_lng] for d_lat in (-1, 0, 1) for d_lng in (-1, 0, 1)
+    ], axis=1)
+    # Same values as the distance matrix, which is never needed (nor built) here
+    coords = location_index.coords
+    candidate_cells = seed_cells[candidates.clip(min=0)]
+    distances = np.where(candidates >= 0, haversine_distance(
+        coords[query_cells, 0][:, None], coords[query_cells, 1][:, None],
+        coords[candidate_cells, 0], coords[candidate_cells, 1]
+    ).astype(DISTANCE_DTYPE), np.inf).astype(DISTANCE_DTYPE)
+    best = distances.min(axis=1)
+    position = np.where(distances == best[:, None], candidates, len(seed_cells)).min(axis=1)
+    return position, best
@@ -1,50 +1,188 @@
-from copy import deepcopy
+import numpy as np
+from source.profiling import get_profiler
 from source.scenario import Scenario
+from source.spatial import build_order_index
+from source.utils import get_cells, is_empty
 
 
 class State:
-    def __init__(self, scenario: Scenario):
-        self.scenario_ix = scenario.index
+    """
+    Simulation state at the start of an epoch: the orders that arose in the previous epoch
+    and the couriers available now.
+
+    States are lightweight: scenario data (location index, distances, epoch tables) is shared,
+    never copied, and `step` returns a new state instead of modifying this one. A state is
+    therefore its own snapshot, and `fork` gives an independent handle for branching (e.g. rollouts).
+    """
+    __slots__ = (
+        'scenario', 'location_index', 'epoch', 'orders', 'couriers', 'prev_actions', 'order_index_kind', 'profiler',
+        '_order_index',
+    )
+
+    def __init__(self, scenario: Scenario, order_index_kind: str = 'grid', profiler=None):
+        self.scenario = scenario
+        self.location_index = scenario.location_index
         self.epoch = 0
-        self.locations = scenario.locations
         # Orders arose between t-1 and t
         self.orders = scenario.get_orders(epoch=self.epoch - 1)
         # Couriers arose between t-1 and t
         self.couriers = scenario.get_couriers(epoch=self.epoch)
-        self.distance_map = scenario.distance_map
-        self.neighbours_map = scenario.neighbours_map
         self.prev_actions = dict()
+        self.order_index_kind = order_index_kind
+        self._order_index = None
+        self.profiler = get_profiler(profiler)
+
+    @property
+    def scenario_ix(self):
+        return None if self.scenario is None else self.scenario.index
+
+    @property
+    def cells(self):
+        """
+        Cell ids of the scenario's region of the location index (see Scenario.cells).
+        """
+        return self.scenario.cells
+
+    @property
+    def data_cells(self):
+        return self.scenario.data_cells
+
+    @property
+    def locations(self):
+        return self.scenario.locations
+
+    @property
+    def distance_matrix(self):
+        return self.location_index.distances
+
+    @property
+    def neighbours(self):
+        return self.location_index.neighbours
+
+    @property
+    def distance_map(self):
+        return self.location_index.distance_map
 
-    def evaluate_cost_function(self, actions):
-        if not self.orders:
+    @property
+    def neighbours_map(self):
+        return self.location_index.neighbours_map
+
+    def fork(self):
+        """
+        Returns a copy of the state sharing all its data (including the order index once built).
+        """
+        state = State.__new__(type(self))
+        for slot in State.__slots__:
+            setattr(state, slot, getattr(self, slot))
+        return state
+
+    @property
+    def order_index(self):
+        """
+        Nearest-order index over the current orders, built once per epoch on first use.
+        """
+        if self._order_index is None and not is_empty(self.orders):
+            self._order_index = build_order_index(
+                self.location_index, get_cells(self.orders, self.location_index), kind=self.order_index_kind
+            )
+        return self._order_index
+
+    def evaluate_cost_function(self, actions, details: bool = True):
+        """
+        Returns the cost of an action set and, if `details`, the nearest order of each courier.
+        :param actions: dict {courier_id: {'lat', 'lng'[, 'cell']}}
+        :param details: whether to build the per-courier detail dicts
+        :return: tuple (total cost, dict of nearest order per courier)
+        """
+        if is_empty(self.orders):
             return 0, dict()
+        courier_ids, action_cells = self.get_action_cells(actions)
+        total_cost, nearest_distances, nearest = self.evaluate_action_cells(action_cells)
+        if not details:
+            return float(total_cost), dict()
+        order_cells = self.order_index.order_cells
         nearest_order = dict()
-        total_cost = 0
-        for j, courier_id in enumerate(actions):
-            action_lat, action_lng = actions[courier_id]['lat'], actions[courier_id]['lng']
-            nearest_order[courier_id] = {'order_id': None, 'distance': float('inf'), 'lat': None,
-                                         'lng': None}
-            for i, order in enumerate(self.orders):
-                order_lat, order_lng = order['lat'], order['lng']
-                d = self.distance_map[(action_lat, action_lng)][(order_lat, order_lng)]
-                if d < nearest_order[courier_id]['distance']:
-                    nearest_order[courier_id] = {
-                        'order_id': actions[courier_id].get('order_id', None),
-                        'distance': d,
-                        'courier_lat': self.couriers[courier_id]['lat'],
-                        'courier_lng': self.couriers[courier_id]['lng'],
-                        'action_lat': action_lat,
-                        'action_lng': action_lng,
-                        'order_lat': order_lat,
-                        'order_lng': order_lng
-                    }
-            total_cost += nearest_order[courier_id]['distance']
-        return total_cost, nearest_order
-
-    def update(self, scenario, actions):
-        self.epoch += 1
-        self.orders = scenario.get_orders(epoch=self.epoch - 1)
-        step_cost, nearest_order = self.evaluate_cost_function(actions) if actions else (0, dict())
-        self.couriers = scenario.get_couriers(epoch=self.epoch) if self.epoch < scenario.epochs else None
-        self.prev_actions = deepcopy(actions)
-        return step_cost, nearest_order, self   # ToDo: return new state instead of updated_state
+        for courier_id, action_cell, order_ix, d in zip(courier_ids, action_cells, nearest, nearest_distances):
+            action_lat, action_lng = self.location_index.location(action_cell)
+            order_lat, order_lng = self.location_index.location(order_cells[order_ix])
+            nearest_order[courier_id] = {
+                'order_id': actions[courier_id].get('order_id', None),
+                'distance': float(d),
+                'courier_lat': self.couriers[courier_id]['lat'],
+                'courier_lng': self.couriers[courier_id]['lng'],
+                'action_lat': action_lat,
+                'action_lng': action_lng,
+                'order_lat': order_lat,
+                'order_lng': order_lng
+            }
+        return float(total_cost), nearest_order
+
+    def get_action_cells(self, actions):
+        """
+        Returns the courier ids and the target cell id of an action dict.
+        """
+        courier_ids = list(actions)
+        return courier_ids, get_cells((actions[courier_id] for courier_id in courier_ids), self.location_index)
+
+    def evaluate_action_cells(self, action_cells):
+        """
+        Scores one action set (couriers,) or a batch of candidate sets (candidates, couriers)
+        of target cell ids against the current orders in a single vectorized query.
+        :param action_cells: int array whose last axis are the couriers
+        :return: tuple (total cost per set, nearest order distances, nearest order positions)
+        """
+        action_cells = np.asarray(action_cells, dtype=np.int64)
+        if is_empty(self.orders):
+            return (
+                np.zeros(action_cells.shape[:-1]),
+                np.zeros(action_cells.shape, dtype=np.float32),
+                np.full(action_cells.shape, -1, dtype=np.int64)
+            )
+        # Candidate sets usually share most of their cells, so each distinct cell is queried once
+        cells, inverse = np.unique(action_cells, return_inverse=True)
+        nearest, distances = self.order_index.nearest(cells)
+        nearest = nearest[inverse].reshape(action_cells.shape)
+        distances = distances[inverse].reshape(action_cells.shape)
+        return distances.sum(axis=-1, dtype=np.float64), distances, nearest
+
+    def step(self, actions, details: bool = True):
+        """
+        Applies the actions of this epoch and moves to the next one, leaving this state unchanged.
+        The actions are scored against the orders that arise during this epoch and are kept
+        (not copied) as the next state's `prev_actions`, so they must not be modified afterwards.
+        :param actions: dict {courier_id: {'lat', 'lng'[, 'cell']}} or None
+        :param details: whether to build the per-courier detail dicts
+        :return: tuple (cost, dict of nearest order per courier, next state)
+        """
+        state = self.fork()
+        state.epoch = self.epoch + 1
+        state.orders = self.scenario.get_orders(epoch=self.epoch)
+        state.prev_actions = actions
+        state._order_index = None
+        with self.profiler.phase('evaluate'):
+            step_cost, nearest_order = state.evaluate_cost_function(actions, details=details) if actions else (0, dict())
+        state.couriers = self.scenario.get_couriers(epoch=state.epoch) if state.epoch < self.scenario.epochs else None
+        return step_cost, nearest_order, state
+
+    def jump(self, epoch: int):
+        """
+        Returns the state at the start of a later epoch, as if the epochs in between had no decisions.
+        The order index is kept when `epoch` is this state's epoch (the orders are the same).
+        :param epoch: epoch to move to (>= self.epoch)
+        :return: new state
+        """
+        if epoch == self.epoch:
+            return self
+        state = self.fork()
+        state.epoch = epoch
+        state.orders = self.scenario.get_orders(epoch=epoch - 1)
+        state.prev_actions = dict()
+        state._order_index = None
+        state.couriers = self.scenario.get_couriers(epoch=epoch) if epoch < self.scenario.epochs else None
+        return state
+
+    def update(self, scenario, actions, details: bool = True):
+        """
+        Same as `step`, kept for backward compatibility (`scenario` must be the state's scenario).
+        """
+        return self.step(actions, details=details)
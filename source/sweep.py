@@ -0,0 +1,222 @@
+"""
+Hyperparameter sweep over a parameter grid.
+
+    python -m source.sweep --data data/robotex5.csv --jobs 4 \
+        --grid '{"policy": ["vfa"], "minutes_bucket_size": [5, 10], "precision": [2, 3], "alpha": [0.1, 0.2]}'
+
+Every combination of the grid values is a configuration, evaluated like the runner does
+(train then test scenarios) in a process pool. Configurations are grouped by `precision`,
+whose dataset-wide location index and distance matrix are built once and shared with the workers, and
+by `minutes_bucket_size`, whose scenarios come from (or go to) the ScenarioCache. Each finished
+configuration appends its rows to the results table, so an interrupted sweep resumes where it
+stopped when run again with the same output.
+"""
+import io
+import os
+import csv
+import json
+import hashlib
+import argparse
+import itertools
+from contextlib import redirect_stdout
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+from source.bounds import solve_perfect_information
+from source.cache import DEFAULT_CACHE_DIR, ScenarioCache
+from source.config import PARAMS, get_policy
+from source.locations import LocationIndex
+from source.parallel import SPLITS
+from source.scenario import Scenario, build_location_index
+from source.utils import iter_daily_data, scan_data, split_dates
+
+SWEEP_FIELDS = [
+    'config_id', 'policy', 'minutes_bucket_size', 'precision', 'params',
+    'scenario_label', 'scenario', 'reward', 'perfect_reward', 'gap', 'execution_secs',
+]
+SWEEP_PARAMS = {
+    # Sweeps only keep the results table
+    'export_policy_details': False,
+    'summary_only': True,
+    'verbose': False,
+}
+
+
+def expand_grid(grid: dict):
+    """
+    Returns every combination of the grid values as a list of configurations.
+    :param grid: dict {parameter: list of values}; `policy` defaults to PARAMS['policies']
+    :return: list of dicts with at least policy, minutes_bucket_size and precision
+    """
+    grid = {
+        'policy': PARAMS['policies'],
+        'minutes_bucket_size': [PARAMS['minutes_bucket_size']],
+        'precision': [PARAMS['precision']],
+        **grid,
+    }
+    keys = sorted(grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[key] for key in keys))]
+
+
+def config_id(config: dict):
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def read_completed(path: str):
+    """
+    Returns the ids of the configurations already in the results table.
+    """
+    if not os.path.exists(path):
+        return set()
+    return set(pd.read_csv(path, usecols=['config_id'], dtype=str).config_id)
+
+
+def load_days(input_data_path: str):
+    """
+    Returns the days of the input file as {'train': [day data], 'test': [day data]}.
+    """
+    summary = scan_data(input_data_path)
+    _, test_dates = split_dates(summary['rows_per_date'].index)
+    test_dates = set(test_dates)
+    days = {split: [] for split in SPLITS}
+    for date, day in iter_daily_data(input_data_path, summary=summary):
+        days['test' if date in test_dates else 'train'].append(day)
+    return days
+
+
+def build_sweep_location_index(days: dict, precision: int):
+    """
+    Returns the location index of all days, shared by the scenarios of every bucket size.
+    """
+    return build_location_index(((None, day) for split in SPLITS for day in days[split]), precision)
+
+
+def build_sweep_scenarios(days: dict, location_index: LocationIndex, minutes_bucket_size: int, precision: int,
+                          jobs: int = 1):
+    """
+    Builds the scenarios of a (bucket size, precision) pair on top of an already built location index.
+    """
+    scenarios = {split: [] for split in SPLITS}
+    for split in SPLITS:
+        for index, day in enumerate(days[split]):
+            scenarios[split].append(Scenario(
+                index, split, day, minutes_bucket_size, precision=precision, location_index=location_index
+            ))
+    solve_perfect_information(scenarios['train'] + scenarios['test'], jobs=jobs)
+    return scenarios
+
+
+def evaluate_config(config: dict, scenarios: dict, base_params: dict):
+    """
+    Trains and evaluates the policy of a configuration over the train then test scenarios.
+    :return: list of result rows (dicts with SWEEP_FIELDS)
+    """
+    params = {key: value for key, value in config.items() if key != 'policy'}
+    policy = get_policy(config['policy'])(**{**base_params, **params})
+    rows = []
+    with redirect_stdout(io.StringIO()):
+        for split in SPLITS:
+            for scenario in scenarios[split]:
+                solution = policy.train(scenario)
+                rows.append({
+                    'config_id': config_id(config),
+                    'policy': config['policy'],
+                    'minutes_bucket_size': config['minutes_bucket_size'],
+                    'precision': config['precision'],
+                    'params': json.dumps(params, sort_keys=True),
+                    'scenario_label': scenario.label,
+                    'scenario': scenario.index,
+                    'reward': solution['cost'],
+                    'perfect_reward': scenario.perfect_cost,
+                    'gap': solution['gap'],
+                    'execution_secs': solution['execution_secs'],
+                })
+    return rows
+
+
+def run_sweep(input_data_path: str, grid: dict, output: str, jobs: int = 1, cache_dir: str = DEFAULT_CACHE_DIR):
+    """
+    Evaluates every configuration of the grid not yet in `output` and appends its rows there.
+    :return: pd.DataFrame with the whole results table
+    """
+    configs = expand_grid(grid)
+    completed = read_completed(output)
+    pending = [config for config in configs if config_id(config) not in completed]
+    print(f"Sweep: {len(configs)} configurations - {len(configs) - len(pending)} already done")
+    base_params = {**PARAMS, 'input_data_path': input_data_path, **SWEEP_PARAMS}
+    cache = ScenarioCache(cache_dir) if cache_dir is not None else None
+    days = None
+
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    new_file = not os.path.exists(output)
+    with open(output, 'a', newline='') as out, ProcessPoolExecutor(max_workers=jobs) as pool:
+        writer = csv.DictWriter(out, fieldnames=SWEEP_FIELDS, lineterminator='\n')
+        if new_file:
+            writer.writeheader()
+        for precision, precision_configs in itertools.groupby(
+                sorted(pending, key=lambda c: (c['precision'], c['minutes_bucket_size'])), key=lambda c: c['precision']):
+            precision_configs = list(precision_configs)
+            location_index = None
+            scenarios = {}
+            for minutes_bucket_size in sorted({config['minutes_bucket_size'] for config in precision_configs}):
+                def build():
+                    nonlocal days, location_index
+                    days = load_days(input_data_path) if days is None else days
+                    if location_index is None:
+                        location_index = build_sweep_location_index(days, precision)
+                    return build_sweep_scenarios(days, location_index, minutes_bucket_size, precision, jobs)
+                if cache is None:
+                    scenarios[minutes_bucket_size] = build()
+                else:
+                    key = cache.key(input_data_path, minutes_bucket_size, precision, global_locations=True)
+                    scenarios[minutes_bucket_size] = cache.get_or_build(
+                        key, build, input_data_path=input_data_path,
+                        minutes_bucket_size=minutes_bucket_size, precision=precision, global_locations=True,
+                    )
+            shared = {
+                id(scenario.location_index): scenario.location_index
+                for bucket_scenarios in scenarios.values() for split in SPLITS for scenario in bucket_scenarios[split]
+            }
+            for shared_index in shared.values():
+                shared_index.share()
+            try:
+                futures = {
+                    pool.submit(evaluate_config, config, scenarios[config['minutes_bucket_size']], base_params): config
+                    for config in precision_configs
+                }
+                for future in as_completed(futures):
+                    rows = future.result()
+                    writer.writerows(rows)
+                    out.flush()
+                    print(f"Sweep: done {futures[future]} - "
+                          f"test reward: {sum(row['reward'] for row in rows if row['scenario_label'] == 'test'):.2f}")
+            finally:
+                for shared_index in shared.values():
+                    shared_index.release()
+    return pd.read_csv(output)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--data', default=PARAMS['input_data_path'], help='Input CSV or Parquet file')
+    parser.add_argument('--grid', required=True, help='Parameter grid as JSON, or the path of a JSON file')
+    parser.add_argument('--output', help='Results table (default: results/sweep_<input file name>.csv)')
+    parser.add_argument('--jobs', type=int, default=PARAMS['jobs'], help='Number of worker processes')
+    parser.add_argument('--cache-dir', default=PARAMS['cache_dir'], help='Scenario cache folder')
+    args = parser.parse_args()
+
+    if os.path.exists(args.grid):
+        with open(args.grid) as f:
+            grid = json.load(f)
+    else:
+        grid = json.loads(args.grid)
+    file_name = args.data.split('/')[-1].split('.')[0]
+    output = args.output or f"results/sweep_{file_name}.csv"
+    results = run_sweep(args.data, grid, output, jobs=args.jobs, cache_dir=args.cache_dir)
+    summary = (
+        results[results.scenario_label == 'test']
+        .groupby(['config_id', 'policy', 'minutes_bucket_size', 'precision', 'params'])[['reward', 'gap']]
+        .mean()
+        .sort_values('reward')
+    )
+    print(summary.to_string())
+    print(f"Sweep results exported to {output}")
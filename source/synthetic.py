@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+from source.spatial import KM_PER_DEGREE
+from source.utils import TIME_FORMAT, prepare_data
+
+DEFAULT_CENTER = (59.437, 24.745)
+# Share of daily orders per hour: quiet nights, lunch and dinner peaks
+HOURLY_PROFILE = np.array([
+    1.5, 1.0, 0.7, 0.5, 0.5, 0.8, 1.5, 2.5, 3.5, 3.5, 4.0, 5.5,
+    7.0, 6.5, 5.0, 4.5, 5.0, 6.5, 8.0, 8.5, 7.5, 5.5, 3.5, 2.5
+])
+
+
+def generate_instance(days: int = 3, orders_per_day: int = 1000, spread_km: float = 5.0,
+                      trip_km: float = 2.0, hotspots: int = 5, center: tuple = DEFAULT_CENTER,
+                      start_date: str = '2022-03-01', seed: int = 0):
+    """
+    Generates a synthetic instance with the same columns as the input CSV.
+    Order origins are drawn around `hotspots` demand centres spread over `spread_km`, trips
+    end about `trip_km` away and start times follow HOURLY_PROFILE.
+    :param days: number of days
+    :param orders_per_day: orders (trips) per day
+    :param spread_km: standard deviation of the hotspot locations around the centre (km)
+    :param trip_km: standard deviation of the trip length along each axis (km)
+    :param hotspots: number of demand centres
+    :param center: (lat, lng) of the city centre
+    :param start_date: first day of the instance
+    :param seed: random seed
+    :return: pd.DataFrame with start_time, start_lat, start_lng, end_lat, end_lng
+    """
+    rng = np.random.default_rng(seed)
+    km_per_degree_lng = KM_PER_DEGREE * np.cos(np.radians(center[0]))
+    hotspot_lat = center[0] + rng.normal(0, spread_km, hotspots) / KM_PER_DEGREE
+    hotspot_lng = center[1] + rng.normal(0, spread_km, hotspots) / km_per_degree_lng
+    hourly = HOURLY_PROFILE / HOURLY_PROFILE.sum()
+    frames = []
+    for day in range(days):
+        date = pd.Timestamp(start_date) + pd.Timedelta(days=day)
+        hours = rng.choice(24, size=orders_per_day, p=hourly)
+        seconds = np.sort(hours * 3600 + rng.integers(0, 3600, orders_per_day))
+        hotspot = rng.integers(0, hotspots, orders_per_day)
+        start_lat = hotspot_lat[hotspot] + rng.normal(0, spread_km / 4, orders_per_day) / KM_PER_DEGREE
+        start_lng = hotspot_lng[hotspot] + rng.normal(0, spread_km / 4, orders_per_day) / km_per_degree_lng
+        frames.append(pd.DataFrame({
+            'start_time': (date + pd.to_timedelta(seconds, unit='s')).strftime(TIME_FORMAT),
+            'start_lat': start_lat,
+            'start_lng': start_lng,
+            'end_lat': start_lat + rng.normal(0, trip_km, orders_per_day) / KM_PER_DEGREE,
+            'end_lng': start_lng + rng.normal(0, trip_km, orders_per_day) / km_per_degree_lng,
+        }))
+    return pd.concat(frames, ignore_index=True)
+
+
+def generate_data(**kwargs):
+    """
+    Same as `generate_instance`, prepared like `utils.load_data` output (start_date, time_seconds).
+    """
+    return prepare_data(generate_instance(**kwargs))
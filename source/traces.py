@@ -0,0 +1,88 @@
+"""
+Action traces: the decisions of a policy over a scenario, recorded by Policy.train
+(`export_traces`) and re-scored by source.rescore without running the policy again.
+
+A trace has one row per decision: the epoch, the courier's trip (row of the day's data,
+EPOCH_DTYPE 'trip') and the LocationIndex key of its target cell. Trips and cell keys do
+not depend on the bucket size, delivery duration or location index of the scenario the
+trace was recorded on, so a trace can be replayed against scenarios built differently.
+"""
+import os
+import numpy as np
+from source.scenario import Scenario
+from source.utils import get_cells
+
+TRACE_FIELDS = ['epochs', 'trips', 'target_keys']
+
+
+class ActionTrace:
+    """
+    Decisions of a policy over one scenario, sorted by epoch.
+    :param epochs: decision epoch of each row
+    :param trips: courier trip of each row
+    :param target_keys: cell key of each row's target
+    :param meta: recording information (policy, scenario_label, scenario, minutes_bucket_size,
+                 precision, delivery_duration_seconds, cost)
+    """
+
+    def __init__(self, epochs, trips, target_keys, **meta):
+        self.epochs = np.asarray(epochs, dtype=np.int32)
+        self.trips = np.asarray(trips, dtype=np.int32)
+        self.target_keys = np.asarray(target_keys, dtype=np.int64)
+        self.meta = meta
+
+    def __len__(self):
+        return len(self.trips)
+
+    @staticmethod
+    def file_name(fname: str):
+        return f'{fname}.npz'
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        np.savez_compressed(
+            path, **{field: getattr(self, field) for field in TRACE_FIELDS},
+            **{f'meta_{key}': value for key, value in self.meta.items()}
+        )
+
+    @classmethod
+    def load(cls, path: str):
+        with np.load(path) as arrays:
+            return cls(
+                *(arrays[field] for field in TRACE_FIELDS),
+                **{key[len('meta_'):]: arrays[key].item() for key in arrays.files if key.startswith('meta_')}
+            )
+
+
+class TraceRecorder:
+    """
+    Collects the actions of a scenario's epochs (dicts {courier position in the epoch: {'lat', 'lng'[, 'cell']}}).
+    """
+
+    def __init__(self, scenario: Scenario):
+        self.scenario = scenario
+        self._epochs, self._trips, self._keys = [], [], []
+
+    def add(self, epoch: int, actions: dict):
+        if not actions:
+            return
+        couriers = np.fromiter(actions, dtype=np.int64, count=len(actions))
+        cells = get_cells(actions.values(), self.scenario.location_index)
+        courier_table = self.scenario.courier_table
+        self._epochs.append(np.full(len(couriers), epoch, dtype=np.int32))
+        self._trips.append(courier_table.rows['trip'][courier_table.offsets[epoch] + couriers])
+        self._keys.append(self.scenario.location_index.keys[cells])
+
+    def trace(self, policy: str, cost: float):
+        scenario = self.scenario
+        arrays = [np.concatenate(parts) if parts else [] for parts in (self._epochs, self._trips, self._keys)]
+        return ActionTrace(
+            *arrays,
+            policy=policy,
+            scenario_label=scenario.label,
+            scenario=scenario.index,
+            minutes_bucket_size=scenario.minutes_bucket_size,
+            precision=scenario.precision,
+            delivery_duration_seconds=scenario.delivery_duration_seconds,
+            cost=cost,
+        )
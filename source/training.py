@@ -0,0 +1,254 @@
+"""
+Convergence-aware training of value function policies (VFA, HierarchicalVFA).
+
+    python -m source.training --data data/robotex5.csv --policy vfa --step-size harmonic \
+        --max-passes 20 --tol 0.01 --checkpoint checkpoints/vfa
+
+Each pass runs the policy over every train scenario (sample path `n` of the policy), one
+scenario after another, with --batch all of them in lockstep (source.batch), or with --jobs
+across worker processes sharing the value table (source.parallel_training, VFA only). After a
+pass the value table is compared with the one before it: the mean and max absolute change
+overall and per epoch, and the sum of absolute changes relative to the sum of absolute values. Training stops
+once the relative change stays below `tol` for `patience` passes, or after `max_passes`.
+The per-pass and per-epoch records are written as CSV, and the trained policy can be saved
+as a checkpoint for `python -m source --from-checkpoints`. With --compare, the policy is also
+trained in a single process, and both are scored (frozen) on the test scenarios in comparison.csv:
+
+    python -m source.training --data data/robotex5.csv --jobs 4 --parallel-mode merge --compare
+"""
+import io
+import os
+import copy
+import time
+import argparse
+from contextlib import nullcontext, redirect_stdout
+import numpy as np
+from source.batch import ScenarioBatch, simulate
+from source.config import PARAMS, get_policy, load_scenarios
+from source.parallel_training import DEFAULT_SYNC_EVERY, MODES, run_parallel_pass, shared_training
+from source.profiling import write_csv
+from source.policies.vfa import STEP_SIZES
+
+PASS_FIELDS = [
+    'pass', 'step_size', 'cost', 'mean_abs_change', 'max_abs_change', 'relative_change', 'new_entries',
+    'scenario_epochs', 'seconds', 'scenario_epochs_per_sec',
+]
+EPOCH_CHANGE_FIELDS = ['pass', 'epoch', 'mean_abs_change', 'max_abs_change', 'entries']
+COMPARISON_FIELDS = [
+    'training', 'jobs', 'parallel_mode', 'sync_every', 'passes', 'converged', 'seconds', 'scenario_epochs_per_sec',
+    'train_cost', 'test_cost',
+]
+DEFAULT_MAX_PASSES = 10
+DEFAULT_TOL = 1e-2
+DEFAULT_PATIENCE = 2
+
+
+def value_changes(before, before_known, after, after_known):
+    """
+    Compares two snapshots of a value table (`after` may have more columns than `before`).
+    :return: tuple (absolute change (epochs x before columns, nan where no estimate before or after),
+             number of entries with a first estimate)
+    """
+    columns = before.shape[1]
+    known = before_known & after_known[:, :columns]
+    change = np.where(known, np.abs(after[:, :columns] - before), np.nan)
+    new_entries = int(after_known.sum() - before_known.sum())
+    return change, new_entries
+
+
+def run_pass(policy, scenarios: list, batch: ScenarioBatch = None, pool=None, jobs: int = 1,
+             parallel_mode: str = 'hogwild', sync_every: int = DEFAULT_SYNC_EVERY):
+    """
+    Runs one training pass, across the workers of `pool` if given (see source.parallel_training).
+    :return: tuple (total cost, scenario-epochs simulated)
+    """
+    if batch is not None:
+        return float(simulate(policy, batch)['costs'].sum()), batch.num_groups
+    scenario_epochs = sum(scenario.epochs for scenario in scenarios)
+    if pool is not None:
+        return run_parallel_pass(policy, scenarios, pool, jobs, parallel_mode, sync_every), scenario_epochs
+    with redirect_stdout(io.StringIO()):
+        cost = sum(policy.train(scenario)['cost'] for scenario in scenarios)
+    return cost, scenario_epochs
+
+
+def evaluate_frozen(policy, scenarios: list):
+    """
+    Returns the total cost of a frozen copy of the policy over the scenarios (nan if there are none).
+    """
+    if not scenarios:
+        return np.nan
+    with redirect_stdout(io.StringIO()):
+        frozen = copy.deepcopy(policy).freeze()
+        return sum(frozen.train(scenario)['cost'] for scenario in scenarios)
+
+
+def train_until_converged(policy, scenarios: list, max_passes: int = DEFAULT_MAX_PASSES, tol: float = DEFAULT_TOL,
+                          patience: int = DEFAULT_PATIENCE, batch: bool = False, verbose: bool = True,
+                          jobs: int = 1, parallel_mode: str = 'hogwild', sync_every: int = DEFAULT_SYNC_EVERY):
+    """
+    Trains a value function policy over the scenarios until its value table stabilizes.
+    :param policy: VFA (or subclass), trained in place starting from sample path policy.n
+    :param scenarios: train scenarios
+    :param max_passes: maximum number of passes over the scenarios
+    :param tol: relative change (sum of absolute changes / sum of absolute values) below which a pass is stable
+    :param patience: number of consecutive stable passes before stopping
+    :param batch: run each pass as a lockstep ScenarioBatch
+    :param verbose: print one line per pass
+    :param jobs: worker processes; above 1, passes run in parallel on a shared value table
+    :param parallel_mode: 'hogwild' or 'merge' (see source.parallel_training.MODES)
+    :param sync_every: scenarios per worker between merges in 'merge' mode
+    :return: tuple (pass records (PASS_FIELDS), per-epoch change records (EPOCH_CHANGE_FIELDS), converged)
+    """
+    if batch and jobs > 1:
+        raise ValueError('Batched passes cannot run across worker processes')
+    scenario_batch = ScenarioBatch(scenarios) if batch else None
+    passes, epoch_changes = [], []
+    stable = 0
+    first_pass = policy.n
+    with shared_training(policy, scenarios, jobs) if jobs > 1 else nullcontext() as pool:
+        for n in range(first_pass, first_pass + max_passes):
+            policy.n = n
+            before, before_known = (array.copy() for array in policy.value_table())
+            start = time.perf_counter()
+            cost, scenario_epochs = run_pass(
+                policy, scenarios, scenario_batch, pool, jobs=jobs, parallel_mode=parallel_mode, sync_every=sync_every
+            )
+            seconds = time.perf_counter() - start
+            after, after_known = policy.value_table()
+            change, new_entries = value_changes(before, before_known, after, after_known)
+            scale = np.abs(after[:, :before.shape[1]][before_known]).sum()
+            total_change = float(np.nansum(change))
+            entries = np.isfinite(change).sum(axis=1)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                epoch_means = np.where(entries > 0, np.nansum(change, axis=1) / entries, np.nan)
+            epoch_max = np.where(np.isnan(change), -np.inf, change).max(axis=1, initial=-np.inf)
+            epoch_max[entries == 0] = np.nan
+            record = {
+                'pass': n,
+                'step_size': policy.current_step_size(),
+                'cost': cost,
+                'mean_abs_change': total_change / entries.sum() if entries.sum() else np.nan,
+                'max_abs_change': float(np.nanmax(epoch_max)) if entries.sum() else np.nan,
+                # Nothing to compare on the first pass from scratch, which is never stable
+                'relative_change': float(total_change / scale) if scale > 0 else np.inf,
+                'new_entries': new_entries,
+                'scenario_epochs': scenario_epochs,
+                'seconds': seconds,
+                'scenario_epochs_per_sec': scenario_epochs / max(seconds, 1e-9),
+            }
+            passes.append(record)
+            epoch_changes.extend(
+                {'pass': n, 'epoch': epoch, 'mean_abs_change': mean, 'max_abs_change': largest, 'entries': count}
+                for epoch, mean, largest, count in zip(
+                    range(len(entries)), epoch_means.tolist(), epoch_max.tolist(), entries.tolist()
+                )
+            )
+            if verbose:
+                print(
+                    f"Pass: {n} - Step size: {record['step_size']:.4f} - Cost: {cost:.1f} - "
+                    f"Mean change: {record['mean_abs_change']:.4f} - Relative change: {record['relative_change']:.4f} - "
+                    f"New entries: {new_entries} - Scenario-epochs/s: {record['scenario_epochs_per_sec']:.0f}"
+                )
+            stable = stable + 1 if record['relative_change'] < tol else 0
+            if stable >= patience:
+                break
+    # Later runs (e.g. the test scenarios) continue on a new sample path
+    policy.n += 1
+    return passes, epoch_changes, stable >= patience
+
+
+def summarize(training: str, passes: list, converged: bool, test_cost: float, jobs: int = 1,
+              parallel_mode: str = None, sync_every: int = None):
+    """
+    Returns the COMPARISON_FIELDS record of a training run.
+    """
+    seconds = sum(record['seconds'] for record in passes)
+    return {
+        'training': training,
+        'jobs': jobs,
+        'parallel_mode': parallel_mode,
+        'sync_every': sync_every,
+        'passes': len(passes),
+        'converged': converged,
+        'seconds': seconds,
+        'scenario_epochs_per_sec': sum(record['scenario_epochs'] for record in passes) / max(seconds, 1e-9),
+        'train_cost': passes[-1]['cost'] if passes else np.nan,
+        'test_cost': test_cost,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--data', default=PARAMS['input_data_path'], help='Input CSV or Parquet file')
+    parser.add_argument('--policy', default='vfa', choices=['vfa', 'hvfa'])
+    parser.add_argument('--step-size', default='constant', choices=STEP_SIZES)
+    parser.add_argument('--alpha', type=float, help='Initial step size (default: the policy default)')
+    parser.add_argument('--max-passes', type=int, default=DEFAULT_MAX_PASSES)
+    parser.add_argument('--tol', type=float, default=DEFAULT_TOL)
+    parser.add_argument('--patience', type=int, default=DEFAULT_PATIENCE)
+    parser.add_argument('--batch', action='store_true', help='Run each pass as a lockstep batch')
+    parser.add_argument('--jobs', type=int, default=1, help='Worker processes sharing the value table (VFA)')
+    parser.add_argument('--parallel-mode', default='hogwild', choices=MODES,
+                        help='Lock-free shared updates (hogwild) or deterministic periodic merges (merge)')
+    parser.add_argument('--sync-every', type=int, default=DEFAULT_SYNC_EVERY,
+                        help='Scenarios per worker between merges (merge mode)')
+    parser.add_argument('--compare', action='store_true',
+                        help='Also train in a single process and compare both on the test scenarios '
+                             '(with --jobs or --batch)')
+    parser.add_argument('--checkpoint', help='Save the trained policy to this folder')
+    parser.add_argument('--output', default='results/training',
+                        help='Folder for passes.csv, epochs.csv and comparison.csv')
+    args = parser.parse_args()
+    if args.batch and args.policy == 'hvfa':
+        parser.error('--batch is not supported by --policy hvfa')
+    if args.jobs > 1 and args.policy == 'hvfa':
+        parser.error('--jobs above 1 is not supported by --policy hvfa')
+    if args.compare and args.jobs <= 1 and not args.batch:
+        parser.error('--compare needs --jobs above 1 or --batch (training is already sequential)')
+
+    PARAMS['input_data_path'] = args.data
+    scenarios = load_scenarios(jobs=args.jobs)
+    params = {**PARAMS, 'export_policy_details': False, 'summary_only': True, 'step_size': args.step_size}
+    if args.alpha is not None:
+        params['alpha'] = args.alpha
+    options = {'max_passes': args.max_passes, 'tol': args.tol, 'patience': args.patience}
+    policy = get_policy(args.policy)(**params)
+    passes, epoch_changes, converged = train_until_converged(
+        policy, scenarios['train'], batch=args.batch, jobs=args.jobs, parallel_mode=args.parallel_mode,
+        sync_every=args.sync_every, **options
+    )
+    total_seconds = sum(record['seconds'] for record in passes)
+    print(
+        f"Training -> Policy: {policy.name} | Passes: {len(passes)} "
+        f"| Converged: {converged} | Time: {total_seconds:.1f}s "
+        f"| Scenario-epochs/s: {sum(record['scenario_epochs'] for record in passes) / max(total_seconds, 1e-9):.0f}"
+    )
+    os.makedirs(args.output, exist_ok=True)
+    write_csv(os.path.join(args.output, 'passes.csv'), passes, PASS_FIELDS)
+    write_csv(os.path.join(args.output, 'epochs.csv'), epoch_changes, EPOCH_CHANGE_FIELDS)
+    if args.compare:
+        training = 'parallel' if args.jobs > 1 else 'batch' if args.batch else 'sequential'
+        comparison = [summarize(
+            training, passes, converged, evaluate_frozen(policy, scenarios['test']), jobs=args.jobs,
+            parallel_mode=args.parallel_mode if args.jobs > 1 else None,
+            sync_every=args.sync_every if args.jobs > 1 and args.parallel_mode == 'merge' else None,
+        )]
+        baseline = get_policy(args.policy)(**params)
+        baseline_passes, _, baseline_converged = train_until_converged(
+            baseline, scenarios['train'], verbose=False, **options
+        )
+        comparison.append(summarize(
+            'sequential', baseline_passes, baseline_converged, evaluate_frozen(baseline, scenarios['test'])
+        ))
+        for record in comparison:
+            print(
+                f"Comparison -> Training: {record['training']} | Jobs: {record['jobs']} "
+                f"| Passes: {record['passes']} | Time: {record['seconds']:.1f}s "
+                f"| Train cost: {record['train_cost']:.1f} | Test cost: {record['test_cost']:.1f}"
+            )
+        write_csv(os.path.join(args.output, 'comparison.csv'), comparison, COMPARISON_FIELDS)
+    print(f"Training history exported to {args.output}")
+    if args.checkpoint:
+        policy.save(args.checkpoint)
+        print(f"Policy saved to {args.checkpoint}")
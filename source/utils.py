@@ -1,33 +1,145 @@
 import numpy as np
 import pandas as pd
-from itertools import product
 
 DTYPES = {'start_time': str, 'start_lat': 'float',
           'start_lng': 'float', 'end_lat': 'float',
           'end_lng': 'float'}
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+SCAN_COLUMNS = ['start_time', 'start_lat', 'start_lng', 'end_lng']
+CSV_CHUNK_ROWS = 200_000
 
 
 def load_data(path="data/data.csv"):
-    return (
-        pd.read_csv(path, dtype=DTYPES)
-        [lambda x: ~(x.start_lng.isna() | x.end_lng.isna())]
-        [lambda x: (x.end_lat > np.floor(np.quantile(x.start_lat, 0.001))) &
-                   (x.end_lng > np.floor(np.quantile(x.start_lng, 0.001))) &
-                   (x.end_lat < np.ceil(np.quantile(x.start_lat, 0.999))) &
-                   (x.end_lng < np.ceil(np.quantile(x.start_lng, 0.999)))
-        ]
-        .assign(start_time=lambda x: pd.to_datetime(x.start_time, format='%Y-%m-%d %H:%M:%S', errors='coerce'),
-                start_date=lambda x: x.start_time.dt.date,
-                time_seconds=lambda x: (
-                        (x.start_time - x.start_time.dt.normalize())/pd.Timedelta('1 second')).astype(int)
-                )
+    data = pd.read_csv(path, dtype=DTYPES)[lambda x: ~(x.start_lng.isna() | x.end_lng.isna())]
+    return prepare_data(filter_outliers(data, get_outlier_bounds(data.start_lat, data.start_lng)))
+
+
+def get_outlier_bounds(start_lat, start_lng):
+    """
+    Returns the lat/lng box (0.1% - 99.9% quantiles of the start coordinates) trips must end in.
+    """
+    return {
+        'min_lat': np.floor(np.quantile(start_lat, 0.001)),
+        'min_lng': np.floor(np.quantile(start_lng, 0.001)),
+        'max_lat': np.ceil(np.quantile(start_lat, 0.999)),
+        'max_lng': np.ceil(np.quantile(start_lng, 0.999)),
+    }
+
+
+def filter_outliers(data: pd.DataFrame, bounds: dict):
+    return data[
+        (data.end_lat > bounds['min_lat']) &
+        (data.end_lng > bounds['min_lng']) &
+        (data.end_lat < bounds['max_lat']) &
+        (data.end_lng < bounds['max_lng'])
+    ]
+
+
+def prepare_data(data: pd.DataFrame):
+    return data.assign(
+        start_time=lambda x: pd.to_datetime(x.start_time, format=TIME_FORMAT, errors='coerce'),
+        start_date=lambda x: x.start_time.dt.date,
+        time_seconds=lambda x: (
+                (x.start_time - x.start_time.dt.normalize())/pd.Timedelta('1 second')).astype(int)
     )
 
 
-def split_data(data, test_size=0.2):
-    unique_dates = np.sort(data.start_date.unique())
+def is_parquet(path: str):
+    return path.endswith('.parquet') or path.endswith('.pq')
+
+
+def read_chunks(path: str, columns: list = None, chunksize: int = CSV_CHUNK_ROWS):
+    """
+    Yields the rows with start and end coordinates of a CSV (in chunks) or Parquet file.
+    """
+    if is_parquet(path):
+        chunks = [pd.read_parquet(path, columns=columns)]
+    else:
+        chunks = pd.read_csv(path, dtype=DTYPES, usecols=columns, chunksize=chunksize)
+    for chunk in chunks:
+        yield chunk[lambda x: ~(x.start_lng.isna() | x.end_lng.isna())]
+
+
+def scan_data(path: str, chunksize: int = CSV_CHUNK_ROWS):
+    """
+    First, cheap pass over the data: reads only the columns needed for the outlier bounds
+    and the number of rows per day, without keeping whole rows in memory.
+    :return: dict with 'bounds' (see get_outlier_bounds), 'rows_per_date' (pd.Series indexed by date)
+             and 'time_as_string' (whether start_time is stored as text)
+    """
+    start_lat, start_lng, rows_per_date = [], [], []
+    time_as_string = True
+    for chunk in read_chunks(path, columns=SCAN_COLUMNS, chunksize=chunksize):
+        time_as_string = not pd.api.types.is_datetime64_any_dtype(chunk.start_time)
+        start_lat.append(chunk.start_lat.to_numpy())
+        start_lng.append(chunk.start_lng.to_numpy())
+        dates = pd.to_datetime(chunk.start_time, format=TIME_FORMAT, errors='coerce').dt.date
+        rows_per_date.append(dates.value_counts())
+    rows_per_date = pd.concat(rows_per_date).groupby(level=0).sum().sort_index()
+    return {
+        'bounds': get_outlier_bounds(np.concatenate(start_lat), np.concatenate(start_lng)),
+        'rows_per_date': rows_per_date,
+        'time_as_string': time_as_string,
+    }
+
+
+def iter_daily_data(path: str, chunksize: int = CSV_CHUNK_ROWS, summary: dict = None):
+    """
+    Streams the data one day at a time, in date order, with the same filters as `load_data`.
+    CSV files are read in chunks and a day is released once all its rows have been read, so
+    for time-sorted files only about one day is held in memory. Parquet files are read one
+    day at a time with column projection and a date predicate pushed down to the reader
+    (Parquet support needs `pyarrow`, which is not a hard requirement).
+    :param path: CSV or Parquet file
+    :param chunksize: CSV rows per chunk
+    :param summary: result of `scan_data` (computed if not given)
+    :return: generator of (date, pd.DataFrame)
+    """
+    summary = scan_data(path, chunksize=chunksize) if summary is None else summary
+    bounds, rows_per_date = summary['bounds'], summary['rows_per_date']
+    if is_parquet(path):
+        for date in rows_per_date.index:
+            day = read_parquet_day(path, date, time_as_string=summary['time_as_string'])
+            yield date, prepare_data(filter_outliers(day, bounds))
+        return
+
+    pending_dates = list(rows_per_date.index)
+    buffers = {date: [] for date in pending_dates}
+    rows_seen = dict.fromkeys(pending_dates, 0)
+    for chunk in read_chunks(path, chunksize=chunksize):
+        dates = pd.to_datetime(chunk.start_time, format=TIME_FORMAT, errors='coerce').dt.date
+        for date, day in chunk.groupby(dates, sort=False):
+            rows_seen[date] += len(day)
+            buffers[date].append(filter_outliers(day, bounds))
+        while pending_dates and rows_seen[pending_dates[0]] == rows_per_date[pending_dates[0]]:
+            date = pending_dates.pop(0)
+            yield date, prepare_data(pd.concat(buffers.pop(date)))
+
+
+def read_parquet_day(path: str, date, time_as_string: bool):
+    """
+    Reads the rows of one day from a Parquet file, pushing the date predicate down to the reader.
+    """
+    start, end = pd.Timestamp(date), pd.Timestamp(date) + pd.Timedelta(days=1)
+    if time_as_string:
+        start, end = start.strftime(TIME_FORMAT), end.strftime(TIME_FORMAT)
+    day = pd.read_parquet(path, filters=[('start_time', '>=', start), ('start_time', '<', end)])
+    return day[lambda x: ~(x.start_lng.isna() | x.end_lng.isna())]
+
+
+def split_dates(dates, test_size=0.2):
+    """
+    Splits sorted dates in train and test, the last `test_size` share being test.
+    :return: tuple (train dates, test dates)
+    """
+    unique_dates = np.sort(np.asarray(list(dates)))
     num_days_test = int(len(unique_dates) * test_size)
     test_dates = unique_dates[-num_days_test:]
+    return unique_dates[~np.isin(unique_dates, test_dates)], test_dates
+
+
+def split_data(data, test_size=0.2):
+    _, test_dates = split_dates(data.start_date.unique(), test_size=test_size)
     test_data = data[data.start_date.isin(test_dates)]
     train_data = data[~data.start_date.isin(test_dates)]
     return train_data, test_data
@@ -53,59 +165,93 @@ def haversine_distance(lat1, lon1, lat2, lon2):
     return km
 
 
-def get_nearest_order_per_courier(orders, couriers, distance_map, neighbours_map):
+def is_empty(records):
+    """
+    True if there are no orders/couriers (None, empty list or empty array).
+    """
+    return records is None or len(records) == 0
+
+
+def get_cells(records, location_index):
+    """
+    Returns the cell id of each record (order, courier or action dict).
+    Uses the precomputed `cell` key when available and falls back to a coordinate lookup.
+    :param records: structured array or iterable of dicts with 'lat' and 'lng' (and optionally 'cell') keys
+    :param location_index: LocationIndex
+    :return: int64 array of cell ids
+    """
+    if isinstance(records, np.ndarray):
+        return records['cell'].astype(np.int64)
+    records = list(records)
+    if all('cell' in record for record in records):
+        return np.fromiter((record['cell'] for record in records), dtype=np.int64, count=len(records))
+    return location_index.lookup(
+        [record['lat'] for record in records], [record['lng'] for record in records]
+    )
+
+
+def get_nearest_order_per_courier(orders, couriers, location_index, order_index=None, max_distance=None):
     """
     Returns the nearest order for each courier.
     :param orders:
     :param couriers:
-    :param distance_map:
-    :param neighbours_map:
+    :param location_index: LocationIndex of the scenario
+    :param order_index: OrderIndex over `orders` (built if not given)
+    :param max_distance: optional search radius (km). Couriers without orders within it stay put.
     :return: dict of nearest order for each courier
     """
-    if not orders:
+    courier_cells = get_cells(couriers, location_index)
+    if is_empty(orders):
         return {
-            ix: {'lat': courier['lat'], 'lng': courier['lng']}
+            ix: {'lat': courier['lat'], 'lng': courier['lng'], 'cell': int(courier_cells[ix])}
             for ix, courier in enumerate(couriers)
         }
 
-    nearest_order = dict()
-    for j, courier in enumerate(couriers):
-        courier_lat, courier_lng = courier['lat'], courier['lng']
-        nearest_order[j] = {'order_id': None, 'distance': float('inf'), 'lat': None, 'lng': None}
-        for i, order in enumerate(orders):
-            order_lat, order_lng = order['lat'], order['lng']
-            d = distance_map[(courier_lat, courier_lng)][(order_lat, order_lng)]
-            if d < nearest_order[j]['distance']:
-                move_lat, move_lng, move_distance = compute_movement_location(courier_lat, courier_lng, order_lat, order_lng, neighbours_map)
-                nearest_order[j] = {
-                    'order_id': i,
-                    'distance': d,
-                    'move_distance': move_distance,
-                    'lat': move_lat,
-                    'lng': move_lng,
-                }
+    if order_index is None:
+        order_cells = get_cells(orders, location_index)
+        courier_order_distances = location_index.distances[np.ix_(courier_cells, order_cells)]
+        order_ids = courier_order_distances.argmin(axis=1)
+        distances = courier_order_distances[np.arange(len(courier_cells)), order_ids]
+        if max_distance is not None:
+            order_ids = np.where(distances <= max_distance, order_ids, -1)
+    else:
+        order_cells = order_index.order_cells
+        order_ids, distances = order_index.nearest(courier_cells, max_distance=max_distance)
+    found = order_ids >= 0
+    move_cells, move_distances = compute_movement_location(
+        courier_cells[found], order_cells[order_ids[found]], location_index
+    )
+    nearest_order = {
+        j: {'lat': couriers[j]['lat'], 'lng': couriers[j]['lng'], 'cell': int(courier_cells[j])}
+        for j in np.flatnonzero(~found).tolist()
+    }
+    for j, move_cell, move_distance in zip(np.flatnonzero(found).tolist(), move_cells, move_distances):
+        move_lat, move_lng = location_index.location(move_cell)
+        nearest_order[j] = {
+            'order_id': int(order_ids[j]),
+            'distance': float(distances[j]),
+            'move_distance': float(move_distance),
+            'lat': move_lat,
+            'lng': move_lng,
+            'cell': int(move_cell),
+        }
     return nearest_order
 
 
-def compute_movement_location(start_lat, start_lng, end_lat, end_lng, neighbours_map):
+def compute_movement_location(start_cells, end_cells, location_index):
     """
-    Compute the movement location for a courier based on neighbour map.
-    :param start_lat:
-    :param start_lng:
-    :param end_lat:
-    :param end_lng:
-    :param neighbours_map:
-    :return:
+    Compute the movement location for each courier based on the neighbours array.
+    :param start_cells: cell ids where the couriers are
+    :param end_cells: cell ids the couriers are heading to
+    :param location_index: LocationIndex of the scenario
+    :return: tuple (move cell ids, distance from the move cell to the end cell)
     """
-    movements = neighbours_map[(start_lat, start_lng)]
-    order_exploited_cords, movement_exploited_cords = list(zip(*product([(end_lat, end_lng)], movements)))
-    distance_array = haversine_distance(*zip(*order_exploited_cords), *zip(*movement_exploited_cords))
-    best_distance = float('inf')
-    best_move = None
-    for i, move in enumerate(movements):
-        if distance_array[i] < best_distance:
-            best_move = move
-            best_distance = distance_array[i]
-
-    return *best_move, best_distance
-
+    movements = location_index.neighbours[np.asarray(start_cells)]
+    distance_array = np.where(
+        movements >= 0,
+        location_index.distances[movements, np.asarray(end_cells)[:, None]],
+        np.inf
+    )
+    best = distance_array.argmin(axis=1)
+    rows = np.arange(len(best))
+    return movements[rows, best], distance_array[rows, best]